@@ -0,0 +1,135 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Servo output stage. Only writes the channels the drag |
+# |   | |/ _____ \| |   |  plates are wired to, skips commands inside a deadband |
+# |   | / /_   _\ \ |   |  of the last written angle, and limits slew and update |
+# |  |_____|___|_____|  |  rate. ThreadedServoStage does the PCA9685 writes on   |
+# |    \___________/    |  its own thread so they can't hold up the loop.        |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+from threading import Thread, Event, Lock
+from time import monotonic
+
+
+class ServoStage:
+    """ Writes plate angles to the configured servo channels.
+
+        deadband is in degrees, max_slew in degrees per second (None for no limit)
+        and min_interval is the shortest time between writes in seconds. """
+
+    def __init__(
+        self,
+        servo_kit,
+        channels,
+        deadband=0.5,
+        max_slew=None,
+        min_interval=0.0,
+        clock=monotonic,
+    ):
+        self.servos = [servo_kit.servo[channel] for channel in channels]
+        self.deadband = deadband
+        self.max_slew = max_slew
+        self.min_interval = min_interval
+        self.clock = clock
+
+        self.target = 0
+        self.last_angle = None
+        self.last_time = None
+        self.writes = 0
+        self.skipped = 0  # commands the limits kept from ever being written
+
+    def command(self, angle):
+        """ Ask for a plate angle, it's written now if the limits allow. """
+        self.target = angle
+        if not self.apply():
+            self.skipped += 1
+
+    def apply(self):
+        """ Move toward the target, returns True if the servos were written. """
+        now = self.clock()
+        angle = self.target
+        if self.last_time is not None:
+            elapsed = now - self.last_time
+            if elapsed < self.min_interval:
+                return False
+            if self.max_slew is not None:
+                step = self.max_slew * elapsed
+                angle = min(max(angle, self.last_angle - step), self.last_angle + step)
+            if abs(angle - self.last_angle) < self.deadband:
+                return False
+        self.write(angle, now)
+        return True
+
+    def write(self, angle, now):
+        for servo in self.servos:
+            servo.angle = angle
+        self.last_angle = angle
+        self.last_time = now
+        self.writes += 1
+
+    def force(self, angle):
+        """ Write an angle right away, ignoring every limit. Used to retract. """
+        self.target = angle
+        self.write(angle, self.clock())
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class ThreadedServoStage(ServoStage):
+    """ command() only records the target, a background thread does the writes
+        and keeps slewing toward the target between commands. Only use this with
+        the hardware backend, the simulated servos aren't thread safe.
+
+        A command is skipped when a newer one replaces it before any write, or
+        none comes after it by stop(). Polls that find nothing to do aren't
+        commands and aren't counted. """
+
+    def __init__(self, servo_kit, channels, poll_interval=0.005, **kwargs):
+        super().__init__(servo_kit, channels, **kwargs)
+        self.poll_interval = poll_interval
+        self.commands = 0  # received, only command() changes it
+        self.handled = 0  # commands up to the one behind the last write
+        self.lock = Lock()
+        self.wake = Event()
+        self.running = False
+        self.thread = Thread(target=self.run, name="servos", daemon=True)
+
+    def command(self, angle):
+        self.target = angle
+        self.commands += 1
+        self.wake.set()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+            with self.lock:
+                # Counted before apply() reads the target, which is at least as new
+                commands = self.commands
+                if self.running and self.apply() and commands > self.handled:
+                    # The latest was written, the ones before it never will be
+                    self.skipped += commands - self.handled - 1
+                    self.handled = commands
+
+    def force(self, angle):
+        with self.lock:
+            super().force(angle)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+        self.wake.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.skipped += self.commands - self.handled
+        self.handled = self.commands
@@ -0,0 +1,313 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Post-flight analysis. Streams a DATA log (text table  |
+# |   | |/ _____ \| |   |  or binary recording) into a per-column cache that     |
+# |   | / /_   _\ \ |   |  reloads as memory maps, lines up the LOG events with  |
+# |  |_____|___|_____|  |  the data, and summarizes the flight in one pass.      |
+# |    \___________/    |  Run: python analyze.py DATA-<time>.txt                |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import argparse
+import json
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+
+from control import PID_LIMITS
+from telemetry import MAGIC, read_recording
+from vehicle import Runmode
+
+TIME_COLUMN = "Time (seconds)"
+ALTITUDE_COLUMN = "Altitude (z)"
+PID_COLUMN = "PID Controller Output"
+
+CHUNK_ROWS = 65536
+DAY = 24 * 3600  # seconds
+EVENT_LINE = re.compile(r"\[ (\d\d:\d\d:\d\d) \]\[ (EVENT|ERROR) \]\t(.*)")
+
+# Event messages main.py writes when it enters each mode
+MODE_EVENTS = {
+    "Standing by for launch...": Runmode.STANDBY,
+    "Switching to LAUNCH mode": Runmode.LAUNCH,
+    "Entering drag mode (COAST)": Runmode.COAST,
+    "Switching to DESCENT mode": Runmode.DESCENT,
+}
+COAST_EVENT = "Entering drag mode (COAST)"
+END_EVENT = "Flight complete, exiting program"
+
+# Log spaced bins for loop periods, 1 us to 10 s, so percentiles come out of a
+# histogram filled as the rows stream past
+PERIOD_BINS = np.logspace(-6, 1, 701)
+
+
+class FlightSummary:
+    """ Running flight statistics, updated one chunk of rows at a time. """
+
+    def __init__(self, headers):
+        self.time_index = headers.index(TIME_COLUMN)
+        self.alt_index = headers.index(ALTITUDE_COLUMN)
+        self.pid_index = headers.index(PID_COLUMN) if PID_COLUMN in headers else None
+        self.rows = 0
+        self.apogee = -np.inf
+        self.apogee_time = None
+        self.saturated_time = 0.0
+        self.last_time = None
+        self.last_pid = None
+        self.period_counts = np.zeros(len(PERIOD_BINS) - 1, dtype=np.int64)
+        self.period_sum = 0.0
+        self.period_min = np.inf
+        self.period_max = 0.0
+
+    def update(self, chunk):
+        if not len(chunk):
+            return
+        time = chunk[:, self.time_index]
+        alt = chunk[:, self.alt_index]
+
+        peak = int(alt.argmax())
+        if alt[peak] > self.apogee:
+            self.apogee = float(alt[peak])
+            self.apogee_time = float(time[peak])
+
+        # Loop periods, carrying the previous chunk's last time stamp over
+        if self.last_time is not None:
+            periods = np.diff(time, prepend=self.last_time)
+        else:
+            periods = np.diff(time)
+        if len(periods):
+            self.period_counts += np.histogram(periods, PERIOD_BINS)[0]
+            self.period_sum += float(periods.sum())
+            self.period_min = min(self.period_min, float(periods.min()))
+            self.period_max = max(self.period_max, float(periods.max()))
+
+        # Each row's PID output holds until the next row
+        if self.pid_index is not None and len(periods):
+            pid = chunk[:, self.pid_index]
+            held = pid[:-1]
+            if self.last_pid is not None:
+                held = np.concatenate(([self.last_pid], held))
+            saturated = (held <= PID_LIMITS[0]) | (held >= PID_LIMITS[1])
+            self.saturated_time += float(periods[saturated].sum())
+            self.last_pid = float(pid[-1])
+
+        self.rows += len(chunk)
+        self.last_time = float(time[-1])
+
+    def period_percentile(self, pct):
+        total = self.period_counts.sum()
+        if not total:
+            return None
+        index = int(np.searchsorted(np.cumsum(self.period_counts), total * pct / 100))
+        center = float(np.sqrt(PERIOD_BINS[index] * PERIOD_BINS[index + 1]))
+        return min(max(center, self.period_min), self.period_max)
+
+    def results(self):
+        periods = int(self.period_counts.sum())
+        results = {
+            "rows": self.rows,
+            "apogee": self.apogee if self.rows else None,
+            "apogee_time": self.apogee_time,
+            "pid_saturated_time": self.saturated_time,
+        }
+        if periods:
+            mean = self.period_sum / periods
+            results["loop"] = {
+                "mean_rate": 1 / mean if mean > 0 else None,
+                "mean_period": mean,
+                "min_period": self.period_min,
+                "max_period": self.period_max,
+                **{f"p{p}_period": self.period_percentile(p) for p in (1, 50, 99)},
+            }
+        return results
+
+
+def stream_table(file_name):
+    """ Yield the headers, then chunks of rows, from a Logger text table. """
+    with open(file_name) as f:
+        headers = None
+        for line in f:
+            if "\t\t" in line:
+                headers = tuple(h for h in line.rstrip("\n").split("\t\t") if h)
+                break
+        if headers is None:
+            raise ValueError(f"{file_name} has no table header")
+        yield headers
+
+        width = len(headers)
+        buffer = np.empty((CHUNK_ROWS, width))
+        count = 0
+        for line in f:
+            fields = line.split()
+            if len(fields) != width:
+                continue  # partial last line if the flight was cut short
+            buffer[count] = fields
+            count += 1
+            if count == CHUNK_ROWS:
+                yield buffer
+                count = 0
+        yield buffer[:count]
+
+
+def stream_recording(file_name):
+    """ Yield the headers, then chunks of rows, from a telemetry recording. """
+    headers, records = read_recording(file_name)
+    yield headers
+    for start in range(0, len(records), CHUNK_ROWS):
+        yield np.asarray(records[start : start + CHUNK_ROWS])
+
+
+def is_recording(file_name):
+    with open(file_name, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def column_file(cache_dir, index):
+    return os.path.join(cache_dir, f"column-{index:02d}.f8")
+
+
+def build_cache(file_name, cache_dir):
+    """ Stream the DATA file into one raw float64 file per column. """
+    os.makedirs(cache_dir, exist_ok=True)
+    if is_recording(file_name):
+        stream = stream_recording(file_name)
+    else:
+        stream = stream_table(file_name)
+    headers = next(stream)
+    summary = FlightSummary(headers)
+    outputs = [open(column_file(cache_dir, i), "wb") for i in range(len(headers))]
+    try:
+        for chunk in stream:
+            summary.update(chunk)
+            for i, out in enumerate(outputs):
+                out.write(np.ascontiguousarray(chunk[:, i]).tobytes())
+    finally:
+        for out in outputs:
+            out.close()
+
+    stat = os.stat(file_name)
+    meta = {
+        "source": os.path.basename(file_name),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "headers": list(headers),
+        "rows": summary.rows,
+        "summary": summary.results(),
+    }
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def load_flight(file_name, rebuild=False):
+    """ Columns of a DATA file as memory maps by header, plus the cache metadata.
+        The cache is rebuilt whenever the source file has changed. """
+    cache_dir = file_name + ".cache"
+    meta_file = os.path.join(cache_dir, "meta.json")
+    meta = None
+    if not rebuild and os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        stat = os.stat(file_name)
+        if meta["size"] != stat.st_size or meta["mtime"] != stat.st_mtime:
+            meta = None
+    if meta is None:
+        meta = build_cache(file_name, cache_dir)
+
+    columns = {}
+    for i, header in enumerate(meta["headers"]):
+        if meta["rows"]:
+            columns[header] = np.memmap(
+                column_file(cache_dir, i), dtype="<f8", mode="r", shape=(meta["rows"],)
+            )
+        else:
+            columns[header] = np.empty(0)
+    return columns, meta
+
+
+def read_events(file_name):
+    """ (clock seconds, kind, message) for every event and error in a LOG file.
+        Lines only stamp the time of day, so a clock that goes backwards is taken
+        to have passed midnight and the seconds keep counting up. """
+    events = []
+    day = 0
+    last = 0
+    with open(file_name) as f:
+        for line in f:
+            match = EVENT_LINE.match(line)
+            if match:
+                clock, kind, message = match.groups()
+                t = datetime.strptime(clock, "%H:%M:%S")
+                seconds = t.hour * 3600 + t.minute * 60 + t.second
+                if seconds < last:
+                    day += 1
+                last = seconds
+                events.append((day * DAY + seconds, kind, message))
+    return events
+
+
+def align_events(events):
+    """ Put events on the DATA timeline, where 0 is the start of COAST. LOG stamps
+        are whole seconds, so these are only good to about a second. """
+    coast = next((t for t, _, message in events if message == COAST_EVENT), None)
+    if coast is None:
+        return []
+    return [(t - coast, kind, message) for t, kind, message in events]
+
+
+def mode_durations(events):
+    """ Seconds spent in each Runmode according to the LOG, to the nearest second. """
+    changes = [(t, MODE_EVENTS[m]) for t, _, m in events if m in MODE_EVENTS]
+    end = next((t for t, _, message in events if message == END_EVENT), None)
+    if end is None and events:
+        end = events[-1][0]
+    durations = {mode.name: 0 for mode in Runmode}
+    for (start, mode), (stop, _) in zip(changes, changes[1:] + [(end, None)]):
+        durations[mode.name] += stop - start
+    return durations
+
+
+def find_log(data_file):
+    """ The LOG file written alongside a DATA file, if there is one. """
+    directory, name = os.path.split(data_file)
+    stem = name.split(".")[0]
+    log_file = os.path.join(directory, "LOG" + stem[len("DATA") :] + ".txt")
+    return log_file if os.path.exists(log_file) else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a recorded flight")
+    parser.add_argument("data", help="DATA-<time>.txt or DATA-<time>.bin")
+    parser.add_argument("--log", help="LOG file, found from the DATA name by default")
+    parser.add_argument("--rebuild", action="store_true", help="ignore the cache")
+    args = parser.parse_args()
+
+    columns, meta = load_flight(args.data, args.rebuild)
+    summary = meta["summary"]
+    print(f"{meta['source']}: {meta['rows']:,} rows, {len(columns)} columns")
+    if summary["apogee"] is not None:
+        print(f"Apogee:             {summary['apogee']:,.1f} ft")
+        print(f"  at                {summary['apogee_time']:.3f} s into COAST")
+    print(f"PID saturated:      {summary['pid_saturated_time']:.3f} s")
+    if "loop" in summary:
+        loop = summary["loop"]
+        print(f"Loop rate:          {loop['mean_rate']:,.1f} Hz mean")
+        print(
+            f"Loop period:        min {loop['min_period'] * 1000:.3f} ms, "
+            f"p50 {loop['p50_period'] * 1000:.3f} ms, "
+            f"p99 {loop['p99_period'] * 1000:.3f} ms, "
+            f"max {loop['max_period'] * 1000:.3f} ms"
+        )
+
+    log_file = args.log or find_log(args.data)
+    if log_file:
+        events = read_events(log_file)
+        print("Time in each mode:")
+        for mode, seconds in mode_durations(events).items():
+            print(f"  {mode:<10}{seconds:>6} s")
+        print("Events on the data timeline:")
+        for t, kind, message in align_events(events):
+            print(f"  {t:>+6} s  {kind:<5}  {message}")
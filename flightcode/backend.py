@@ -0,0 +1,413 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Sensor and actuator backends. main.py talks to the    |
+# |   | |/ _____ \| |   |  BNO055, MPL3115A2 and servos through one of these, so |
+# |   | / /_   _\ \ |   |  the flight code can run either on the Pi or against   |
+# |  |_____|___|_____|  |  the simulated dynamics in sim/, faster than real time.|
+# |    \___________/    |                                                        |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import os
+import sys
+from math import copysign
+from threading import Thread
+from time import monotonic, sleep
+
+from registers import BurstBNO055, BurstMPL3115A2, CONVERSION_TIMES, OVERSAMPLING
+from vehicle import FlightStatus, GRAV, METERSTOFEET
+
+SIM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim")
+
+# adafruit_bno055 properties that make up its calibration, see calibration()
+IMU_CALIBRATION = (
+    "offsets_accelerometer",
+    "offsets_gyroscope",
+    "offsets_magnetometer",
+    "radius_accelerometer",
+    "radius_magnetometer",
+)
+DRIVER_ERRORS = (ImportError, NotImplementedError, RuntimeError, OSError, ValueError)
+
+
+class HardwareBackend:
+    """ The real sensors and servos, connected over I2C. """
+
+    name = "hardware"
+
+    def __init__(self):
+        self.i2c = None
+        self.bno = None
+        self.bno_driver = None  # adafruit_bno055 object, even with burst reads
+        self.mpl = None
+        self.servos = None
+
+    def clock(self):
+        return monotonic()
+
+    def sleep(self, seconds):
+        sleep(seconds)
+
+    # Each driver is imported where it's first used, so the rest of the flight
+    # code doesn't need Blinka installed and the imports overlap too
+
+    def open_bno055(self):
+        import adafruit_bno055 as bno055
+
+        self.bno = self.bno_driver = bno055.BNO055(self.i2c)
+
+    def open_mpl3115a2(self):
+        import adafruit_mpl3115a2 as mpl3115a2
+
+        self.mpl = mpl3115a2.MPL3115A2(self.i2c)
+
+    def open_servos(self):
+        from adafruit_servokit import ServoKit
+
+        self.servos = ServoKit(channels=16, i2c=self.i2c)
+
+    def connect(self, event_log):
+        """ Connect to everything, logging what worked. Returns a FlightStatus.
+
+            The devices are set up on a thread each. Most of their setup is
+            sleeping through resets and mode changes, and Blinka's I2C lock keeps
+            their transactions on the shared bus from interleaving. """
+        try:
+            import board
+            import busio
+        except (ImportError, NotImplementedError, RuntimeError):
+            event_log.error("Failed to import sensor drivers")
+            return FlightStatus.NOGO
+
+        # Create I2C object
+        try:
+            self.i2c = busio.I2C(board.SCL, board.SDA)
+            event_log.event("i2c object created succesfully")
+        except RuntimeError:
+            event_log.error("Failed to create an i2c object")
+            return FlightStatus.NOGO
+
+        devices = (
+            ("BNO055", self.open_bno055),
+            ("MPL3115", self.open_mpl3115a2),
+            ("servos", self.open_servos),
+        )
+        failed = {}
+
+        def open_device(name, opener):
+            try:
+                opener()
+            except DRIVER_ERRORS as e:
+                failed[name] = e
+
+        threads = [
+            Thread(target=open_device, args=device, name=f"open {device[0]}")
+            for device in devices
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Logged in a fixed order once they're all done
+        status = FlightStatus.GO
+        for name, _ in devices:
+            if name in failed:
+                event_log.error(f"Failed to connect to {name}: {failed[name]}")
+                status = FlightStatus.NOGO
+            else:
+                event_log.event(f"Connection to {name} successful")
+        return status
+
+    def calibration(self):
+        """ The BNO055's calibration offsets once it's fully calibrated, or None.
+            The lists can be handed back to restore_calibration on a later boot. """
+        bno = self.bno_driver
+        try:
+            if bno is None or not bno.calibrated:
+                return None
+            values = {name: getattr(bno, name) for name in IMU_CALIBRATION}
+        except (AttributeError, RuntimeError, OSError):
+            return None
+        # Offsets are tuples and radii plain numbers, JSON wants lists
+        return {
+            name: list(value) if isinstance(value, tuple) else value
+            for name, value in values.items()
+        }
+
+    def restore_calibration(self, offsets, event_log):
+        """ Load offsets from calibration() into the BNO055, so its fusion doesn't
+            start from scratch. The driver switches to config mode to write them. """
+        bno = self.bno_driver
+        try:
+            for name in IMU_CALIBRATION:
+                value = offsets[name]
+                setattr(bno, name, tuple(value) if isinstance(value, list) else value)
+            event_log.event("Restored BNO055 calibration from the last run")
+        except (AttributeError, KeyError, TypeError, RuntimeError, OSError):
+            event_log.error("Failed to restore BNO055 calibration")
+
+    def use_burst_reads(self, event_log, oversampling=OVERSAMPLING):
+        """ Swap the drivers for the burst readers in registers.py once they've set
+            the sensors up. Returns a FlightStatus. """
+        try:
+            self.bno = BurstBNO055(self.i2c)
+            self.mpl = BurstMPL3115A2(self.i2c, oversampling=oversampling)
+            event_log.event("Using burst register reads")
+        except (RuntimeError, OSError, ValueError):
+            event_log.error("Failed to set up burst register reads")
+            return FlightStatus.NOGO
+        return FlightStatus.GO
+
+
+class SimulatedMPL3115A2:
+    """ Stands in for adafruit_mpl3115a2.MPL3115A2, altitude is in meters. Also
+        stands in for registers.BurstMPL3115A2, whose conversions run on their own
+        and are polled for. """
+
+    def __init__(self, backend, read_time, poll_time, conversion_time):
+        self.backend = backend
+        self.read_time = read_time
+        self.poll_time = poll_time
+        self.conversion_time = conversion_time
+        self.ready_time = None  # when the running conversion finishes
+
+    def measure(self):
+        return (self.backend.pad_altitude + self.backend.height) / METERSTOFEET
+
+    @property
+    def altitude(self):
+        self.backend.advance(self.read_time)
+        return self.measure()
+
+    def poll_altitude(self):
+        backend = self.backend
+        backend.advance(self.poll_time)
+        if self.ready_time is None:
+            self.ready_time = backend.time + self.conversion_time
+        elif backend.time >= self.ready_time:
+            self.ready_time = backend.time + self.conversion_time
+            return self.measure()
+        return None
+
+
+class SimulatedBNO055:
+    """ Stands in for adafruit_bno055.BNO055 and registers.BurstBNO055,
+        acceleration is in m/s^2. Like the real sensor it measures specific
+        force, the vehicle's acceleration plus 1 g, so it reads +g on the pad. """
+
+    def __init__(self, backend, read_time, burst_time):
+        self.backend = backend
+        self.read_time = read_time
+        self.burst_time = burst_time
+
+    @property
+    def acceleration(self):
+        self.backend.advance(self.read_time)
+        return (0.0, 0.0, self.specific_force())
+
+    @property
+    def quaternion(self):
+        # The simulated vehicle flies straight up, so body and inertial frames line up
+        self.backend.advance(self.read_time)
+        return (1.0, 0.0, 0.0, 0.0)
+
+    def read_motion(self):
+        self.backend.advance(self.burst_time)
+        return (0.0, 0.0, self.specific_force()), (1.0, 0.0, 0.0, 0.0)
+
+    def specific_force(self):
+        """ Vertical reading in m/s^2. """
+        return (self.backend.accel + GRAV) / METERSTOFEET
+
+
+class SimulatedServo:
+    def __init__(self, backend, write_time):
+        self.backend = backend
+        self.write_time = write_time
+        self._angle = 0
+
+    @property
+    def angle(self):
+        return self._angle
+
+    @angle.setter
+    def angle(self, degrees):
+        self.backend.advance(self.write_time)
+        if degrees != self._angle:
+            self._angle = degrees
+            self.backend.input_changed()
+
+
+class SimulatedServoKit:
+    """ Stands in for adafruit_servokit.ServoKit. """
+
+    def __init__(self, backend, channels, write_time):
+        self.servo = [SimulatedServo(backend, write_time) for _ in range(channels)]
+
+
+# Phases of the simulated flight, each with its own dynamics
+PAD = "pad"
+BURN = "burn"
+COAST = "coast"
+LANDED = "landed"
+
+
+class SimBackend:
+    """ 1D flight driven by the drag model in sim/sim.py and sim/atmosphere.py.
+
+        Time is simulated: every sensor read or servo write advances the clock by
+        roughly what that I2C transaction costs on the Pi, so the flight code runs
+        as fast as the CPU allows and the same inputs always give the same flight.
+
+        The flight is integrated by one of the integrators in sim/integrators.py,
+        adaptive RK45 by default, only as far as the clock has got. Ignition,
+        burnout and landing end a step exactly where they happen and switch the
+        phase there, apogee is found by root finding, and a new plate angle
+        starts a fresh step from the moment it's written. """
+
+    name = "sim"
+
+    def __init__(
+        self,
+        pad_altitude=1000,
+        pad_time=5.0,
+        burn_time=1.5,
+        thrust_accel=480.0,
+        integrator="rk45",
+        step=0.01,
+        baro_read_time=0.005,
+        imu_read_time=0.001,
+        servo_write_time=0.0005,
+        imu_burst_time=0.0008,
+        baro_poll_time=0.0002,
+    ):
+        if SIM_DIR not in sys.path:
+            sys.path.insert(0, SIM_DIR)
+        import sim as dynamics
+        from atmosphere import Atmosphere
+        from integrators import Event, Trajectory, create_integrator
+
+        self.dynamics = dynamics
+        self.atmosphere = Atmosphere()
+
+        self.pad_altitude = pad_altitude  # feet above sea level
+        self.pad_time = pad_time  # time on the pad before ignition
+        self.burn_time = burn_time
+        self.thrust_accel = thrust_accel  # ft/s^2, net of gravity and drag ignored
+
+        self.time = 0.0
+        self.height = 0.0  # feet above the pad
+        self.velocity = 0.0
+        self.phase = PAD
+
+        self.apogee_event = Event("apogee", lambda t, y: y[1], direction=-1)
+        events = (
+            Event(BURN, lambda t, y: t - self.pad_time, 1, terminal=True),
+            Event(COAST, lambda t, y: t - self.burnout_time, 1, terminal=True),
+            Event(LANDED, lambda t, y: y[0], -1, terminal=True),
+            self.apogee_event,
+        )
+        self.integrator = create_integrator(integrator, step=step)
+        self.trajectory = Trajectory(
+            self.rates, 0.0, (0.0, 0.0), self.integrator, events, self.change_phase
+        )
+
+        self.bno = SimulatedBNO055(self, imu_read_time, imu_burst_time)
+        self.mpl = SimulatedMPL3115A2(
+            self, baro_read_time, baro_poll_time, CONVERSION_TIMES[OVERSAMPLING]
+        )
+        self.servos = SimulatedServoKit(self, 16, servo_write_time)
+
+    @property
+    def burnout_time(self):
+        return self.pad_time + self.burn_time
+
+    @property
+    def accel(self):
+        """ Vertical acceleration in ft/s^2 right now. """
+        return self.derivative(self.time, self.height, self.velocity)
+
+    @property
+    def apogee(self):
+        """ Highest point above the pad so far, in feet. """
+        highest = self.height
+        for event, time, state in self.trajectory.found:
+            if event is self.apogee_event and time <= self.time:
+                highest = max(highest, state[0])
+        return highest
+
+    def clock(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def connect(self, event_log):
+        event_log.event("Using simulated sensors and servos")
+        return FlightStatus.GO
+
+    def calibration(self):
+        return None
+
+    def restore_calibration(self, offsets, event_log):
+        pass
+
+    def use_burst_reads(self, event_log, oversampling=OVERSAMPLING):
+        self.mpl.conversion_time = CONVERSION_TIMES[oversampling]
+        event_log.event("Using burst register reads on the simulated sensors")
+        return FlightStatus.GO
+
+    def plate_input(self):
+        """ Drag plate deflection as the 0 to 1 input sim.acceleration expects. """
+        angle = self.servos.servo[0].angle or 0
+        return angle / 180
+
+    def derivative(self, time, height, velocity):
+        """ Vertical acceleration in ft/s^2 at the given state. """
+        if self.phase is COAST:
+            density = self.atmosphere.density(self.pad_altitude + height)
+            coast = self.dynamics.acceleration(velocity, density, self.plate_input())
+            drag = -coast - self.dynamics.GRAV
+            return -self.dynamics.GRAV - copysign(drag, velocity)
+        if self.phase is BURN:
+            return self.thrust_accel
+        return 0.0
+
+    def rates(self, time, state):
+        height, velocity = state
+        return velocity, self.derivative(time, height, velocity)
+
+    def change_phase(self, event, time, state):
+        self.phase = event.name
+        if self.phase is LANDED:
+            return 0.0, 0.0
+        return state
+
+    def input_changed(self):
+        """ The plate angle changed, the integration carries on from now. """
+        self.trajectory.restart(self.time)
+
+    def integration_report(self):
+        integrator = self.integrator
+        return (
+            f"Integrated with {integrator.name}: {integrator.evaluations:,} "
+            f"derivative evaluations in {integrator.steps:,} steps"
+        )
+
+    def advance(self, seconds):
+        """ Integrate the flight forward by the given amount of time. """
+        self.time += seconds
+        self.height, self.velocity = self.trajectory.at(self.time)
+
+
+BACKENDS = {HardwareBackend.name: HardwareBackend, SimBackend.name: SimBackend}
+
+
+def create_backend(name):
+    """ Look up a backend by name and create it. """
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown backend '{name}', expected one of {list(BACKENDS)}")
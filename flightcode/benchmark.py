@@ -0,0 +1,361 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Microbenchmarks for the flight code: what each piece  |
+# |   | |/ _____ \| |   |  of a control cycle costs in Python, down to a whole   |
+# |   | / /_   _\ \ |   |  COAST cycle on fake sensors. Results are compared to  |
+# |  |_____|___|_____|  |  a JSON baseline and the run fails on a regression.    |
+# |    \___________/    |  Run: python benchmark.py [--save]                     |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from timeit import Timer
+
+import numpy as np
+
+import vehicle
+import control
+from actuator import ServoStage
+from backend import SIM_DIR
+from downlink import Downlink, LoopbackTransport
+from estimator import AltitudeEstimator
+from logger import Logger, ThreadedLogger, LogWriter
+from pid import PID
+from registers import (
+    decode_altitude,
+    decode_motion,
+    encode_altitude,
+    encode_motion,
+    BNO055_ACCEL_DATA,
+    MOTION,
+)
+from sampler import Sampler
+from telemetry import TelemetryRecorder
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.json")
+THRESHOLD = 10  # percent slower than the baseline that counts as a regression
+REPEAT = 7
+DATA_ROW = (12.34, 0.1, -0.2, -45.6, 1.2, -2.3, 345.6, 7.8, -9.1, 2345.6, 42.0, 4000.1)
+
+
+class FakeBNO055:
+    """ Accelerometer that answers instantly with a fixed, slightly tilted coast.
+        Like the real one it reads specific force, only drag during a coast. """
+
+    acceleration = (0.31, -0.12, -2.4)
+    quaternion = (0.9990482, 0.0348995, 0.0, 0.0261769)
+
+
+class FakeMPL3115A2:
+    altitude = 1219.2  # meters
+
+
+class FakeServo:
+    angle = 0
+
+
+class FakeServoKit:
+    def __init__(self, channels=16):
+        self.servo = [FakeServo() for _ in range(channels)]
+
+
+class FakeClock:
+    """ Moves forward one control period every time it's read. """
+
+    def __init__(self, period=0.01):
+        self.now = 0.0
+        self.period = period
+
+    def __call__(self):
+        self.now += self.period
+        return self.now
+
+
+# Each case sets itself up and returns the call to time, or the call and a
+# function that cleans up after it
+
+def pid_output():
+    pid = PID(*control.PID_GAINS, 4000, min_output=0, max_output=180)
+    return lambda: pid.output(4100.0, 0.01)
+
+
+def vehicle_to_inertial():
+    quaternion = FakeBNO055.quaternion
+    accel = np.array(FakeBNO055.acceleration)
+    return lambda: vehicle.vehicle_to_inertial(quaternion) @ accel
+
+
+def inertial_acceleration():
+    sampler = Sampler(FakeBNO055(), FakeMPL3115A2(), FakeClock())
+    snapshot = sampler.sample()
+    return lambda: vehicle.inertial_acceleration(snapshot)
+
+
+def projected_altitude():
+    return lambda: vehicle.projected_altitude(-40.0, 500.0, 2500.0)
+
+
+def estimator_step():
+    estimator = AltitudeEstimator(4000.0)
+
+    def step():
+        estimator.predict(0.01)
+        estimator.update_acceleration(-40.0)
+        estimator.update_altitude(4000.0)
+
+    return step
+
+
+def sampler_sample():
+    sampler = Sampler(FakeBNO055(), FakeMPL3115A2(), FakeClock())
+    return sampler.sample
+
+
+def decode_registers():
+    """ Decoding a burst read of both sensors, the bus time isn't included. """
+    image = encode_motion(FakeBNO055.acceleration, FakeBNO055.quaternion)
+    motion = bytes(image[BNO055_ACCEL_DATA : BNO055_ACCEL_DATA + MOTION.size])
+    altitude = bytes(encode_altitude(FakeMPL3115A2.altitude)[:5])
+
+    def decode():
+        decode_motion(motion)
+        decode_altitude(altitude)
+
+    return decode
+
+
+def logger_write_to_table():
+    log = Logger("DATA", control.DATA_HEADERS)
+    return lambda: log.write_to_table(DATA_ROW)
+
+
+def logger_event():
+    log = Logger("LOG")
+    return lambda: log.event("Switching to DESCENT mode")
+
+
+def threaded_logger_event():
+    # Big enough that the timing loop never fills it, and stopped afterwards so
+    # the writer thread doesn't slow down the cases after this one
+    writer = LogWriter(capacity=2 ** 24, fsync_interval=None)
+    log = ThreadedLogger("LOG", writer=writer)
+    return lambda: log.event("Switching to DESCENT mode"), writer.stop
+
+
+def recorder_writer():
+    """ TelemetryRecorder.write_to_table that starts over at the top of the file
+        instead of dropping rows once it's full. """
+    recorder = TelemetryRecorder("DATA", control.DATA_HEADERS, 2 ** 16)
+
+    def write(row):
+        if recorder.count == recorder.capacity:
+            recorder.count = 0
+        recorder.write_to_table(row)
+
+    return write
+
+
+def telemetry_write_to_table():
+    write = recorder_writer()
+    return lambda: write(DATA_ROW)
+
+
+def downlink_publish():
+    """ Quantizing and framing a row, with a budget too big to ever run out. """
+    downlink = Downlink(LoopbackTransport(), bandwidth=1e12, clock=FakeClock())
+    return lambda: downlink.publish(DATA_ROW)
+
+
+def atmosphere_density():
+    from atmosphere import Atmosphere
+
+    atmosphere = Atmosphere()
+    return lambda: atmosphere.density(2500.0)
+
+
+def atmosphere_density_array():
+    """ A batch of altitudes the way montecarlo.py and surface.py ask. """
+    from atmosphere import Atmosphere
+
+    atmosphere = Atmosphere()
+    altitudes = np.linspace(0.0, 10000.0, 1000)
+    return lambda: atmosphere.density(altitudes)
+
+
+def atmosphere_table_density():
+    from atmosphere import AtmosphereTable
+
+    atmosphere = AtmosphereTable()
+    altitudes = np.linspace(0.0, 10000.0, 1000)
+    return lambda: atmosphere.density(altitudes)
+
+
+def coast_cycle():
+    """ Sample, rotate, estimate, project, PID, servos and the data log, as
+        main.py runs them in COAST. """
+    clock = FakeClock()
+    sampler = Sampler(FakeBNO055(), FakeMPL3115A2(), clock)
+    servo_stage = ServoStage(FakeServoKit(), (0, 1), max_slew=600, clock=clock)
+    write = recorder_writer()
+    controller = control.FlightController(4000.0, 4000.0, command=servo_stage.command)
+    controller.start_coast(0.0)
+    controller.apogee_detector.window = float("inf")  # stay in COAST
+    step = controller.step
+
+    def cycle():
+        write(step(sampler.sample(), 0.01))
+
+    return cycle
+
+
+CASES = {
+    "PID.output": pid_output,
+    "vehicle_to_inertial @ accel": vehicle_to_inertial,
+    "inertial_acceleration": inertial_acceleration,
+    "projected_altitude": projected_altitude,
+    "AltitudeEstimator step": estimator_step,
+    "Sampler.sample": sampler_sample,
+    "decode burst registers": decode_registers,
+    "Logger.write_to_table": logger_write_to_table,
+    "Logger.event": logger_event,
+    "ThreadedLogger.event": threaded_logger_event,
+    "TelemetryRecorder.write_to_table": telemetry_write_to_table,
+    "Downlink.publish": downlink_publish,
+    "Atmosphere.density": atmosphere_density,
+    "Atmosphere.density x 1,000": atmosphere_density_array,
+    "AtmosphereTable.density x 1,000": atmosphere_table_density,
+    "COAST cycle": coast_cycle,
+}
+
+
+def measure(call, repeat=REPEAT):
+    """ Best time per call in nanoseconds, over `repeat` runs of enough calls to
+        take at least 0.2 s each. """
+    timer = Timer(call)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def run(names, repeat=REPEAT):
+    """ Results in nanoseconds per call by case name. Files the cases write go to a
+        scratch directory that's removed afterwards. """
+    if SIM_DIR not in sys.path:
+        sys.path.insert(0, SIM_DIR)
+    results = {}
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        os.chdir(scratch)
+        for name in names:
+            case = CASES[name]()
+            call, cleanup = case if isinstance(case, tuple) else (case, None)
+            results[name] = measure(call, repeat)
+            if cleanup is not None:
+                cleanup()
+            print(f"  {name:<34}{results[name]:>12,.0f} ns")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+def machine():
+    return {
+        "platform": platform.platform(),
+        "processor": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+
+def load_baseline(file_name):
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def save_baseline(file_name, results, old=None):
+    """ Store results, keeping any cases this run didn't measure. """
+    merged = dict(old["results"]) if old else {}
+    merged.update(results)
+    with open(file_name, "w") as f:
+        json.dump({"machine": machine(), "results": merged}, f, indent=2)
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """ (name, ns, baseline ns or None, change in percent or None, regressed). """
+    rows = []
+    for name, ns in results.items():
+        old = baseline["results"].get(name) if baseline else None
+        if old:
+            change = (ns - old) / old * 100
+            rows.append((name, ns, old, change, change > threshold))
+        else:
+            rows.append((name, ns, None, None, False))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flight code microbenchmarks")
+    parser.add_argument("cases", nargs="*", help="case names, all of them by default")
+    parser.add_argument("--baseline", default=BASELINE, help="JSON baseline file")
+    parser.add_argument(
+        "--save", action="store_true", help="store these results as the baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="percent slower than the baseline that fails the run",
+    )
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--list", action="store_true", help="list the cases and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(CASES))
+        sys.exit(0)
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}")
+
+    baseline = load_baseline(args.baseline)
+    if baseline and baseline["machine"] != machine():
+        print(f"Warning: {args.baseline} was recorded on {baseline['machine']}")
+    print("Running benchmarks")
+    results = run(args.cases or list(CASES), args.repeat)
+
+    print()
+    print(f"{'Case':<36}{'ns/call':>10}{'baseline':>10}{'change':>9}")
+    regressions = []
+    for name, ns, old, change, regressed in compare(results, baseline, args.threshold):
+        if old is None:
+            print(f"{name:<36}{ns:>10,.0f}{'-':>10}{'-':>9}")
+            continue
+        flag = "  REGRESSED" if regressed else ""
+        print(f"{name:<36}{ns:>10,.0f}{old:>10,.0f}{change:>+8.1f}%{flag}")
+        if regressed:
+            regressions.append(name)
+    if "COAST cycle" in results:
+        ns = results["COAST cycle"]
+        print(
+            f"\nA COAST cycle costs {ns / 1000:.1f} us, {ns / 1e5:.2f}% of a 10 ms tick"
+        )
+
+    if args.save:
+        save_baseline(args.baseline, results, baseline)
+        print(f"Saved {args.baseline}")
+    elif regressions:
+        print(
+            f"\n{len(regressions)} case(s) more than {args.threshold:g}% slower "
+            "than the baseline"
+        )
+        sys.exit(1)
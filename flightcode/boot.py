@@ -0,0 +1,145 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Startup bookkeeping: how long each boot phase took on |
+# |   | |/ _____ \| |   |  the way to armed, from process start and from power   |
+# |   | / /_   _\ \ |   |  on, and the calibration cache the last run left so    |
+# |  |_____|___|_____|  |  the next one can warm start. Standard library only,   |
+# |    \___________/    |  so main.py can import it before anything heavy.       |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import json
+import os
+from threading import Thread
+from time import perf_counter, time
+
+CALIBRATION = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "calibration.json"
+)
+
+# The Pi has no real time clock, so ages can be off after a cold boot without a
+# network. The cached pad altitude is also checked against fresh readings.
+CALIBRATION_MAX_AGE = 6 * 3600  # seconds
+
+
+def uptime():
+    """ Seconds since the system booted, roughly since power on, or None off
+        Linux. """
+    try:
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_age():
+    """ Seconds since this process started, interpreter startup included, or
+        None off Linux. """
+    up = uptime()
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the command name, which is in parentheses and may have
+            # spaces, start time is the 22nd field overall
+            fields = f.read().rsplit(")", 1)[1].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+    return None if up is None else up - started
+
+
+class Background(Thread):
+    """ Runs task(*args) on its own thread, result() waits for it and returns
+        what it returned, or raises what it raised. """
+
+    def __init__(self, name, task, *args):
+        super().__init__(name=name, daemon=True)
+        self.task = task
+        self.args = args
+        self.value = None
+        self.exception = None
+        self.seconds = None
+
+    def run(self):
+        start = perf_counter()
+        try:
+            self.value = self.task(*self.args)
+        except BaseException as e:
+            self.exception = e
+        self.seconds = perf_counter() - start
+
+    def result(self):
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class BootTimer:
+    """ Times the boot phases one after another, lap(name) ends the current one.
+        Work started with background() overlaps the phases and is reported next
+        to them. """
+
+    def __init__(self, clock=perf_counter):
+        self.clock = clock
+        self.start = self.last = clock()
+        self.phases = []  # (name, seconds)
+        self.tasks = []
+
+    def lap(self, name):
+        now = self.clock()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def background(self, name, task, *args):
+        """ Start task(*args) on a thread, returns it, call result() on it. """
+        task = Background(name, task, *args)
+        self.tasks.append(task)
+        task.start()
+        return task
+
+    def elapsed(self):
+        return self.clock() - self.start
+
+    def report(self):
+        """ One line, e.g. for the event log once the flight is armed. """
+        parts = [f"{name} {seconds:.3f} s" for name, seconds in self.phases]
+        parts += [
+            f"{task.name} {task.seconds:.3f} s in the background"
+            for task in self.tasks
+            if task.seconds is not None
+        ]
+        line = f"Armed in {self.elapsed():.3f} s"
+        age, up = process_age(), uptime()
+        if age is not None:
+            line += f", {age:.3f} s after the process started"
+        if up is not None:
+            line += f", {up:.1f} s after power on"
+        return f"{line}: {', '.join(parts)}"
+
+
+def load_calibration(file_name, backend, max_age=CALIBRATION_MAX_AGE):
+    """ What the last run on this backend saved, or None if there's nothing or it
+        was saved more than max_age seconds ago. """
+    try:
+        with open(file_name) as f:
+            calibration = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(calibration, dict) or calibration.get("backend") != backend:
+        return None
+    if not 0 <= time() - calibration.get("saved", 0) <= max_age:
+        return None
+    return calibration
+
+
+def save_calibration(file_name, backend, **values):
+    """ Replace the cache in one rename, so a power cut never leaves half a
+        file. """
+    calibration = {"backend": backend, "saved": time(), **values}
+    temporary = f"{file_name}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(calibration, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, file_name)
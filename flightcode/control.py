@@ -0,0 +1,174 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  One control cycle of the flight: estimator update,    |
+# |   | |/ _____ \| |   |  mode transitions, apogee projection and PID output    |
+# |   | / /_   _\ \ |   |  from a sensor snapshot. main.py runs it on live       |
+# |  |_____|___|_____|  |  sensors and replay.py on recorded ones, so both go    |
+# |    \___________/    |  through exactly the same code.                        |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import vehicle
+import profiler as prof
+from pid import PID
+from estimator import AltitudeEstimator
+
+TARGET_ALT = 10000  # altitude to reach from ground
+LAUNCH_HEIGHT = 100  # feet above the pad that count as a launch
+PID_GAINS = (0.1, 0.05, 0.001)  # KP, KI, KD
+PID_LIMITS = (0, 180)  # plate angle, degrees
+
+# How long each flight event has to persist before the mode switches, in seconds
+LAUNCH_WINDOW = 0.5
+BURNOUT_WINDOW = 0.1
+APOGEE_WINDOW = 0.5
+APOGEE_HYSTERESIS = 0  # ft/s
+
+DATA_HEADERS = (
+    "Time (seconds)",
+    "Acceleration (x)",
+    "Acceleration (y)",
+    "Acceleration (z)",
+    "Velocity (x)",
+    "Velocity (y)",
+    "Velocity (z)",
+    "Position (x)",
+    "Position (y)",
+    "Altitude (z)",
+    "PID Controller Output",
+    "Projected Altitude",
+)
+
+
+def ignore(*args):
+    pass
+
+
+class FlightController:
+    """ Takes the flight from STANDBY to DESCENT one snapshot at a time.
+
+        init_alt is the pad altitude and target the altitude to reach, both in
+        feet. predictor is an ApogeePredictor, or None for the closed form
+        projection. command(angle) moves the plates and notify(message) reports
+        flight events, both are skipped by default. The mode, estimate, PID and
+        DATA row all live in one vehicle.FlightState. """
+
+    def __init__(
+        self,
+        init_alt,
+        target,
+        predictor=None,
+        gains=PID_GAINS,
+        command=ignore,
+        notify=ignore,
+        profiler=None,
+    ):
+        self.predictor = predictor
+        self.command = command
+        self.notify = notify
+        self.profiler = profiler if profiler is not None else prof.NullProfiler()
+        self.state = state = vehicle.FlightState()
+
+        # Vertical state estimate, fed by both sensors every cycle
+        self.estimator = AltitudeEstimator(init_alt, memory=state.estimate)
+        low, high = PID_LIMITS
+        self.pid = PID(
+            *gains, target, min_output=low, max_output=high, memory=state.pid
+        )
+
+        # Flight event detectors, each fed one sample per cycle
+        self.launch_detector = vehicle.LaunchDetector(
+            init_alt + LAUNCH_HEIGHT, LAUNCH_WINDOW, memory=state.launch
+        )
+        self.burnout_detector = vehicle.BurnoutDetector(
+            BURNOUT_WINDOW, memory=state.burnout
+        )
+        self.apogee_detector = vehicle.ApogeeDetector(
+            APOGEE_WINDOW, APOGEE_HYSTERESIS, memory=state.apogee
+        )
+
+    @property
+    def mode(self):
+        return self.state.mode
+
+    @mode.setter
+    def mode(self, mode):
+        self.state.mode = mode
+
+    def start_coast(self, time):
+        """ DATA rows count time from here. """
+        self.state.mode = vehicle.Runmode.COAST
+        self.state.coast_start = time
+
+    def step(self, snapshot, dt):
+        """ Run one control cycle, dt seconds after the last. Returns the DATA row
+            during COAST, otherwise None. The row is one of the state's saved
+            rows, copy it to keep it longer than vehicle.HISTORY cycles. """
+        profiler = self.profiler
+        estimator = self.estimator
+        state = self.state
+        mark = profiler.mark()
+        acceleration = vehicle.inertial_acceleration(snapshot, state.acceleration)
+        mark = profiler.lap(prof.ROTATION, mark)
+        estimator.predict(dt)
+        estimator.update_acceleration(acceleration[2])
+        if snapshot.altitude_fresh:
+            estimator.update_altitude(vehicle.altitude(snapshot))
+        profiler.lap(prof.ESTIMATOR, mark)
+
+        # Waiting for launch on the launhpad
+        mode = state.mode
+        if mode is vehicle.Runmode.STANDBY:
+            if self.launch_detector.update(snapshot.time, estimator.altitude):
+                state.mode = vehicle.Runmode.LAUNCH
+                latency = self.launch_detector.latency
+                self.notify(f"Launch confirmed after {latency:.3f} s")
+                self.notify("Switching to LAUNCH mode")
+
+        # Waiting for motor to burn out
+        elif mode is vehicle.Runmode.LAUNCH:
+            if self.burnout_detector.update(snapshot.time, estimator.acceleration):
+                self.start_coast(snapshot.time)
+                latency = self.burnout_detector.latency
+                self.notify(f"Burnout confirmed after {latency:.3f} s")
+                self.notify("Entering drag mode (COAST)")
+
+        # Deploy drag plates
+        elif mode is vehicle.Runmode.COAST:
+            return self.coast(snapshot, acceleration, dt)
+
+        return None
+
+    def coast(self, snapshot, acceleration, dt):
+        profiler = self.profiler
+        estimator = self.estimator
+        state = self.state
+        memory = state.memory
+        velocity = vehicle.velocity(state, acceleration, estimator.velocity, dt)
+        alt = estimator.altitude
+        vehicle.position(state, velocity, alt, dt)
+        mark = profiler.mark()
+        if self.predictor is not None:
+            # Plates are at last cycle's command until this one goes out
+            p_alt = self.predictor.predict(alt, estimator.velocity, self.pid.output_val)
+        else:
+            p_alt = vehicle.projected_altitude(
+                estimator.acceleration, estimator.velocity, alt
+            )
+        mark = profiler.lap(prof.PROJECTION, mark)
+        angle = self.pid.output(p_alt, dt)
+        mark = profiler.lap(prof.PID, mark)
+        self.command(angle)
+        profiler.lap(prof.SERVOS, mark)
+        # The rest of the row is already in place
+        memory[vehicle.TIME] = snapshot.time - memory[vehicle.COAST_START]
+        memory[vehicle.PID_OUTPUT] = angle
+        memory[vehicle.PROJECTED_ALT] = p_alt
+        row = state.save()
+        if self.apogee_detector.update(snapshot.time, velocity[2]):
+            state.mode = vehicle.Runmode.DESCENT
+            self.notify(f"Reached apogee: {alt:,} feet")
+            self.notify(f"Apogee confirmed after {self.apogee_detector.latency:.3f} s")
+            self.notify("Switching to DESCENT mode")
+        return row
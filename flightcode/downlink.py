@@ -0,0 +1,507 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Live telemetry downlink (main.py --downlink). COAST   |
+# |   | |/ _____ \| |   |  rows and flight events go out as small binary frames: |
+# |   | / /_   _\ \ |   |  quantized deltas between keyframes, a sequence number |
+# |  |_____|___|_____|  |  and a CRC, over UDP, a serial radio or a loopback.    |
+# |    \___________/    |  Low priority fields are sent less often when the link |
+# |                     |  can't keep up. Run this file on the ground to receive |
+# |                     |  and store the stream: python downlink.py udp::5005    |
+# +------------------------------------------------------------------------------+
+
+import argparse
+import socket
+from binascii import crc_hqx
+from collections import deque
+from struct import Struct, error as StructError
+from time import monotonic
+
+import control
+from logger import Logger, format_message
+from telemetry import TelemetryRecorder, convert_to_table
+
+# Frame: sync, kind, sequence, payload size, payload, CRC-16/CCITT of everything
+# between the sync bytes and the CRC
+SYNC = b"\xa5\x5a"
+HEADER = Struct("<2sBHB")
+CRC = Struct("<H")
+OVERHEAD = HEADER.size + CRC.size
+MAX_PAYLOAD = 255
+
+# Frame kinds. Keyframes carry every field as an int32, deltas carry the fields
+# due this frame as int16 changes since the last keyframe, so losing one delta
+# doesn't affect the others
+KEYFRAME = 1
+DELTA = 2
+EVENT = 3
+ERROR = 4
+
+HIGH = 0
+MEDIUM = 1
+LOW = 2
+MAX_PERIOD = 32  # frames, the most a priority is decimated
+
+# (quantum, priority) for each DATA column, values go down as multiples of quantum
+FIELDS = {
+    "Time (seconds)": (0.001, HIGH),
+    "Acceleration (x)": (0.01, LOW),
+    "Acceleration (y)": (0.01, LOW),
+    "Acceleration (z)": (0.01, MEDIUM),
+    "Velocity (x)": (0.01, LOW),
+    "Velocity (y)": (0.01, LOW),
+    "Velocity (z)": (0.01, HIGH),
+    "Position (x)": (0.1, LOW),
+    "Position (y)": (0.1, LOW),
+    "Altitude (z)": (0.1, HIGH),
+    "PID Controller Output": (0.01, HIGH),
+    "Projected Altitude": (0.1, MEDIUM),
+}
+QUANTA = tuple(FIELDS[header][0] for header in control.DATA_HEADERS)
+PRIORITIES = tuple(FIELDS[header][1] for header in control.DATA_HEADERS)
+ALL_FIELDS = (1 << len(control.DATA_HEADERS)) - 1
+DATA_PREFIX = Struct("<BH")  # keyframe number, field mask
+MISSING = -(2 ** 31)  # int32 sent for values that can't be quantized, e.g. NaN
+EVENT_TIME = Struct("<d")
+
+KEY_INTERVAL = 50  # data frames between keyframes
+BANDWIDTH = 1200  # bytes per second, about what a 9600 baud radio gets through
+ADAPT_INTERVAL = 0.25  # seconds between rate adjustments
+EVENT_BACKLOG = 64
+
+
+def crc(data):
+    return crc_hqx(data, 0xFFFF)
+
+
+def frame(kind, sequence, payload):
+    """ One complete frame. """
+    body = HEADER.pack(SYNC, kind, sequence, len(payload)) + payload
+    return body + CRC.pack(crc(body[2:]))
+
+
+def value_format(kind, mask):
+    """ Struct for a data payload with the fields in mask: keyframe number, mask
+        and the values. """
+    count = bin(mask).count("1")
+    return Struct(f"<BH{count}{'i' if kind == KEYFRAME else 'h'}")
+
+
+def quantize(value, quantum):
+    """ Slow path for values the fast one couldn't pack. """
+    try:
+        q = round(value / quantum)
+    except (ValueError, OverflowError):
+        return MISSING
+    return max(MISSING + 1, min(q, 2 ** 31 - 1))
+
+
+class Downlink:
+    """ Builds and sends telemetry frames, inside a link budget in bytes per
+        second. publish() takes a COAST data row, event() and error() a message.
+
+        Every data frame carries the HIGH priority fields. MEDIUM and LOW ones are
+        only due every `periods[priority]` frames, and when the link falls behind
+        the lowest priority is decimated first, then the frame rate itself. Events
+        go ahead of data. Frames that don't fit are skipped, never queued, so the
+        stream always carries the latest values. """
+
+    def __init__(self, transport, bandwidth=BANDWIDTH, clock=monotonic):
+        self.transport = transport
+        self.bandwidth = bandwidth
+        self.clock = clock
+        self.budget = bandwidth / 4  # bytes that can go out in one burst
+        self.tokens = self.budget
+        self.last_time = None
+
+        self.sequence = 0
+        self.rows = 0  # rows published
+        self.since_key = KEY_INTERVAL  # data frames since the last keyframe
+        self.key = None  # quantized values of the last keyframe
+        self.key_id = 0
+        self.inverse = [1 / quantum for quantum in QUANTA]
+        self.periods = [1, 1, 1]  # by priority, powers of two
+        self.key_packer = value_format(KEYFRAME, ALL_FIELDS)
+        self.layouts = {}
+        self.events = deque()
+
+        # Link use over the current adaptation window
+        self.window_start = None
+        self.window_bytes = 0
+        self.window_skipped = 0
+
+        self.frames = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.events_dropped = 0
+
+    def refill(self):
+        now = self.clock()
+        if self.last_time is not None:
+            self.tokens = min(
+                self.budget, self.tokens + (now - self.last_time) * self.bandwidth
+            )
+        else:
+            self.window_start = now
+        self.last_time = now
+        if now - self.window_start >= ADAPT_INTERVAL:
+            self.adapt(now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+            self.window_skipped = 0
+
+    def adapt(self, elapsed):
+        """ Decimate more if frames were skipped or the link is nearly full, less
+            once it's under half used. """
+        periods = self.periods
+        use = self.window_bytes / (self.bandwidth * elapsed)
+        if self.window_skipped or use > 0.9:
+            for priority in (LOW, MEDIUM, HIGH):
+                ceiling = MAX_PERIOD if priority == LOW else periods[priority + 1]
+                if periods[priority] < ceiling:
+                    periods[priority] *= 2
+                    break
+        elif use < 0.5:
+            for priority in (HIGH, MEDIUM, LOW):
+                floor = 1 if priority == HIGH else periods[priority - 1]
+                if periods[priority] > floor:
+                    periods[priority] //= 2
+                    break
+
+    def send(self, kind, payload):
+        """ Send a frame if the budget allows, returns whether it went. """
+        data = frame(kind, self.sequence, payload)
+        if len(data) > self.tokens or not self.transport.send(data):
+            self.skipped += 1
+            self.window_skipped += 1
+            return False
+        self.tokens -= len(data)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.frames += 1
+        self.bytes += len(data)
+        self.window_bytes += len(data)
+        return True
+
+    def send_events(self):
+        events = self.events
+        while events:
+            kind, payload = events[0]
+            if not self.send(kind, payload):
+                return
+            events.popleft()
+
+    def queue_event(self, kind, msg):
+        if len(self.events) >= EVENT_BACKLOG:
+            self.events.popleft()
+            self.events_dropped += 1
+        message = str(msg).encode()[: MAX_PAYLOAD - EVENT_TIME.size]
+        self.events.append((kind, EVENT_TIME.pack(self.clock()) + message))
+        self.refill()
+        self.send_events()
+
+    def event(self, msg):
+        self.queue_event(EVENT, msg)
+
+    def error(self, msg):
+        self.queue_event(ERROR, msg)
+
+    def publish(self, data_tup):
+        """ Send a COAST data row, or as much of it as is due. """
+        self.refill()
+        if self.events:
+            self.send_events()
+        rows = self.rows
+        self.rows += 1
+        periods = self.periods
+        if rows % periods[HIGH]:
+            return
+
+        try:
+            values = [round(v * s) for v, s in zip(data_tup, self.inverse)]
+        except (ValueError, OverflowError):
+            values = [quantize(v, q) for v, q in zip(data_tup, QUANTA)]
+
+        kind = KEYFRAME
+        if self.since_key < KEY_INTERVAL:
+            due = (not rows % periods[MEDIUM], not rows % periods[LOW])
+            layout = self.layouts.get(due)
+            if layout is None:
+                layout = self.layouts[due] = self.delta_layout(due)
+            mask, fields, packer = layout
+            key = self.key
+            sent = [values[i] - key[i] for i in fields]
+            if max(sent) <= 32767 and min(sent) >= -32768:
+                kind = DELTA
+                key_id = self.key_id
+        if kind == KEYFRAME:
+            mask, sent, packer = ALL_FIELDS, values, self.key_packer
+            key_id = (self.key_id + 1) & 0xFF
+        try:
+            payload = packer.pack(key_id, mask, *sent)
+        except StructError:
+            # Outside int32, only possible in a keyframe
+            values = [quantize(v, q) for v, q in zip(data_tup, QUANTA)]
+            payload = packer.pack(key_id, mask, *values)
+        if not self.send(kind, payload):
+            return
+
+        if kind == KEYFRAME:
+            self.key = values
+            self.key_id = key_id
+            self.since_key = 1
+        else:
+            self.since_key += 1
+
+    def delta_layout(self, due):
+        """ (mask, field indices, Struct) of a delta frame with the HIGH fields
+            and the MEDIUM and LOW ones that are due. """
+        included = (True,) + due
+        fields = [i for i, p in enumerate(PRIORITIES) if included[p]]
+        mask = sum(1 << i for i in fields)
+        return mask, fields, value_format(DELTA, mask)
+
+    def stats(self):
+        return (
+            f"Downlink sent {self.frames:,} frames ({self.bytes:,} bytes), "
+            f"skipped {self.skipped:,}, dropped {self.events_dropped:,} events, "
+            f"field periods {self.periods}"
+        )
+
+    def close(self):
+        self.refill()
+        self.send_events()
+        self.transport.close()
+
+
+# Transports. send(frame) returns False instead of waiting when the link is busy,
+# receive() returns whatever bytes have arrived
+
+
+class LoopbackTransport:
+    """ Keeps frames in memory, for testing without a radio. """
+
+    def __init__(self):
+        self.frames = deque()
+
+    def send(self, data):
+        self.frames.append(data)
+        return True
+
+    def receive(self, timeout=None):
+        data = b"".join(self.frames)
+        self.frames.clear()
+        return data
+
+    def close(self):
+        pass
+
+
+class UDPTransport:
+    """ One datagram per frame. bind=True listens on the address instead. """
+
+    def __init__(self, host, port, bind=False):
+        self.address = (host or ("0.0.0.0" if bind else "127.0.0.1"), port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if bind:
+            self.sock.bind(self.address)
+        else:
+            self.sock.setblocking(False)
+
+    def send(self, data):
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError:
+            return False
+        return True
+
+    def receive(self, timeout=None):
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(65536)
+        except socket.timeout:
+            return b""
+
+    def close(self):
+        self.sock.close()
+
+
+class SerialTransport:
+    """ A serial radio, through pyserial. Writes never block, frames that don't
+        fit in the driver's buffer are skipped. """
+
+    def __init__(self, device, baudrate=9600):
+        # Imported here so only serial links need pyserial installed
+        import serial
+
+        self.serial = serial.Serial(device, baudrate, timeout=0, write_timeout=0)
+        self.timeout_error = serial.SerialTimeoutException
+
+    def send(self, data):
+        try:
+            return self.serial.write(data) == len(data)
+        except self.timeout_error:
+            return False
+
+    def receive(self, timeout=None):
+        self.serial.timeout = timeout
+        return self.serial.read(max(1, self.serial.in_waiting))
+
+    def close(self):
+        self.serial.close()
+
+
+def create_transport(spec, bind=False):
+    """ Transport from "udp:<host>:<port>", "serial:<device>[:<baud>]" or
+        "loopback". """
+    kind, _, rest = spec.partition(":")
+    if kind == "udp":
+        host, _, port = rest.rpartition(":")
+        return UDPTransport(host, int(port), bind)
+    if kind == "serial":
+        device, _, baudrate = rest.partition(":")
+        return SerialTransport(device, int(baudrate or 9600))
+    if kind == "loopback":
+        return LoopbackTransport()
+    raise ValueError(
+        f"Unknown transport '{spec}', expected udp:<host>:<port>, "
+        "serial:<device>[:<baud>] or loopback"
+    )
+
+
+class GroundReceiver:
+    """ Reassembles the stream on the ground. feed() takes bytes as they arrive,
+        in any pieces, and finds the frames in them by their sync bytes and CRC.
+
+        Data rows go to recorder with the last received value of any field the
+        frame didn't carry, and events to event_log, when given. Deltas for a
+        keyframe that was lost can't be applied, so they're dropped until the
+        next keyframe arrives. """
+
+    def __init__(self, recorder=None, event_log=None):
+        self.recorder = recorder
+        self.event_log = event_log
+        self.buffer = bytearray()
+        self.expected = None  # next sequence number
+        self.key = None  # quantized values of the last keyframe
+        self.key_id = None
+        self.values = [0] * len(QUANTA)
+        self.formats = {}
+        self.rows = []
+        self.events = []  # (time, kind, message)
+
+        self.frames = 0
+        self.corrupt = 0
+        self.lost = 0
+        self.unusable = 0  # deltas dropped while waiting for a keyframe
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        while True:
+            start = buffer.find(SYNC)
+            if start < 0:
+                del buffer[: max(0, len(buffer) - 1)]
+                return
+            del buffer[:start]
+            if len(buffer) < HEADER.size:
+                return
+            _, kind, sequence, size = HEADER.unpack_from(buffer)
+            end = HEADER.size + size + CRC.size
+            if len(buffer) < end:
+                return
+            (checksum,) = CRC.unpack_from(buffer, end - CRC.size)
+            if checksum != crc(buffer[2 : end - CRC.size]):
+                # Not a frame after all, or damaged, look for the next sync
+                self.corrupt += 1
+                del buffer[:1]
+                continue
+            payload = bytes(buffer[HEADER.size : end - CRC.size])
+            del buffer[:end]
+            self.receive(kind, sequence, payload)
+
+    def receive(self, kind, sequence, payload):
+        self.frames += 1
+        if self.expected is not None and sequence != self.expected:
+            self.lost += (sequence - self.expected) & 0xFFFF
+        self.expected = (sequence + 1) & 0xFFFF
+
+        if kind in (EVENT, ERROR):
+            (time,) = EVENT_TIME.unpack_from(payload)
+            message = payload[EVENT_TIME.size :].decode(errors="replace")
+            self.events.append((time, kind, message))
+            if self.event_log is not None:
+                label = "EVENT" if kind == EVENT else "ERROR"
+                self.event_log.writeln(
+                    format_message(f"{time:.3f}", label, message).rstrip("\n")
+                )
+            return
+        if kind not in (KEYFRAME, DELTA):
+            return
+
+        key_id, mask = DATA_PREFIX.unpack_from(payload)
+        layout = (kind, mask)
+        unpacker = self.formats.get(layout)
+        if unpacker is None:
+            unpacker = self.formats[layout] = value_format(kind, mask)
+        received = unpacker.unpack(payload)[2:]
+        values = self.values
+        if kind == KEYFRAME:
+            self.key = list(received)
+            self.key_id = key_id
+            values[:] = received
+        elif key_id != self.key_id:
+            self.unusable += 1
+            return
+        else:
+            key = self.key
+            fields = (i for i in range(len(values)) if mask >> i & 1)
+            for i, delta in zip(fields, received):
+                values[i] = key[i] + delta
+
+        row = tuple(
+            float("nan") if q == MISSING else q * quantum
+            for q, quantum in zip(values, QUANTA)
+        )
+        self.rows.append(row)
+        if self.recorder is not None:
+            self.recorder.write_to_table(row)
+
+    def stats(self):
+        return (
+            f"Received {self.frames:,} frames, {len(self.rows):,} rows and "
+            f"{len(self.events):,} events: {self.lost:,} lost, "
+            f"{self.corrupt:,} corrupt, {self.unusable:,} deltas without a keyframe"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Receive the telemetry downlink")
+    parser.add_argument(
+        "link", help="udp:[<host>]:<port> to listen on, or serial:<device>[:<baud>]"
+    )
+    parser.add_argument(
+        "--capacity", type=int, default=2 ** 16, help="data rows to make room for"
+    )
+    args = parser.parse_args()
+
+    transport = create_transport(args.link, bind=True)
+    recorder = TelemetryRecorder("GROUND", control.DATA_HEADERS, args.capacity)
+    event_log = Logger("GROUND-LOG")
+    receiver = GroundReceiver(recorder, event_log)
+    print(f"Listening on {args.link}, Ctrl-C to stop")
+    try:
+        while True:
+            data = transport.receive(timeout=1.0)
+            if data:
+                events = len(receiver.events)
+                receiver.feed(data)
+                for time, kind, message in receiver.events[events:]:
+                    print(f"  {time:>10.3f} s  {message}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
+        recorder.close()
+        event_log.close()
+    print(receiver.stats())
+    print(f"Wrote {convert_to_table(recorder.file_name)} and {event_log.log_file.name}")
@@ -0,0 +1,146 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Linear Kalman filter for the vertical state. Tracks   |
+# |   | |/ _____ \| |   |  altitude, velocity and acceleration, fusing MPL3115A2 |
+# |   | / /_   _\ \ |   |  altitude with BNO055 inertial acceleration. Either    |
+# |  |_____|___|_____|  |  sensor can be fed at its own rate. The matrices are   |
+# |    \___________/    |  only 3x3, so each step is written out element by      |
+# |                     |  element in plain floats instead of NumPy calls.       |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+from array import array
+from struct import Struct
+
+ALTITUDE = 0
+VELOCITY = 1
+ACCELERATION = 2
+MEMORY_SIZE = 12  # the state, then the covariance row by row
+MEMORY = Struct(f"{MEMORY_SIZE}d")  # stores all of it in one call
+
+
+class AltitudeEstimator:
+    """ Constant-acceleration Kalman filter, all units in feet and seconds.
+
+        jerk_noise is the variance of the jerk driving the model, taken as constant
+        over each step, altitude_noise and accel_noise are the measurement
+        variances. The state and its covariance live in memory, MEMORY_SIZE
+        doubles updated in place, such as a slice of a vehicle.FlightState. x
+        and P are views into it, P flattened row by row. Each step unpacks the
+        memory into locals and packs the results back in one call, storing
+        element by element through a memoryview costs twice as much. """
+
+    def __init__(
+        self,
+        altitude=0.0,
+        jerk_noise=1e4,
+        altitude_noise=4.0,
+        accel_noise=0.5,
+        memory=None,
+    ):
+        self.jerk_noise = jerk_noise
+        self.altitude_noise = altitude_noise
+        self.accel_noise = accel_noise
+
+        if memory is None:
+            memory = array("d", bytes(8 * MEMORY_SIZE))
+        memory = self.memory = memoryview(memory)
+        self.x = memory[:3]
+        self.P = memory[3:MEMORY_SIZE]
+        self.x[:] = array("d", (altitude, 0.0, 0.0))
+        self.P[:] = array("d", (altitude_noise, 0, 0, 0, 100.0, 0, 0, 0, 100.0))
+
+    @property
+    def altitude(self):
+        return self.x[ALTITUDE]
+
+    @property
+    def velocity(self):
+        return self.x[VELOCITY]
+
+    @property
+    def acceleration(self):
+        return self.x[ACCELERATION]
+
+    def predict(self, dt):
+        """ Propagate the state forward by dt seconds. """
+        if dt <= 0:
+            return
+        h = 0.5 * dt * dt
+        memory = self.memory
+        x0, x1, x2, p00, p01, p02, p10, p11, p12, p20, p21, p22 = memory
+
+        # P = F P F^T + Q, with F = [[1, dt, h], [0, 1, dt], [0, 0, 1]] and Q from
+        # a constant jerk over the step, q G G^T with G = (dt^3 / 6, h, dt)
+        a0 = p00 + dt * p10 + h * p20
+        a1 = p01 + dt * p11 + h * p21
+        a2 = p02 + dt * p12 + h * p22
+        b0 = p10 + dt * p20
+        b1 = p11 + dt * p21
+        b2 = p12 + dt * p22
+        q = self.jerk_noise
+        g0 = dt * h / 3
+        qg0, qg1, qg2 = q * g0, q * h, q * dt
+        c0 = p20 + dt * p21 + h * p22
+        c1 = p21 + dt * p22
+        MEMORY.pack_into(
+            memory,
+            0,
+            x0 + (x1 * dt + x2 * h),
+            x1 + x2 * dt,
+            x2,
+            a0 + dt * a1 + h * a2 + qg0 * g0,
+            a1 + dt * a2 + qg0 * h,
+            a2 + qg0 * dt,
+            b0 + dt * b1 + h * b2 + qg1 * g0,
+            b1 + dt * b2 + qg1 * h,
+            b2 + qg1 * dt,
+            c0 + qg2 * g0,
+            c1 + qg2 * h,
+            p22 + qg2 * dt,
+        )
+
+    def correct(self, index, measurement, noise):
+        """ Scalar measurement update for a directly observed state. """
+        memory = self.memory
+        x0, x1, x2, p00, p01, p02, p10, p11, p12, p20, p21, p22 = memory
+        # The observed row, the column of the symmetric covariance and the
+        # innovation variance
+        if index == ALTITUDE:
+            r0, r1, r2 = p00, p01, p02
+            c0, c1, c2 = p00, p10, p20
+            innovation, s = measurement - x0, p00 + noise
+        elif index == VELOCITY:
+            r0, r1, r2 = p10, p11, p12
+            c0, c1, c2 = p01, p11, p21
+            innovation, s = measurement - x1, p11 + noise
+        else:
+            r0, r1, r2 = p20, p21, p22
+            c0, c1, c2 = p02, p12, p22
+            innovation, s = measurement - x2, p22 + noise
+        k0, k1, k2 = c0 / s, c1 / s, c2 / s
+        MEMORY.pack_into(
+            memory,
+            0,
+            x0 + k0 * innovation,
+            x1 + k1 * innovation,
+            x2 + k2 * innovation,
+            p00 - k0 * r0,
+            p01 - k0 * r1,
+            p02 - k0 * r2,
+            p10 - k1 * r0,
+            p11 - k1 * r1,
+            p12 - k1 * r2,
+            p20 - k2 * r0,
+            p21 - k2 * r1,
+            p22 - k2 * r2,
+        )
+
+    def update_altitude(self, altitude):
+        """ Fold in a barometric altitude, in feet. """
+        self.correct(ALTITUDE, altitude, self.altitude_noise)
+
+    def update_acceleration(self, accel):
+        """ Fold in a vertical inertial acceleration, in ft/s^2. """
+        self.correct(ACCELERATION, accel, self.accel_noise)
@@ -1,8 +1,12 @@
 # Custom logging utilities, written specifically for this flight code.
 
+import atexit
+import os
 import time
+from collections import deque
 from datetime import datetime
 from random import randint
+from threading import Thread, Event
 
 # why
 LOG_HEADER = """\
@@ -17,6 +21,30 @@ LOG_HEADER = """\
 """
 
 
+def log_file_name(prefix, extension="txt"):
+    """ File name for a log, stamped with the current time """
+    current_time = time.ctime().replace(" ", "-")
+    return f"{prefix}-" + current_time + f".{extension}"
+
+
+def format_message(ctime, kind, msg):
+    """ One event or error line """
+    return f"[ {ctime} ][ {kind} ]\t{msg}\n"
+
+
+def format_table_header(headers):
+    """ Header line for a data table """
+    return "".join(header + "\t\t" for header in headers) + "\n"
+
+
+def format_table_row(headers, data_tup):
+    """ Right-justify each value under its header, one line per row """
+    fields = [
+        f"{data:.3f}".rjust(len(header)) for header, data in zip(headers, data_tup)
+    ]
+    return "\t\t".join(fields) + "\n"
+
+
 class Logger:
     """ Generic data and/or event logging class """
 
@@ -27,15 +55,11 @@ class Logger:
         self.log_file.write(LOG_HEADER)
         if headers is not None:
             self.headers = headers
-            for header in headers:
-                self.log_file.write(header + "\t\t")
-            self.log_file.write("\n")
+            self.log_file.write(format_table_header(headers))
 
     def create_log_file(self, prefix):
         """ Create a file and return the file handle """
-        current_time = time.ctime().replace(" ", "-")
-        file_name = f"{prefix}-" + current_time + ".txt"
-        return open(file_name, "w")
+        return open(log_file_name(prefix), "w")
 
     def time_stamp(self):
         """ Generate a time stamp for logging """
@@ -46,16 +70,12 @@ class Logger:
     def event(self, msg):
         """ Write text to event log """
         if not self.log_file.closed:
-            ctime = self.time_stamp()
-            log_text = f"[ {ctime} ][ EVENT ]\t{msg}\n"
-            self.log_file.write(log_text)
+            self.log_file.write(format_message(self.time_stamp(), "EVENT", msg))
 
     def error(self, msg):
         """ Log an error """
         if not self.log_file.closed:
-            ctime = self.time_stamp()
-            log_text = f"[ {ctime} ][ ERROR ]\t{msg}\n"
-            self.log_file.write(log_text)
+            self.log_file.write(format_message(self.time_stamp(), "ERROR", msg))
 
     def writeln(self, msg):
         """ A simple write to file. """
@@ -65,19 +85,210 @@ class Logger:
 
     def write_to_table(self, data_tup: tuple):
         """ Write right-justified data to file. """
-        for i in range(len(data_tup)):
-            data = f"{data_tup[i]:.3f}"
-            indent = str(" ") * (len(self.headers[i]) - len(data))
-            if i == len(data_tup) - 1:
-                self.log_file.write(indent + data + "\n")
-            else:
-                self.log_file.write(indent + data + "\t\t")
+        self.log_file.write(format_table_row(self.headers, data_tup))
 
     def close(self):
         if not self.log_file.closed:
             self.log_file.close()
 
 
+# Kinds of record a ThreadedLogger queues
+EVENT = 0
+ERROR = 1
+LINE = 2
+ROW = 3
+CLOSE = 4
+
+# What LogWriter does with a record that arrives when the queue is full
+DROP_NEWEST = "newest"
+DROP_OLDEST = "oldest"
+
+
+class LogWriter:
+    """ Writes the records of every ThreadedLogger from one background thread.
+
+        Loggers append records to a bounded queue and return right away. The
+        writer wakes every flush_interval seconds, or sooner once the queue is a
+        quarter full or an error comes in, formats everything waiting and writes
+        it out in one go per file. Files are fsynced after a batch once
+        fsync_interval seconds have passed since the last sync, so 0 syncs every
+        batch and None never does. When the queue is full the overflow policy
+        drops either the new record or the oldest one, and dropped counts them. """
+
+    def __init__(
+        self,
+        capacity=4096,
+        flush_interval=0.05,
+        fsync_interval=0.0,
+        overflow=DROP_NEWEST,
+    ):
+        if overflow not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError(f"unknown overflow policy {overflow!r}")
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.overflow = overflow
+        self.wake_size = max(1, capacity // 4)
+
+        # deque appends and pops are atomic, so producers never take a lock
+        self.queue = deque()
+        self.dropped = 0
+        self.batches = 0
+        self.written = 0
+
+        # Records are stamped with monotonic time, turned into wall time here
+        self.offset = time.time() - time.monotonic()
+        self.last_sync = time.monotonic()
+        self.wake = Event()
+        self.running = False
+        self.thread = None
+
+    def put(self, record):
+        """ Queue a record, called from any thread. """
+        queue = self.queue
+        if len(queue) >= self.capacity:
+            self.dropped += 1
+            if self.overflow == DROP_NEWEST:
+                return
+            try:
+                oldest = queue.popleft()
+            except IndexError:
+                oldest = None  # the writer emptied it in the meantime
+            if oldest is not None and oldest[1] == CLOSE:
+                queue.appendleft(oldest)  # someone is waiting on that one
+                return
+        queue.append(record)
+        if len(queue) >= self.wake_size or record[1] == ERROR:
+            self.wake.set()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = Thread(target=self.run, name="log writer", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """ Stop the thread once everything queued so far is written. """
+        if self.running:
+            self.running = False
+            self.wake.set()
+            self.thread.join()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.write_batch()
+        self.write_batch()
+
+    def close_log(self, logger):
+        """ Write everything queued for logger, then close its file. Waits until
+            that's done. Close records skip the capacity check. """
+        done = Event()
+        self.queue.append((logger, CLOSE, 0, done))
+        if self.running:
+            self.wake.set()
+            done.wait()
+        else:
+            self.write_batch()
+
+    def write_batch(self):
+        """ Write out everything in the queue. Runs on the writer thread, or the
+            caller's once the thread has stopped. """
+        queue = self.queue
+        pending = {}  # logger -> formatted text in order
+        closing = []
+        stamps = {}  # second -> formatted clock time, stamps mostly repeat
+        for _ in range(len(queue)):
+            logger, kind, stamp, payload = queue.popleft()
+            if kind == CLOSE:
+                closing.append((logger, payload))
+                continue
+            parts = pending.setdefault(logger, [])
+            if kind == ROW:
+                parts.append(format_table_row(logger.headers, payload))
+            elif kind == LINE:
+                parts.append(f"{payload}\n")
+            else:
+                second = int(stamp + self.offset)
+                ctime = stamps.get(second)
+                if ctime is None:
+                    ctime = datetime.fromtimestamp(second).strftime("%H:%M:%S")
+                    stamps[second] = ctime
+                kind = "EVENT" if kind == EVENT else "ERROR"
+                parts.append(format_message(ctime, kind, payload))
+        if not pending and not closing:
+            return
+
+        for logger, parts in pending.items():
+            if not logger.log_file.closed:
+                logger.log_file.write("".join(parts))
+                logger.log_file.flush()
+            self.written += len(parts)
+        self.batches += 1
+
+        now = time.monotonic()
+        if self.fsync_interval is not None and (
+            closing or now - self.last_sync >= self.fsync_interval
+        ):
+            for logger in pending:
+                if not logger.log_file.closed:
+                    os.fsync(logger.log_file.fileno())
+            self.last_sync = now
+        for logger, done in closing:
+            if not logger.log_file.closed:
+                logger.log_file.flush()
+                if self.fsync_interval is not None:
+                    os.fsync(logger.log_file.fileno())
+                logger.log_file.close()
+            done.set()
+
+
+# Shared by every ThreadedLogger that isn't given a writer of its own
+WRITER = None
+
+
+def shared_writer():
+    global WRITER
+    if WRITER is None:
+        WRITER = LogWriter()
+        atexit.register(WRITER.stop)
+    return WRITER
+
+
+class ThreadedLogger(Logger):
+    """ Logger whose writes are queued with a monotonic time stamp and done by a
+        LogWriter thread, so logging never waits on the file. close() returns
+        once everything logged before it is on disk. """
+
+    def __init__(self, prefix, headers=None, writer=None):
+        super().__init__(prefix, headers)
+        self.writer = writer if writer is not None else shared_writer()
+        self.closed = False
+        self.writer.start()
+
+    def event(self, msg):
+        if not self.closed:
+            self.writer.put((self, EVENT, time.monotonic(), msg))
+
+    def error(self, msg):
+        if not self.closed:
+            self.writer.put((self, ERROR, time.monotonic(), msg))
+
+    def writeln(self, msg):
+        if not self.closed:
+            self.writer.put((self, LINE, 0, msg))
+
+    def write_to_table(self, data_tup: tuple):
+        if not self.closed:
+            self.writer.put((self, ROW, 0, data_tup))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close_log(self)
+
+
 # This is for testing
 if __name__ == "__main__":
     alt = 400
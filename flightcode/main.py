@@ -49,161 +49,388 @@
 #                End
 
 
-from logger import Logger
-from pid import PID
+import boot
+
+# Startup is timed from here, the report goes in the log once the flight is armed
+boot_timer = boot.BootTimer()
+
+from logger import Logger, ThreadedLogger
+from telemetry import SYNC_ROWS, TelemetryRecorder
 import vehicle as vehicle
-from time import monotonic, sleep
-import board
-import busio
+import control
+from backend import BACKENDS, create_backend
+from sampler import (
+    Sampler,
+    ThreadedSampler,
+    BurstSampler,
+    ThreadedBurstSampler,
+    CaptureSampler,
+    CAPTURE_HEADERS,
+)
+from scheduler import LoopScheduler
+import profiler as prof
+from actuator import ServoStage, ThreadedServoStage
+from time import perf_counter
+import argparse
+import sys
 
 
-TARGET_ALT = 10000  # altitude to reach from ground
-TIME_SINCE_LAUNCH = 0  # used for data logging during coast mode
 DELTA_T = 0
+DATA_CAPACITY = 2 ** 16  # rows preallocated in the data log
+CAPTURE_CAPACITY = 2 ** 18  # snapshots kept by --capture, about 40 min at 100 Hz
+
+# Drag plate servo output
+SERVO_CHANNELS = (0, 1)  # PCA9685 channels the plate servos are wired to
+SERVO_DEADBAND = 0.5  # degrees, smaller changes aren't written
+SERVO_MAX_SLEW = 600  # degrees per second
+SERVO_MIN_INTERVAL = 0.02  # seconds, the servos only see a new pulse every 20 ms
+
+
+# Pick between the real sensors and the simulated flight, e.g.
+#   python main.py --backend sim
+parser = argparse.ArgumentParser(description="Altitude control flight code")
+parser.add_argument("--backend", choices=list(BACKENDS), default="hardware")
+parser.add_argument(
+    "--threaded-sampling",
+    action="store_true",
+    help="read the sensors on a background thread (hardware backend only)",
+)
+parser.add_argument(
+    "--burst",
+    action="store_true",
+    help="read the BNO055 in one burst and poll the MPL3115A2 instead of waiting",
+)
+parser.add_argument(
+    "--target",
+    type=float,
+    default=control.TARGET_ALT,
+    help="altitude to reach above the pad, in feet",
+)
+parser.add_argument("--rate", type=float, default=100, help="control loop rate in Hz")
+parser.add_argument(
+    "--baro-every",
+    type=int,
+    default=1,
+    help="read the altimeter every N control cycles, the estimator fills in between",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="time each stage of the loop and write a PROFILE log at DESCENT",
+)
+parser.add_argument(
+    "--apogee-surface",
+    help="predict apogee from a surface built by sim/surface.py instead of the "
+    "closed form projected_altitude",
+)
+parser.add_argument(
+    "--capture",
+    action="store_true",
+    help="record every sensor snapshot to a RAW file for replay.py",
+)
+parser.add_argument(
+    "--downlink",
+    help="send live telemetry over udp:<host>:<port>, serial:<device>[:<baud>] "
+    "or loopback, receive it with downlink.py",
+)
+parser.add_argument(
+    "--downlink-rate",
+    type=float,
+    help="link budget for --downlink in bytes per second, 1200 by default",
+)
+parser.add_argument(
+    "--processes",
+    action="store_true",
+    help="run acquisition, control and logging as separate processes",
+)
+parser.add_argument(
+    "--calibration",
+    help="calibration cache to warm start from and update, calibration.json next "
+    "to the code by default on the hardware backend",
+)
+parser.add_argument(
+    "--cold",
+    action="store_true",
+    help="ignore the calibration cache, it's still updated",
+)
+parser.add_argument(
+    "--threaded-servos",
+    action="store_true",
+    help="write the servos from a background thread (hardware backend only)",
+)
+args = parser.parse_args()
+if args.threaded_sampling and args.backend != "hardware":
+    parser.error("--threaded-sampling needs the hardware backend")
+if args.threaded_servos and args.backend != "hardware":
+    parser.error("--threaded-servos needs the hardware backend")
+if args.processes and (args.threaded_sampling or args.threaded_servos or args.profile):
+    parser.error("--processes can't be combined with threading or --profile")
+if args.calibration is None and args.backend == "hardware":
+    args.calibration = boot.CALIBRATION
+
+# Multi-process flight, see processes.py. Everything below is the single process one
+if args.processes:
+    import processes
+
+    servo_config = dict(
+        channels=SERVO_CHANNELS,
+        deadband=SERVO_DEADBAND,
+        max_slew=SERVO_MAX_SLEW,
+        min_interval=SERVO_MIN_INTERVAL,
+    )
+    sys.exit(processes.run(args, servo_config, DATA_CAPACITY))
+backend = create_backend(args.backend)
+clock = backend.clock
+boot_timer.lap("imports")
 
 
-# Mode of operation and flight readiness flags
+# Flight readiness flag, the mode of operation is kept by the controller
 STATUS = vehicle.FlightStatus.GO
-MODE = vehicle.Runmode.STANDBY
 
 
 # SENSOR AND LOG INITIALIZATION
 
-# Opening up flight log, so we can see what happened during the flight
-event_log = Logger("LOG")
-
-# Data log
-data_log = Logger(
-    "DATA",
-    headers=(
-        "Time (seconds)",
-        "Acceleration (x)",
-        "Acceleration (y)",
-        "Acceleration (z)",
-        "Velocity (x)",
-        "Velocity (y)",
-        "Velocity (z)",
-        "Position (x)",
-        "Position (y)",
-        "Altitude (z)",
-        "PID Controller Output",
-        "Projected Altitude",
-    ),
-)
+# Opening up flight log, so we can see what happened during the flight. Events are
+# queued and written by a background thread, so logging never holds up the loop
+event_log = ThreadedLogger("LOG")
+
+# The sensors come up in the background while the rest of the files are opened
 event_log.event("Initializing connection to sensors")
+connecting = boot_timer.background("connect", backend.connect, event_log)
 
-# Create I2C object
-try:
-    i2c = busio.I2C(board.SCL, board.SDA)
-    event_log.event("i2c object created succesfully")
-except RuntimeError:
-    event_log.error("Failed to create an i2c object")
-    STATUS = vehicle.FlightStatus.NOGO
-
-# Create connection to BNO055 accelerometer
-try:
-    bno = vehicle.bno055.BNO055(i2c)
-    event_log.event("Connection to BNO055 successful")
-except (RuntimeError, OSError, ValueError):
-    event_log.error("Failed to connect to BNO055")
-    STATUS = vehicle.FlightStatus.NOGO
-
-# Create connection to MPL3115a2 altimeter
-try:
-    mpl = vehicle.mpl3115a2.MPL3115A2(i2c)
-    event_log.event("Connection to MPL3115 successful")
-except (RuntimeError, OSError, ValueError):
-    event_log.error("Failed to connect to MPL3115")
-    STATUS = vehicle.FlightStatus.NOGO
-
-# Create a connection to servos
-try:
-    servos = vehicle.ServoKit(channels=16, i2c=i2c)
-except (RuntimeError, OSError, ValueError):
-    event_log.error("Failed to connect to servos")
-    STATUS = vehicle.FlightStatus.NOGO
+# Data log, converted to a text table after the flight with telemetry.py
+data_log = TelemetryRecorder(
+    "DATA", control.DATA_HEADERS, DATA_CAPACITY, sync_every=SYNC_ROWS
+)
+
+# Raw sensor snapshots, replayed through the control code by replay.py
+capture_log = None
+if args.capture:
+    capture_log = TelemetryRecorder("RAW", CAPTURE_HEADERS, CAPTURE_CAPACITY)
+
+# Live telemetry, sent in the time left over each cycle
+downlink = None
+if args.downlink:
+    from downlink import Downlink, create_transport, BANDWIDTH
+
+    try:
+        transport = create_transport(args.downlink)
+        downlink = Downlink(transport, args.downlink_rate or BANDWIDTH, clock)
+        event_log.event(f"Sending telemetry to {args.downlink}")
+    except (ImportError, OSError, ValueError) as e:
+        event_log.error(f"Failed to open downlink {args.downlink}: {e}")
+
+# Drag-aware apogee prediction, if a surface was given
+apogee_predictor = None
+if args.apogee_surface:
+    from predictor import ApogeePredictor
+
+    apogee_predictor = ApogeePredictor(args.apogee_surface)
+    event_log.event(f"Predicting apogee from {args.apogee_surface}")
+
+# What the last run left to warm start from
+calibration = None
+if args.calibration and not args.cold:
+    calibration = boot.load_calibration(args.calibration, backend.name)
+    if calibration is not None:
+        event_log.event(f"Warm starting from {args.calibration}")
+boot_timer.lap("files")
+
+
+def save_calibration(pad_altitude):
+    """ Update the calibration cache. The last IMU offsets are kept until the
+        BNO055 reports being calibrated again. """
+    values = {"pad_altitude": pad_altitude}
+    imu = backend.calibration() or (calibration or {}).get("imu")
+    if imu is not None:
+        values["imu"] = imu
+    try:
+        boot.save_calibration(args.calibration, backend.name, **values)
+    except OSError as e:
+        event_log.error(f"Failed to save calibration to {args.calibration}: {e}")
+
+
+STATUS = connecting.result()
+if STATUS is vehicle.FlightStatus.GO and calibration and "imu" in calibration:
+    backend.restore_calibration(calibration["imu"], event_log)
+if args.burst and STATUS is vehicle.FlightStatus.GO:
+    STATUS = backend.use_burst_reads(event_log)
+boot_timer.lap("sensors")
+bno = backend.bno
+mpl = backend.mpl
+servos = backend.servos
+if args.burst:
+    SamplerType = ThreadedBurstSampler if args.threaded_sampling else BurstSampler
+else:
+    SamplerType = ThreadedSampler if args.threaded_sampling else Sampler
+sampler = SamplerType(bno, mpl, clock, args.baro_every)
+if capture_log is not None:
+    sampler = CaptureSampler(sampler, capture_log)
 
 
 # MAIN EVENT LOOP
 if STATUS is vehicle.FlightStatus.GO:
-    DELTA_T = monotonic()
+    sampler.start()
+    ServoStageType = ThreadedServoStage if args.threaded_servos else ServoStage
+    servo_stage = ServoStageType(
+        servos,
+        SERVO_CHANNELS,
+        deadband=SERVO_DEADBAND,
+        max_slew=SERVO_MAX_SLEW,
+        min_interval=SERVO_MIN_INTERVAL,
+        clock=clock,
+    )
+    servo_stage.start()
     event_log.event("Reading current altitude")
-    init_alt = vehicle.init_current_altitude(mpl)
-    threshold_alt = init_alt + 100  # altitude at which to switch to launch mode
-    target = init_alt + TARGET_ALT
+    expected = calibration.get("pad_altitude") if calibration else None
+    init_alt, readings = vehicle.init_current_altitude(
+        sampler, clock, expected=expected
+    )
+    boot_timer.lap("pad altitude")
+    target = init_alt + args.target
     event_log.event(
-        f"Altitude initialized to {init_alt:,}, setting target to {target:,}"
+        f"Altitude initialized to {init_alt:,} from {readings} readings, "
+        f"setting target to {target:,}"
+    )
+
+    # Written on the side, a loop that overruns has no slack to write it in
+    if args.calibration:
+        boot.Background("save calibration", save_calibration, init_alt).start()
+
+    # Runs the loop at a fixed rate, logging happens in the time left over
+    scheduler = LoopScheduler(args.rate, clock, backend.sleep)
+
+    # Per stage timing of the loop, only recorded with --profile
+    profiler = prof.StageProfiler() if args.profile else prof.NullProfiler()
+
+    # Flight events go down the link as well as into the log
+    notify = event_log.event
+    if downlink is not None:
+
+        def notify(msg):
+            event_log.event(msg)
+            downlink.event(msg)
+
+    # Estimator, flight event detectors and PID, fed one snapshot per loop
+    controller = control.FlightController(
+        init_alt,
+        target,
+        predictor=apogee_predictor,
+        command=servo_stage.command,
+        notify=notify,
+        profiler=profiler,
     )
+    boot_timer.lap("arming")
+    boot_report = boot_timer.report()
+    event_log.event(boot_report)
     event_log.event("Standing by for launch...")
 
-    # Create a PID controller object
-    pid = PID(0.1, 0.05, 0.001, target, min_output=0, max_output=180)
+    # One deferred task per DATA row, so the backlog of rows waiting to be logged
+    # stays well inside the rows the flight state keeps intact
+    record = data_log.write_to_table
+    if downlink is not None:
+
+        def record(data_tup):
+            data_log.write_to_table(data_tup)
+            downlink.publish(data_tup)
+
+    # Loop rate bookkeeping, both in flight time and in wall time
+    loop_count = 0
+    loop_start = clock()
+    wall_start = perf_counter()
 
     # Main event loop
     while True:
         # Time elapsed since last loop
-        DELTA_T = monotonic() - DELTA_T
-
-        # Waiting for launch on the launhpad
-        if MODE is vehicle.Runmode.STANDBY:
-            if vehicle.altitude(mpl) > init_alt:
-                if vehicle.verify_launch(mpl, threshold_alt):
-                    MODE = vehicle.Runmode.LAUNCH
-                    event_log.event("Switching to LAUNCH mode")
-            pass
-
-        # Waiting for motor to burn out
-        elif MODE is vehicle.Runmode.LAUNCH:
-            if vehicle.inertial_acceleration(bno)[2] < 0:
-                MODE = vehicle.Runmode.COAST
-                event_log.event("Entering drag mode (COAST)")
-                TIME_SINCE_LAUNCH = monotonic()  # start coast counter
-                vehicle.ALTITUDE = mpl.altitude
-
-        # Deploy drag plates and log data
-        elif MODE is vehicle.Runmode.COAST:
-            acceleration = vehicle.inertial_acceleration(bno)
-            velocity = vehicle.velocity(mpl, acceleration, DELTA_T)
-            position = vehicle.position(velocity, DELTA_T)
-            p_alt = vehicle.projected_altitude(
-                acceleration[2], velocity[2], mpl.altitude
-            )
-            angle = pid.output(p_alt, DELTA_T)
-            vehicle.move_servos(servos, angle)
-            data_tup = (
-                monotonic() - TIME_SINCE_LAUNCH,
-                acceleration[0],
-                acceleration[1],
-                acceleration[2],
-                velocity[0],
-                velocity[1],
-                velocity[2],
-                position[0],
-                position[1],
-                vehicle.altitude(mpl),
-                angle,
-                p_alt,
-            )
-            if vehicle.vertical_velocity(mpl, DELTA_T) < 0:
-                if vehicle.verify_apogee(mpl, DELTA_T):
-                    MODE = vehicle.Runmode.DESCENT
-                    event_log.event(f"Reached apogee: {mpl.altitude:,} feet")
-                    event_log.event("Switching to DESCENT mode")
+        DELTA_T = scheduler.tick()
+        loop_count += 1
+
+        # One reading of every sensor for this cycle
+        mark = profiler.mark()
+        snapshot = sampler.sample()
+        profiler.lap(prof.SAMPLE, mark)
+
+        # Standby, launch and coast, with data logged during the coast
+        if controller.mode is not vehicle.Runmode.DESCENT:
+            data_tup = controller.step(snapshot, DELTA_T)
+            if data_tup is not None:
+                scheduler.defer(profiler.timed, prof.LOGGING, record, data_tup)
 
         # Retract plates and close everything down
-        elif MODE is vehicle.Runmode.DESCENT:
-            event_log.event("Closing data log")
-            data_log.close()
-            # Retract plates
-            vehicle.move_servos(servos, 0)
+        else:
+            loop_time = clock() - loop_start
+            wall_time = perf_counter() - wall_start
+            # Plates first, nothing below may hold them out or keep them from
+            # retracting if it fails
+            servo_stage.stop()
+            servo_stage.force(0)
             event_log.event("Retracting plates")
-            sleep(3)  # give the servos some time to retract
-            event_log.event("Flight complete, exiting program")
-            event_log.close()
+            try:
+                loop_report = (
+                    f"Control loop ran {loop_count:,} times over {loop_time:.2f} s "
+                    f"({loop_count / loop_time:,.1f} Hz), "
+                    f"{wall_time:.2f} s wall time ({loop_count / wall_time:,.1f} Hz)"
+                )
+                scheduler.drain()
+                event_log.event(loop_report)
+                timing = scheduler.stats()
+                timing_report = (
+                    f"Scheduled at {timing['rate']:,.0f} Hz: {timing['overruns']:,} "
+                    f"overruns in {timing['ticks']:,} ticks, start jitter "
+                    f"p50 {timing['jitter_p50'] * 1000:.3f} ms, "
+                    f"p99 {timing['jitter_p99'] * 1000:.3f} ms, "
+                    f"max {timing['jitter_max'] * 1000:.3f} ms"
+                )
+                event_log.event(timing_report)
+                sampler.stop()
+                if args.profile:
+                    event_log.event("Writing loop profile")
+                    profile_log = Logger("PROFILE")
+                    profiler.write_report(profile_log)
+                    profile_log.close()
+                event_log.event("Closing data log")
+                if data_log.dropped:
+                    event_log.error(
+                        f"Data log full, dropped {data_log.dropped:,} rows"
+                    )
+                data_log.close()
+                if capture_log is not None:
+                    if capture_log.dropped:
+                        event_log.error(
+                            f"Capture full, dropped {capture_log.dropped:,} snapshots"
+                        )
+                    capture_log.close()
+                if downlink is not None:
+                    event_log.event(downlink.stats())
+                    downlink.close()
+                # The BNO055 has usually finished calibrating by now
+                if args.calibration and backend.calibration() is not None:
+                    save_calibration(init_alt)
+                event_log.event(
+                    f"Servo stage wrote {servo_stage.writes:,} times, "
+                    f"skipped {servo_stage.skipped:,} commands"
+                )
+            finally:
+                backend.sleep(3)  # give the servos some time to retract
+                event_log.event("Flight complete, exiting program")
+                if event_log.writer.dropped:
+                    event_log.error(
+                        f"Log queue full, dropped {event_log.writer.dropped:,} records"
+                    )
+                event_log.close()
+            if backend.name == "sim":
+                print(boot_report)
+                print(loop_report)
+                print(timing_report)
+                apogee = backend.pad_altitude + backend.apogee
+                print(f"Simulated apogee: {apogee:,.1f} feet")
+                print(backend.integration_report())
             break
 
 elif STATUS is vehicle.FlightStatus.NOGO:
     event_log.event("Errors occurred, flight is a no go, closing files and exiting")
     event_log.close()
     data_log.close()
+    if capture_log is not None:
+        capture_log.close()
 
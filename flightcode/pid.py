@@ -10,45 +10,67 @@
 # |                     |                                                        |
 # +------------------------------------------------------------------------------+
 
+MEMORY_SIZE = 3  # last error, integral and output
+
 
 class PID:
     """ PID takes in gains and an initial setpoint. """
 
-    def __init__(self, KP, KI, KD, setpoint, min_output=None, max_output=None):
-        """ Initialize gains and other important variables. """
+    def __init__(
+        self, KP, KI, KD, setpoint, min_output=None, max_output=None, memory=None
+    ):
+        """ Initialize gains and other important variables. What carries over
+            between outputs is kept in memory, a sequence of MEMORY_SIZE values
+            updated in place, like a slice of a vehicle.FlightState. It's a list
+            of its own unless one is handed in. """
         self.KP = KP
         self.KI = KI
         self.KD = KD
 
         self.setpoint = setpoint
-        self.P0 = 0
-        self.I0 = 0
+        if memory is None:
+            memory = [0] * MEMORY_SIZE
+        memory[0] = memory[1] = memory[2] = 0
+        self.memory = memory
 
-        self.output_val = 0
         self.max_output = max_output
         self.min_output = min_output
 
+    @property
+    def P0(self):
+        return self.memory[0]
+
+    @property
+    def I0(self):
+        return self.memory[1]
+
+    @property
+    def output_val(self):
+        return self.memory[2]
+
     def output(self, input_val, time_diff):
         """ Output a value, given a time step. """
+        memory = self.memory
         P = input_val - self.setpoint
-        I = self.I0 + (P * time_diff)
-        D = (P - self.P0) / 2
+        I = memory[1] + (P * time_diff)
+        D = (P - memory[0]) / 2
 
         diff_output = (self.KP * P) + (self.KI * I) * (self.KD * D)
-        self.P0 = P
-        self.I0 = I
+        memory[0] = P
+        memory[1] = I
 
-        self.output_val += diff_output
+        output_val = memory[2] = self.clamp(memory[2] + diff_output)
+        return output_val
 
-        # If PID instance has values for max and min output, clamp the output
+    def clamp(self, value):
+        """ If PID instance has values for max and min output, clamp the output. """
         if self.max_output is not None:
-            if self.output_val > self.max_output:
-                self.output_val = self.max_output
+            if value > self.max_output:
+                value = self.max_output
         if self.min_output is not None:
-            if self.output_val < self.min_output:
-                self.output_val = self.min_output
-
-        return self.output_val
+            if value < self.min_output:
+                value = self.min_output
+        return value
 
     def __str__(self):
         return f"""\
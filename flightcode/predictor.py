@@ -0,0 +1,83 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Drag-aware apogee prediction. Looks up how much       |
+# |   | |/ _____ \| |   |  higher the vehicle will coast in a surface made ahead |
+# |   | / /_   _\ \ |   |  of time by sim/surface.py, over altitude, vertical    |
+# |  |_____|___|_____|  |  velocity and plate angle, with trilinear              |
+# |    \___________/    |  interpolation in constant time.                       |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import json
+
+import numpy as np
+
+AXES = ("altitude", "velocity", "angle")
+
+
+def surface_files(path):
+    """ The .npy surface and its .json axes description, from either name. """
+    stem = path[: -len(".npy")] if path.endswith(".npy") else path
+    stem = stem[: -len(".json")] if stem.endswith(".json") else stem
+    return stem + ".npy", stem + ".json"
+
+
+class ApogeePredictor:
+    """ Predicted apogee from altitude (ft), vertical velocity (ft/s) and plate
+        angle (degrees), assuming the plates hold their angle the rest of the way.
+        Points off the surface are clamped to its edges. """
+
+    def __init__(self, path):
+        surface_file, axes_file = surface_files(path)
+        with open(axes_file) as f:
+            self.axes = json.load(f)
+        # Memory mapped and read through a flat memoryview, which hands back plain
+        # floats without going through NumPy scalars. Nothing is copied, so only
+        # the pages a flight touches are ever read from the card.
+        self.surface = np.require(
+            np.load(surface_file, mmap_mode="r"), np.float64, "C"
+        )
+        self.gains = memoryview(self.surface.reshape(-1))
+
+        self.starts = []
+        self.inv_steps = []
+        self.lasts = []
+        for name in AXES:
+            axis = self.axes[name]
+            self.starts.append(axis["start"])
+            self.inv_steps.append(1 / axis["step"])
+            self.lasts.append(axis["count"] - 1)
+        _, velocities, angles = self.surface.shape
+        self.strides = (velocities * angles, angles, 1)
+
+    def locate(self, axis, value):
+        """ Cell index and fraction along one axis, clamped to the surface. """
+        pos = (value - self.starts[axis]) * self.inv_steps[axis]
+        last = self.lasts[axis]
+        if pos <= 0:
+            return 0, 0.0
+        if pos >= last:
+            return last - 1, 1.0
+        i = int(pos)
+        return i, pos - i
+
+    def predict(self, alt, veloc, angle):
+        """ Predicted apogee in feet. """
+        if veloc <= 0:
+            return alt
+        i, fi = self.locate(0, alt)
+        j, fj = self.locate(1, veloc)
+        k, fk = self.locate(2, angle)
+        si, sj, _ = self.strides
+        g = self.gains
+        base = i * si + j * sj + k
+
+        # Interpolate along angle, then velocity, then altitude
+        c00 = g[base] + (g[base + 1] - g[base]) * fk
+        c01 = g[base + sj] + (g[base + sj + 1] - g[base + sj]) * fk
+        c10 = g[base + si] + (g[base + si + 1] - g[base + si]) * fk
+        c11 = g[base + si + sj] + (g[base + si + sj + 1] - g[base + si + sj]) * fk
+        c0 = c00 + (c01 - c00) * fj
+        c1 = c10 + (c11 - c10) * fj
+        return alt + c0 + (c1 - c0) * fi
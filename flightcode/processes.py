@@ -0,0 +1,392 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Multi-process flight (main.py --processes). Sensor    |
+# |   | |/ _____ \| |   |  acquisition and the servos, estimation and control,   |
+# |   | / /_   _\ \ |   |  and logging each get a process and a core, and pass   |
+# |  |_____|___|_____|  |  records through statebus rings. The acquisition side  |
+# |    \___________/    |  watches the control process and retracts the plates  |
+# |                     |  itself if it stalls.                                  |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import multiprocessing
+import os
+from time import monotonic, perf_counter, sleep
+
+import boot
+import vehicle
+import control
+from backend import create_backend
+from logger import Logger
+from sampler import Sampler, BurstSampler, CaptureSampler, CAPTURE_HEADERS
+from scheduler import LoopScheduler
+from actuator import ServoStage
+from statebus import (
+    StateRing,
+    EventChannel,
+    RingSampler,
+    float_fields,
+    EVENT,
+    EVENT_FIELDS,
+)
+from telemetry import SYNC_ROWS, TelemetryRecorder
+
+RING_CAPACITY = 4096
+CAPTURE_CAPACITY = 2 ** 18  # snapshots kept by --capture, about 40 min at 100 Hz
+WATCHDOG_TIMEOUT = 0.25  # seconds without a control cycle before retracting
+STARTUP_TIMEOUT = 10  # seconds the control process gets to start up
+LOG_INTERVAL = 0.01  # seconds between the logging process's passes
+
+# One record per control cycle: the snapshot it used, the mode after it, the plate
+# angle to command and, during COAST, the DATA row to log
+CONTROL_HEADERS = ("Snapshot", "Mode", "Plate angle", "Logged")
+CONTROL_HEADERS += control.DATA_HEADERS
+BLANK_ROW = (0.0,) * len(control.DATA_HEADERS)
+
+
+def create_rings():
+    prefix = f"aiat-{os.getpid()}"
+    layouts = {
+        "snapshots": float_fields(CAPTURE_HEADERS),
+        "control": float_fields(CONTROL_HEADERS),
+        "acquisition events": EVENT_FIELDS,
+        "control events": EVENT_FIELDS,
+    }
+    return {
+        role: StateRing(
+            f"{prefix}-{role.replace(' ', '-')}", fields, RING_CAPACITY, create=True
+        )
+        for role, fields in layouts.items()
+    }
+
+
+def attach(specs, *roles):
+    return [StateRing(*specs[role]) for role in roles]
+
+
+def load_calibration(args):
+    if not args.calibration or args.cold:
+        return None
+    return boot.load_calibration(args.calibration, args.backend)
+
+
+def save_imu_calibration(args, backend, events):
+    """ Add the BNO055's offsets to the cache once it reports being calibrated.
+        Only the acquisition process talks to it, so this runs there and keeps
+        the pad altitude the control process saved. """
+    imu = backend.calibration()
+    if not args.calibration or imu is None:
+        return
+    cached = boot.load_calibration(args.calibration, args.backend) or {}
+    values = {
+        name: value
+        for name, value in cached.items()
+        if name not in ("backend", "saved")
+    }
+    values["imu"] = imu
+    try:
+        boot.save_calibration(args.calibration, args.backend, **values)
+    except OSError as e:
+        events.error(f"Failed to save calibration to {args.calibration}: {e}")
+
+
+def acquisition(args, servo_config, specs, stop):
+    """ Reads the sensors at the loop rate, publishes each snapshot and moves the
+        servos to the control process's latest command. With the simulated
+        backend it waits for each snapshot to be used, so the simulated clock
+        stays in step with control. """
+    snapshots, commands, event_ring = attach(
+        specs, "snapshots", "control", "acquisition events"
+    )
+    events = EventChannel(event_ring)
+    backend = create_backend(args.backend)
+    clock = backend.clock
+    events.event("Initializing connection to sensors")
+    if backend.connect(events) is not vehicle.FlightStatus.GO:
+        events.event("Errors occurred, flight is a no go, closing files and exiting")
+        raise SystemExit(1)
+    calibration = load_calibration(args)
+    if calibration is not None and "imu" in calibration:
+        backend.restore_calibration(calibration["imu"], events)
+    if args.burst and backend.use_burst_reads(events) is not vehicle.FlightStatus.GO:
+        events.event("Errors occurred, flight is a no go, closing files and exiting")
+        raise SystemExit(1)
+
+    SamplerType = BurstSampler if args.burst else Sampler
+    sampler = SamplerType(backend.bno, backend.mpl, clock, args.baro_every)
+    capture_log = None
+    if args.capture:
+        capture_log = TelemetryRecorder("RAW", CAPTURE_HEADERS, CAPTURE_CAPACITY)
+        sampler = CaptureSampler(sampler, capture_log)
+    servo_stage = ServoStage(backend.servos, clock=clock, **servo_config)
+    scheduler = LoopScheduler(args.rate, clock, backend.sleep)
+    lockstep = backend.name == "sim"
+
+    # Control heartbeat, the last snapshot it acknowledged and when that changed
+    acknowledged = 0
+    heartbeat = monotonic()
+    timeout = STARTUP_TIMEOUT
+    command_sequence = 0
+    retracted = False
+
+    loop_count = 0
+    loop_start = clock()
+    wall_start = perf_counter()
+    while not stop.is_set():
+        scheduler.tick()
+        loop_count += 1
+        snapshot = sampler.sample()
+        sequence = snapshots.publish(
+            (
+                snapshot.time,
+                *snapshot.acceleration,
+                *snapshot.quaternion,
+                snapshot.altitude,
+                snapshot.altitude_fresh,
+            )
+        )
+        if lockstep:
+            snapshots.wait_acknowledged(sequence, timeout, stop=stop)
+        if stop.is_set():
+            break
+        if snapshots.acknowledged != acknowledged:
+            acknowledged = snapshots.acknowledged
+            heartbeat = monotonic()
+            timeout = WATCHDOG_TIMEOUT
+        stalled = monotonic() - heartbeat > timeout
+
+        # Watchdog, control hasn't asked for a snapshot in too long
+        if stalled:
+            vehicle.move_servos(backend.servos, 0)
+            retracted = True
+            events.error(
+                f"Control process stalled for {monotonic() - heartbeat:.3f} s, "
+                "retracting plates"
+            )
+            break
+
+        latest, record = commands.latest()
+        if latest != command_sequence:
+            command_sequence = latest
+            mode = vehicle.Runmode(int(record[1]))
+            if mode is vehicle.Runmode.COAST:
+                servo_stage.command(record[2])
+            elif mode is vehicle.Runmode.DESCENT:
+                break
+
+    loop_time = clock() - loop_start
+    wall_time = perf_counter() - wall_start
+    loop_report = (
+        f"Acquisition loop ran {loop_count:,} times over {loop_time:.2f} s "
+        f"({loop_count / loop_time:,.1f} Hz), "
+        f"{wall_time:.2f} s wall time ({loop_count / wall_time:,.1f} Hz)"
+    )
+    events.event(loop_report)
+    timing = scheduler.stats()
+    events.event(
+        f"Scheduled at {timing['rate']:,.0f} Hz: {timing['overruns']:,} overruns "
+        f"in {timing['ticks']:,} ticks"
+    )
+    if capture_log is not None:
+        if capture_log.dropped:
+            events.error(f"Capture full, dropped {capture_log.dropped:,} snapshots")
+        capture_log.close()
+    # The BNO055 has usually finished calibrating by now
+    save_imu_calibration(args, backend, events)
+    if not retracted:
+        servo_stage.force(0)
+    events.event(
+        f"Servo stage wrote {servo_stage.writes:,} times, "
+        f"skipped {servo_stage.skipped:,} commands"
+    )
+    events.event("Retracting plates")
+    backend.sleep(3)  # give the servos some time to retract
+    if backend.name == "sim":
+        print(loop_report)
+        apogee = backend.pad_altitude + backend.apogee
+        print(f"Simulated apogee: {apogee:,.1f} feet")
+        print(backend.integration_report())
+    if retracted:
+        raise SystemExit(2)
+
+
+def control_loop(args, lockstep, specs, stop):
+    """ Runs the flight controller on the acquisition process's snapshots and
+        publishes a command record for every one it uses. """
+    snapshots, commands, event_ring = attach(
+        specs, "snapshots", "control", "control events"
+    )
+    events = EventChannel(event_ring)
+    sampler = RingSampler(snapshots, stop, every=lockstep)
+    descent = vehicle.Runmode.DESCENT
+    boot_timer = boot.BootTimer()
+    try:
+        predictor = None
+        if args.apogee_surface:
+            from predictor import ApogeePredictor
+
+            predictor = ApogeePredictor(args.apogee_surface)
+            events.event(f"Predicting apogee from {args.apogee_surface}")
+        calibration = load_calibration(args)
+        boot_timer.lap("files")
+        sampler.clock()  # wait for the first snapshot
+        boot_timer.lap("sensors")
+        events.event("Reading current altitude")
+        expected = calibration.get("pad_altitude") if calibration else None
+        init_alt, readings = vehicle.init_current_altitude(
+            sampler, sampler.clock, expected=expected
+        )
+        boot_timer.lap("pad altitude")
+        target = init_alt + args.target
+        events.event(
+            f"Altitude initialized to {init_alt:,} from {readings} readings, "
+            f"setting target to {target:,}"
+        )
+        if args.calibration:
+            # The last IMU offsets are kept until acquisition saves fresh ones
+            values = {"pad_altitude": init_alt}
+            if calibration is not None and "imu" in calibration:
+                values["imu"] = calibration["imu"]
+            try:
+                boot.save_calibration(args.calibration, args.backend, **values)
+            except OSError as e:
+                events.error(f"Failed to save calibration to {args.calibration}: {e}")
+
+        controller = control.FlightController(
+            init_alt, target, predictor=predictor, notify=events.event
+        )
+        boot_timer.lap("arming")
+        events.event(boot_timer.report())
+        events.event("Standing by for launch...")
+        pid = controller.pid
+        last_time = None
+        while controller.mode is not descent:
+            snapshot = sampler.sample()
+            dt = 0.0 if last_time is None else snapshot.time - last_time
+            last_time = snapshot.time
+            row = controller.step(snapshot, dt)
+            commands.publish(
+                (
+                    snapshot.count,
+                    controller.mode,
+                    pid.output_val,
+                    row is not None,
+                    *(row if row is not None else BLANK_ROW),
+                )
+            )
+        sampler.stop()
+    except EOFError:
+        events.error("Acquisition stopped before the flight was over")
+
+
+def logging_loop(args, data_capacity, specs, stop):
+    """ Writes the LOG and DATA files from the other processes' rings, and sends
+        them down the telemetry link with --downlink. """
+    rings = attach(specs, "control", "acquisition events", "control events")
+    commands, event_rings = rings[0], rings[1:]
+    event_log = Logger("LOG")
+    data_log = TelemetryRecorder(
+        "DATA", control.DATA_HEADERS, data_capacity, sync_every=SYNC_ROWS
+    )
+    downlink = None
+    if args.downlink:
+        from downlink import Downlink, create_transport, BANDWIDTH
+
+        try:
+            transport = create_transport(args.downlink)
+            downlink = Downlink(transport, args.downlink_rate or BANDWIDTH)
+            event_log.event(f"Sending telemetry to {args.downlink}")
+        except (ImportError, OSError, ValueError) as e:
+            event_log.error(f"Failed to open downlink {args.downlink}: {e}")
+    next_sequence = [1] * len(rings)
+    lost = 0
+
+    while True:
+        finished = stop.is_set()
+
+        # Events from both processes, back in the order they happened
+        pending = []
+        for i, ring in enumerate(event_rings, 1):
+            newest = ring.sequence
+            for sequence in range(next_sequence[i], newest + 1):
+                record = ring.read(sequence)
+                if record is None:
+                    lost += 1
+                else:
+                    pending.append(record)
+            next_sequence[i] = newest + 1
+        for _, kind, message in sorted(pending):
+            log = event_log.event if kind == EVENT else event_log.error
+            log(message.decode())
+            if downlink is not None:
+                send = downlink.event if kind == EVENT else downlink.error
+                send(message.decode())
+
+        newest = commands.sequence
+        for sequence in range(next_sequence[0], newest + 1):
+            record = commands.read(sequence)
+            if record is None:
+                lost += 1
+            elif record[3]:
+                data_log.write_to_table(record[4:])
+                if downlink is not None:
+                    downlink.publish(record[4:])
+        next_sequence[0] = newest + 1
+
+        if finished:
+            break
+        sleep(LOG_INTERVAL)
+
+    if lost:
+        event_log.error(f"Logging fell behind, lost {lost:,} records")
+    event_log.event("Closing data log")
+    if data_log.dropped:
+        event_log.error(f"Data log full, dropped {data_log.dropped:,} rows")
+    data_log.close()
+    if downlink is not None:
+        event_log.event(downlink.stats())
+        downlink.close()
+    event_log.event("Flight complete, exiting program")
+    event_log.close()
+
+
+def run(args, servo_config, data_capacity):
+    """ Fly with one process each for acquisition, control and logging. Returns
+        the acquisition process's exit code, 2 if the watchdog retracted. """
+    # Fork, so the children don't re-run main.py the way spawned ones would
+    context = multiprocessing.get_context("fork")
+    rings = create_rings()
+    specs = {role: ring.spec() for role, ring in rings.items()}
+    stop = context.Event()
+    lockstep = args.backend == "sim"
+
+    logging_process = context.Process(
+        target=logging_loop,
+        name="logging",
+        args=(args, data_capacity, specs, stop),
+    )
+    control_process = context.Process(
+        target=control_loop, name="control", args=(args, lockstep, specs, stop)
+    )
+    acquisition_process = context.Process(
+        target=acquisition,
+        name="acquisition",
+        args=(args, servo_config, specs, stop),
+    )
+    try:
+        logging_process.start()
+        control_process.start()
+        acquisition_process.start()
+        acquisition_process.join()
+        stop.set()
+        control_process.join(1)
+        if control_process.is_alive():
+            control_process.kill()
+            control_process.join()
+        logging_process.join()
+    finally:
+        stop.set()
+        for ring in rings.values():
+            ring.close()
+    return acquisition_process.exitcode
@@ -0,0 +1,135 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Hot path profiler for the control loop. Each stage's  |
+# |   | |/ _____ \| |   |  duration is taken with perf_counter_ns and stored in  |
+# |   | / /_   _\ \ |   |  a preallocated ring buffer, and the latency           |
+# |  |_____|___|_____|  |  percentiles and histograms are only worked out at the |
+# |    \___________/    |  end of the flight.                                    |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+from array import array
+from time import perf_counter_ns
+
+import numpy as np
+
+# Control loop stages, used as indexes into the profiler's buffers
+SAMPLE = 0
+ROTATION = 1
+ESTIMATOR = 2
+PROJECTION = 3
+PID = 4
+SERVOS = 5
+LOGGING = 6
+STAGE_NAMES = (
+    "sensor sample",
+    "inertial acceleration",
+    "estimator",
+    "projected altitude",
+    "PID output",
+    "move servos",
+    "data log write",
+)
+
+PERCENTILES = (50, 90, 99)
+
+
+class StageProfiler:
+    """ Records how long each stage of the loop takes, in nanoseconds.
+
+        mark() starts the clock, lap(stage, mark) records the time since mark
+        against the stage and returns a new mark, so back to back stages cost one
+        clock read each. """
+
+    def __init__(self, stages=STAGE_NAMES, capacity=2 ** 16):
+        self.stages = stages
+        self.capacity = capacity
+        self.durations = [array("q", bytes(8 * capacity)) for _ in stages]
+        self.counts = [0] * len(stages)
+
+    def mark(self):
+        return perf_counter_ns()
+
+    def lap(self, stage, mark):
+        """ Record the time since mark against stage, returns the current time. """
+        now = perf_counter_ns()
+        count = self.counts[stage]
+        self.durations[stage][count % self.capacity] = now - mark
+        self.counts[stage] = count + 1
+        return now
+
+    def timed(self, stage, task, *args):
+        """ Run task(*args), recording how long it took against stage. """
+        mark = perf_counter_ns()
+        result = task(*args)
+        self.lap(stage, mark)
+        return result
+
+    def summary(self):
+        """ Per stage sample count and latency percentiles in microseconds. """
+        results = []
+        for name, durations, count in zip(self.stages, self.durations, self.counts):
+            samples = np.frombuffer(durations, dtype=np.int64)[
+                : min(count, self.capacity)
+            ]
+            stage = {"stage": name, "count": count}
+            if len(samples):
+                micros = samples / 1000
+                stage["mean"] = float(micros.mean())
+                for pct, value in zip(PERCENTILES, np.percentile(micros, PERCENTILES)):
+                    stage[f"p{pct}"] = float(value)
+                stage["max"] = float(micros.max())
+                stage["histogram"] = histogram(micros)
+            results.append(stage)
+        return results
+
+    def write_report(self, log):
+        """ Write the summary and histograms with a Logger. """
+        log.writeln(
+            f"{'Stage':<24}{'count':>9}{'mean us':>11}{'p50 us':>11}"
+            f"{'p90 us':>11}{'p99 us':>11}{'max us':>11}"
+        )
+        summary = self.summary()
+        for s in summary:
+            if s["count"] == 0:
+                log.writeln(f"{s['stage']:<24}{0:>9}")
+                continue
+            log.writeln(
+                f"{s['stage']:<24}{s['count']:>9,}{s['mean']:>11.2f}{s['p50']:>11.2f}"
+                f"{s['p90']:>11.2f}{s['p99']:>11.2f}{s['max']:>11.2f}"
+            )
+        for s in summary:
+            if s["count"] == 0:
+                continue
+            log.writeln("")
+            log.writeln(f"{s['stage']} latency histogram")
+            for label, count in s["histogram"]:
+                log.writeln(f"  {label:>18}  {count:>9,}")
+
+
+class NullProfiler(StageProfiler):
+    """ Stands in when profiling is off, every call does as little as possible. """
+
+    def __init__(self, stages=STAGE_NAMES, capacity=0):
+        super().__init__(stages, 0)
+
+    def mark(self):
+        return 0
+
+    def lap(self, stage, mark):
+        return 0
+
+    def timed(self, stage, task, *args):
+        return task(*args)
+
+
+def histogram(micros):
+    """ Counts in power of two microsecond buckets, as (label, count) pairs. """
+    edges = [0.0] + [2.0 ** i for i in range(0, 21)] + [float("inf")]
+    counts, _ = np.histogram(micros, bins=edges)
+    pairs = []
+    for low, high, count in zip(edges[:-1], edges[1:], counts):
+        if count:
+            pairs.append((f"{low:g} - {high:g} us", int(count)))
+    return pairs
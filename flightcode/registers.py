@@ -0,0 +1,340 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Burst register access to the BNO055 and MPL3115A2     |
+# |   | |/ _____ \| |   |  (main.py --burst). Acceleration and quaternion come   |
+# |   | / /_   _\ \ |   |  out of one 32 byte read, and the altimeter converts   |
+# |  |_____|___|_____|  |  on its own while its data ready flag is polled, so    |
+# |    \___________/    |  nothing waits. FakeI2C serves recorded register       |
+# |                     |  images and counts transactions, run this file to      |
+# |                     |  check the decoding against it.                        |
+# +------------------------------------------------------------------------------+
+
+from struct import Struct
+from time import sleep
+
+# BNO055, page 0. Acceleration at 0x08, then magnetometer, gyroscope and Euler
+# angles, then the quaternion at 0x20, 32 bytes in all, little endian int16s
+BNO055_ADDRESS = 0x28
+BNO055_ACCEL_DATA = 0x08
+BNO055_QUATERNION_DATA = 0x20
+BNO055_ACCEL_SCALE = 1 / 100  # m/s^2 per LSB, the default units
+BNO055_QUATERNION_SCALE = 1 / (1 << 14)
+MOTION = Struct("<3h18x4h")
+
+# MPL3115A2. Status followed by the 20 bit altitude in meters, Q16.4 big endian
+MPL3115A2_ADDRESS = 0x60
+MPL3115A2_STATUS = 0x00
+MPL3115A2_PT_DATA_CFG = 0x13
+MPL3115A2_CTRL_REG1 = 0x26
+MPL3115A2_PDR = 0x04  # new pressure/altitude data ready
+MPL3115A2_ALT = 0x80
+MPL3115A2_OST = 0x02
+MPL3115A2_SBYB = 0x01
+MPL3115A2_DATA_FLAGS = 0x07  # data ready flags for pressure and temperature
+ALTITUDE = Struct(">Bi")  # status, then the altitude read as an int32 with the
+ALTITUDE_SCALE = 1 / 65536  # temperature MSB in the low byte, masked off below
+
+OVERSAMPLING = 4  # 18 ms conversions, so about every other control cycle
+
+# Shortest time between conversions in seconds for each oversampling setting
+CONVERSION_TIMES = {
+    1: 0.006,
+    2: 0.010,
+    4: 0.018,
+    8: 0.034,
+    16: 0.066,
+    32: 0.130,
+    64: 0.258,
+    128: 0.512,
+}
+
+
+def decode_motion(buffer):
+    """ (acceleration in m/s^2, (w, x, y, z) quaternion) from the 32 bytes
+        starting at BNO055_ACCEL_DATA, unpacked in one call. """
+    ax, ay, az, qw, qx, qy, qz = MOTION.unpack_from(buffer)
+    a = BNO055_ACCEL_SCALE
+    q = BNO055_QUATERNION_SCALE
+    return (ax * a, ay * a, az * a), (qw * q, qx * q, qy * q, qz * q)
+
+
+def decode_altitude(buffer):
+    """ Altitude in meters from the 5 bytes starting at MPL3115A2_STATUS, or None
+        if the data ready flag isn't set. """
+    status, raw = ALTITUDE.unpack_from(buffer)
+    if not status & MPL3115A2_PDR:
+        return None
+    return (raw & ~0xFF) * ALTITUDE_SCALE
+
+
+def encode_motion(acceleration, quaternion, image=None):
+    """ Put an acceleration and quaternion into a BNO055 register image, the way
+        the sensor would report them. Returns the image. """
+    if image is None:
+        image = bytearray(256)
+    a = [round(v / BNO055_ACCEL_SCALE) for v in acceleration]
+    q = [round(v / BNO055_QUATERNION_SCALE) for v in quaternion]
+    Struct("<3h").pack_into(image, BNO055_ACCEL_DATA, *a)
+    Struct("<4h").pack_into(image, BNO055_QUATERNION_DATA, *q)
+    return image
+
+
+def encode_altitude(altitude, ready=True, image=None):
+    """ Put an altitude in meters into an MPL3115A2 register image, with the data
+        ready flag set or not. Returns the image. """
+    if image is None:
+        image = bytearray(256)
+    raw = round(altitude * 16) << 12  # Q16.4 in the top 20 bits
+    image[MPL3115A2_STATUS] = MPL3115A2_PDR if ready else 0
+    image[MPL3115A2_STATUS + 1 : MPL3115A2_STATUS + 4] = raw.to_bytes(
+        4, "big", signed=True
+    )[:3]
+    return image
+
+
+class RegisterDevice:
+    """ Register reads and writes on one I2C address, on a busio.I2C style bus.
+        Every call is one bus transaction, and the bus is locked around it because
+        the servo driver shares it, possibly from another thread. """
+
+    def __init__(self, i2c, address):
+        self.i2c = i2c
+        self.address = address
+        self.register = bytearray(1)
+        self.out = bytearray(2)
+
+    def read_into(self, register, buffer):
+        """ Fill buffer from consecutive registers starting at register. """
+        self.register[0] = register
+        i2c = self.i2c
+        while not i2c.try_lock():
+            pass
+        try:
+            i2c.writeto_then_readfrom(self.address, self.register, buffer)
+        finally:
+            i2c.unlock()
+        return buffer
+
+    def write(self, register, value):
+        self.out[0] = register
+        self.out[1] = value
+        i2c = self.i2c
+        while not i2c.try_lock():
+            pass
+        try:
+            i2c.writeto(self.address, self.out)
+        finally:
+            i2c.unlock()
+
+
+class BurstBNO055:
+    """ Reads acceleration and orientation from a BNO055 the Adafruit driver has
+        already set up, in one transaction instead of one per quantity. """
+
+    def __init__(self, i2c, address=BNO055_ADDRESS):
+        self.device = RegisterDevice(i2c, address)
+        self.buffer = bytearray(MOTION.size)
+
+    def read_motion(self):
+        """ (acceleration, quaternion) in the driver's units. """
+        return decode_motion(self.device.read_into(BNO055_ACCEL_DATA, self.buffer))
+
+    @property
+    def acceleration(self):
+        return self.read_motion()[0]
+
+    @property
+    def quaternion(self):
+        return self.read_motion()[1]
+
+
+class BurstMPL3115A2:
+    """ MPL3115A2 altimeter that converts on its own between polls.
+
+        The Adafruit driver starts a one shot conversion on every read and sleeps
+        until it's done. Here the next conversion is started as soon as one is
+        read, or with continuous=True the sensor runs in active mode, which only
+        goes as fast as once a second. poll_altitude() checks the data ready flag
+        and reads the result in the same transaction, so it never waits. """
+
+    def __init__(
+        self,
+        i2c,
+        address=MPL3115A2_ADDRESS,
+        oversampling=OVERSAMPLING,
+        continuous=False,
+    ):
+        if oversampling not in CONVERSION_TIMES:
+            raise ValueError(
+                f"Oversampling must be one of {list(CONVERSION_TIMES)}, "
+                f"not {oversampling}"
+            )
+        self.device = RegisterDevice(i2c, address)
+        self.buffer = bytearray(ALTITUDE.size)
+        self.continuous = continuous
+        self.conversion_time = CONVERSION_TIMES[oversampling]
+        self.control = MPL3115A2_ALT | (oversampling.bit_length() - 1) << 3
+
+        # Standby while it's configured, then start converting
+        self.device.write(MPL3115A2_CTRL_REG1, self.control)
+        self.device.write(MPL3115A2_PT_DATA_CFG, MPL3115A2_DATA_FLAGS)
+        if continuous:
+            self.device.write(MPL3115A2_CTRL_REG1, self.control | MPL3115A2_SBYB)
+        else:
+            self.trigger()
+
+    def trigger(self):
+        self.device.write(MPL3115A2_CTRL_REG1, self.control | MPL3115A2_OST)
+
+    def poll_altitude(self):
+        """ Altitude in meters if a new conversion has finished, otherwise None. """
+        altitude = decode_altitude(self.device.read_into(MPL3115A2_STATUS, self.buffer))
+        if altitude is not None and not self.continuous:
+            self.trigger()
+        return altitude
+
+    @property
+    def altitude(self):
+        """ Waits for the next conversion, for callers that need a value. """
+        while True:
+            altitude = self.poll_altitude()
+            if altitude is not None:
+                return altitude
+            sleep(self.conversion_time / 4)
+
+
+class FakeI2C:
+    """ busio.I2C stand-in serving recorded register images, one per device per
+        tick, and counting the transactions made in each tick.
+
+        images maps addresses to a sequence of 256 byte register images. tick()
+        moves every device on to its next image, staying on the last one at the
+        end. Writes change the current image and carry over to later ones. """
+
+    def __init__(self, images):
+        self.images = {address: list(frames) for address, frames in images.items()}
+        self.index = 0
+        self.written = {address: {} for address in self.images}
+        self.current = {}
+        self.load()
+        self.transactions = 0
+        self.tick_transactions = 0
+        self.per_tick = []  # transactions in each finished tick
+        self.locked = False
+
+    def load(self):
+        for address, frames in self.images.items():
+            image = bytearray(frames[min(self.index, len(frames) - 1)])
+            for register, value in self.written[address].items():
+                image[register] = value
+            self.current[address] = image
+
+    def rewind(self):
+        """ Back to the first images with the counts zeroed, e.g. once the devices
+            have been set up. Writes so far are kept. """
+        self.index = 0
+        self.load()
+        self.transactions = 0
+        self.tick_transactions = 0
+        self.per_tick = []
+
+    def tick(self):
+        self.per_tick.append(self.tick_transactions)
+        self.tick_transactions = 0
+        self.index += 1
+        self.load()
+
+    def count(self):
+        self.transactions += 1
+        self.tick_transactions += 1
+
+    def try_lock(self):
+        if self.locked:
+            return False
+        self.locked = True
+        return True
+
+    def unlock(self):
+        self.locked = False
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        self.count()
+        data = bytes(buffer[start:end])
+        register = data[0]
+        for offset, value in enumerate(data[1:]):
+            self.current[address][register + offset] = value
+            self.written[address][register + offset] = value
+
+    def writeto_then_readfrom(
+        self,
+        address,
+        buffer_out,
+        buffer_in,
+        *,
+        out_start=0,
+        out_end=None,
+        in_start=0,
+        in_end=None,
+    ):
+        self.count()
+        register = buffer_out[out_start]
+        if in_end is None:
+            in_end = len(buffer_in)
+        image = self.current[address]
+        buffer_in[in_start:in_end] = image[register : register + in_end - in_start]
+
+
+if __name__ == "__main__":
+    import math
+
+    from sampler import BurstSampler
+
+    # A tilted, spinning coast, with the altimeter ready every other tick
+    ticks = 1000
+    bno_images, mpl_images, expected = [], [], []
+    for i in range(ticks):
+        t = i * 0.01
+        accel = (0.3 * math.sin(t), -0.2 * math.cos(t), -12.2 + t)
+        half = 0.05 + 0.5 * t
+        quaternion = (math.cos(half), 0.0, math.sin(half) * 0.6, math.sin(half) * 0.8)
+        altitude = 300.0 + 80.0 * t - 4.9 * t * t
+        bno_images.append(encode_motion(accel, quaternion))
+        mpl_images.append(encode_altitude(altitude, ready=i % 2 == 0))
+        expected.append((accel, quaternion, altitude))
+
+    bus = FakeI2C({BNO055_ADDRESS: bno_images, MPL3115A2_ADDRESS: mpl_images})
+    bno = BurstBNO055(bus)
+    mpl = BurstMPL3115A2(bus)
+    bus.rewind()  # setting them up isn't part of the flight
+
+    sampler = BurstSampler(bno, mpl, iter(range(ticks)).__next__)
+    worst = [0.0, 0.0, 0.0]
+    fresh = 0
+    for i in range(ticks):
+        snapshot = sampler.sample()
+        accel, quaternion, altitude = expected[i]
+        for j, (got, want) in enumerate(
+            ((snapshot.acceleration, accel), (snapshot.quaternion, quaternion))
+        ):
+            worst[j] = max(worst[j], *(abs(a - b) for a, b in zip(got, want)))
+        if snapshot.altitude_fresh:
+            fresh += 1
+            worst[2] = max(worst[2], abs(snapshot.altitude - altitude))
+        bus.tick()
+
+    # Half a quantization step at most
+    assert worst[0] <= BNO055_ACCEL_SCALE / 2 + 1e-12
+    assert worst[1] <= BNO055_QUATERNION_SCALE / 2 + 1e-12
+    assert worst[2] <= 1 / 32 + 1e-12
+    assert fresh == ticks // 2
+    per_tick = bus.per_tick
+    print(f"{ticks:,} ticks, {fresh:,} fresh altitudes")
+    print(
+        f"Transactions per tick: {sum(per_tick) / len(per_tick):.2f} on average, "
+        f"{min(per_tick)} to {max(per_tick)}"
+    )
+    print(
+        f"Worst decoding error: {worst[0]:.4f} m/s^2, {worst[1]:.6f} quaternion, "
+        f"{worst[2]:.4f} m"
+    )
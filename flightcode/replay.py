@@ -0,0 +1,275 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Replays a recorded flight through the control code as |
+# |   | |/ _____ \| |   |  fast as the CPU allows, writes the DATA table it      |
+# |   | / /_   _\ \ |   |  produces and diffs it against the original. Takes a   |
+# |  |_____|___|_____|  |  raw capture from main.py --capture, or a DATA log.    |
+# |    \___________/    |  Run: python replay.py RAW-<time>.bin                  |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import argparse
+import os
+from time import perf_counter
+
+import numpy as np
+
+import vehicle
+import control
+from analyze import is_recording, load_flight
+from predictor import ApogeePredictor
+from sampler import CAPTURE_HEADERS, ReplaySampler, Snapshot
+from telemetry import TelemetryRecorder, convert_to_table, read_recording
+
+TIME_COLUMN = control.DATA_HEADERS[0]
+IDENTITY = (1.0, 0.0, 0.0, 0.0)
+CHUNK_ROWS = 65536
+
+
+class Replay:
+    """ Feeds recorded samples to a FlightController and records its DATA rows.
+        target is the altitude to reach above the pad in feet, predictor and gains
+        are passed on to the controller. """
+
+    def __init__(self, target=control.TARGET_ALT, predictor=None, gains=None):
+        self.target = target
+        self.predictor = predictor
+        self.gains = gains if gains is not None else control.PID_GAINS
+        self.controller = None
+        self.events = []  # (recorded time, message)
+        self.time = None
+        self.samples = 0
+        self.duration = 0.0  # seconds of recorded data replayed
+
+    def notify(self, message):
+        self.events.append((self.time, message))
+
+    def create_controller(self, init_alt):
+        self.controller = control.FlightController(
+            init_alt,
+            init_alt + self.target,
+            predictor=self.predictor,
+            gains=self.gains,
+            notify=self.notify,
+        )
+        return self.controller
+
+    def run(self, samples, recorder, last_time=None):
+        """ Step the controller through (snapshot, dt) pairs until DESCENT. """
+        controller = self.controller
+        step = controller.step
+        write = recorder.write_to_table
+        descent = vehicle.Runmode.DESCENT
+        for snapshot in samples:
+            time = snapshot.time
+            dt = 0.0 if last_time is None else time - last_time
+            last_time = self.time = time
+            self.samples += 1
+            row = step(snapshot, dt)
+            if row is not None:
+                write(row)
+            if controller.mode is descent:
+                break
+
+    def replay_capture(self, records, recorder, pad_samples=vehicle.PAD_SAMPLES):
+        """ Replay a raw capture from the pad, the same way main.py flies it.
+            pad_samples is how many readings the flight's pad average took, its
+            LOG has it. """
+        sampler = ReplaySampler(records)
+        start = sampler.clock()
+        init_alt, readings = vehicle.init_current_altitude(
+            sampler, sampler.clock, samples=pad_samples
+        )
+        self.samples += sampler.count
+        self.time = start
+        self.notify(f"Altitude initialized to {init_alt:,} from {readings} readings")
+        self.create_controller(init_alt)
+
+        def snapshots():
+            while not sampler.done:
+                yield sampler.sample()
+
+        # main.py's first control cycle after the pad average has no time step
+        self.run(snapshots(), recorder)
+        self.duration = self.time - start
+
+    def replay_data(self, columns, recorder, pad_altitude=0.0):
+        """ Replay the COAST of a DATA log. Its inertial acceleration becomes the
+            accelerometer and its altitude the altimeter, so the estimator sees an
+            already filtered altitude. The estimator starts from the first row's
+            state, carried back to the start of the coast. """
+        time = np.asarray(columns[TIME_COLUMN])
+        if not len(time):
+            return
+        accel = [np.asarray(columns[f"Acceleration ({a})"]) for a in "xyz"]
+        alt = np.asarray(columns["Altitude (z)"])
+        veloc = np.asarray(columns["Velocity (z)"])
+
+        controller = self.create_controller(pad_altitude)
+        controller.start_coast(0.0)
+        t0 = float(time[0])
+        x = controller.estimator.x
+        x[0] = alt[0] - veloc[0] * t0
+        x[1] = veloc[0] - accel[2][0] * t0
+        x[2] = accel[2][0]
+
+        # Back into the driver's units, meters and m/s^2
+        scale = 1 / vehicle.METERSTOFEET
+        table = np.column_stack(
+            (
+                time,
+                accel[0] * scale,
+                accel[1] * scale,
+                (accel[2] + vehicle.GRAV) * scale,  # the sensor reads +1 g at rest
+                alt * scale,
+            )
+        )
+
+        def snapshots():
+            for start in range(0, len(table), CHUNK_ROWS):
+                for t, ax, ay, az, z in table[start : start + CHUNK_ROWS].tolist():
+                    yield Snapshot(0, t, (ax, ay, az), IDENTITY, z, True)
+
+        self.run(snapshots(), recorder, last_time=0.0)
+        self.duration = self.time
+
+
+def is_capture(file_name):
+    return is_recording(file_name) and read_recording(file_name)[0] == CAPTURE_HEADERS
+
+
+def find_data(capture_file):
+    """ The DATA file main.py wrote alongside a raw capture, if there is one. """
+    directory, name = os.path.split(capture_file)
+    stem = name[len("RAW") :].rsplit(".", 1)[0]
+    for extension in ("bin", "txt"):
+        data_file = os.path.join(directory, f"DATA{stem}.{extension}")
+        if os.path.exists(data_file):
+            return data_file
+    return None
+
+
+def diff_flights(original, replayed):
+    """ Compare two DATA logs given as columns by header. The replayed columns are
+        interpolated onto the original's time stamps where the two overlap.
+        Returns a summary of both flights and per column (header, max abs, rms,
+        mean) differences. """
+    summary = {}
+    for name, columns in (("original", original), ("replayed", replayed)):
+        time = np.asarray(columns[TIME_COLUMN])
+        alt = np.asarray(columns["Altitude (z)"])
+        pid = np.asarray(columns["PID Controller Output"])
+        summary[name] = {
+            "rows": len(time),
+            "coast": float(time[-1]) if len(time) else 0.0,
+            "apogee": float(alt.max()) if len(alt) else None,
+            "final_pid": float(pid[-1]) if len(pid) else None,
+        }
+
+    t0 = np.asarray(original[TIME_COLUMN])
+    t1 = np.asarray(replayed[TIME_COLUMN])
+    differences = []
+    if not len(t0) or not len(t1):
+        return summary, differences
+    overlap = (t0 >= t1[0]) & (t0 <= t1[-1])
+    times = t0[overlap]
+    for header in control.DATA_HEADERS[1:]:
+        if header not in original or header not in replayed:
+            continue
+        error = np.interp(times, t1, replayed[header]) - original[header][overlap]
+        if len(error):
+            rms = float(np.sqrt(np.mean(error * error)))
+            stats = (float(np.abs(error).max()), rms, float(error.mean()))
+        else:
+            stats = (0.0, 0.0, 0.0)
+        differences.append((header, *stats))
+    return summary, differences
+
+
+def print_diff(summary, differences):
+    original, replayed = summary["original"], summary["replayed"]
+    print(f"{'':<24}{'original':>14}{'replayed':>14}")
+    print(f"{'DATA rows':<24}{original['rows']:>14,}{replayed['rows']:>14,}")
+    print(f"{'Coast (s)':<24}{original['coast']:>14.3f}{replayed['coast']:>14.3f}")
+    for key, label in (("apogee", "Apogee (ft)"), ("final_pid", "Final PID output")):
+        if original[key] is not None and replayed[key] is not None:
+            print(f"{label:<24}{original[key]:>14,.3f}{replayed[key]:>14,.3f}")
+    if differences:
+        print()
+        print(f"{'Column':<24}{'max abs':>14}{'rms':>14}{'mean':>14}")
+        for header, max_abs, rms, mean in differences:
+            print(f"{header:<24}{max_abs:>14.6g}{rms:>14.6g}{mean:>14.6g}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded flight through the control code"
+    )
+    parser.add_argument(
+        "recording", help="RAW-<time>.bin from main.py --capture, or a DATA log"
+    )
+    parser.add_argument("--against", help="DATA log to diff with, found by default")
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=control.TARGET_ALT,
+        help="altitude to reach above the pad, in feet",
+    )
+    parser.add_argument(
+        "--pad-altitude",
+        type=float,
+        default=0.0,
+        help="pad altitude in feet, only used for DATA logs, which don't record it",
+    )
+    parser.add_argument(
+        "--pad-samples",
+        type=int,
+        default=vehicle.PAD_SAMPLES,
+        help="altimeter readings the flight averaged on the pad, fewer than the "
+        "default when its LOG says it warm started",
+    )
+    parser.add_argument("--gains", type=float, nargs=3, metavar=("KP", "KI", "KD"))
+    parser.add_argument("--apogee-surface", help="surface built by sim/surface.py")
+    args = parser.parse_args()
+
+    predictor = ApogeePredictor(args.apogee_surface) if args.apogee_surface else None
+    replay = Replay(args.target, predictor, args.gains)
+
+    if is_capture(args.recording):
+        records = read_recording(args.recording)[1]
+        recorder = TelemetryRecorder("REPLAY", control.DATA_HEADERS, len(records))
+        wall_start = perf_counter()
+        replay.replay_capture(records, recorder, args.pad_samples)
+        against = args.against or find_data(args.recording)
+    else:
+        columns, meta = load_flight(args.recording)
+        recorder = TelemetryRecorder("REPLAY", control.DATA_HEADERS, meta["rows"])
+        wall_start = perf_counter()
+        replay.replay_data(columns, recorder, args.pad_altitude)
+        against = args.against or args.recording
+    wall_time = perf_counter() - wall_start
+
+    rows = recorder.count
+    replayed = {
+        header: np.array(recorder.records[:rows, i])
+        for i, header in enumerate(control.DATA_HEADERS)
+    }
+    recorder.close()
+    table = convert_to_table(recorder.file_name)
+
+    rate = replay.samples / wall_time if wall_time > 0 else float("inf")
+    speed = replay.duration / wall_time if wall_time > 0 else float("inf")
+    print(
+        f"Replayed {replay.samples:,} samples ({replay.duration:,.1f} s recorded) "
+        f"in {wall_time:.3f} s: {rate:,.0f} samples/s, {speed:,.0f}x real time"
+    )
+    for time, message in replay.events:
+        print(f"  {time:>10.3f} s  {message}")
+    print(f"Wrote {recorder.file_name} and {table}")
+
+    if against:
+        print(f"Diff against {against}:")
+        print_diff(*diff_flights(load_flight(against)[0], replayed))
+    else:
+        print("No DATA log to diff against, pass one with --against")
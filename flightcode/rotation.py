@@ -0,0 +1,91 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Quaternion rotation from the vehicle frame to the     |
+# |   | |/ _____ \| |   |  inertial frame. rotate() does one vector into a       |
+# |   | / /_   _\ \ |   |  preallocated buffer for the control loop,             |
+# |  |_____|___|_____|  |  rotate_batch() does a whole recording at once for     |
+# |    \___________/    |  post-flight work. Run this file to benchmark them.    |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import numpy as np
+
+
+def rotate(quaternion, vector, scale, out):
+    """ Rotate vector by the (w, x, y, z) quaternion, multiply by scale and store
+        it in out. Same result as vehicle.vehicle_to_inertial(quaternion) @ vector,
+        but without building the matrix or any arrays. Returns out. """
+    a, b, c, d = quaternion
+    x, y, z = vector
+    aa, bb, cc, dd = a * a, b * b, c * c, d * d
+    ab, ac, ad = a * b, a * c, a * d
+    bc, bd, cd = b * c, b * d, c * d
+    out[0] = scale * ((aa + bb - cc - dd) * x + 2 * ((bc - ad) * y + (bd + ac) * z))
+    out[1] = scale * ((aa - bb + cc - dd) * y + 2 * ((bc + ad) * x + (cd - ab) * z))
+    out[2] = scale * ((aa - bb - cc + dd) * z + 2 * ((bd - ac) * x + (cd + ab) * y))
+    return out
+
+
+def rotate_batch(quaternions, vectors, scale=1.0, out=None):
+    """ rotate() over N x 4 quaternions and N x 3 vectors in one go, returns N x 3. """
+    q = np.asarray(quaternions, dtype=float)
+    v = np.asarray(vectors, dtype=float)
+    if out is None:
+        out = np.empty(v.shape)
+    a, b, c, d = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    x, y, z = v[:, 0], v[:, 1], v[:, 2]
+    aa, bb, cc, dd = a * a, b * b, c * c, d * d
+    ab, ac, ad = a * b, a * c, a * d
+    bc, bd, cd = b * c, b * d, c * d
+    out[:, 0] = (aa + bb - cc - dd) * x + 2 * ((bc - ad) * y + (bd + ac) * z)
+    out[:, 1] = (aa - bb + cc - dd) * y + 2 * ((bc + ad) * x + (cd - ab) * z)
+    out[:, 2] = (aa - bb - cc + dd) * z + 2 * ((bd - ac) * x + (cd + ab) * y)
+    if scale != 1.0:
+        out *= scale
+    return out
+
+
+if __name__ == "__main__":
+    from timeit import timeit
+
+    from vehicle import METERSTOFEET, vehicle_to_inertial
+
+    rng = np.random.default_rng(0)
+    count = 100000
+    quaternions = rng.normal(size=(count, 4))
+    quaternions /= np.linalg.norm(quaternions, axis=1)[:, None]
+    vectors = rng.normal(scale=20, size=(count, 3))
+    # Plain floats, like the driver hands back
+    quaternion = tuple(quaternions[0].tolist())
+    vector = tuple(vectors[0].tolist())
+
+    def matrix_path():
+        return vehicle_to_inertial(quaternion) @ np.asarray(vector) * METERSTOFEET
+
+    out = np.zeros(3)
+    assert np.allclose(rotate(quaternion, vector, METERSTOFEET, out), matrix_path())
+    batch = rotate_batch(quaternions, vectors, METERSTOFEET)
+    sample = range(0, count, 997)
+    reference = [vehicle_to_inertial(quaternions[i]) @ vectors[i] for i in sample]
+    assert np.allclose(batch[sample], np.array(reference) * METERSTOFEET)
+
+    loops = 20000
+    matrix_time = timeit(matrix_path, number=loops) / loops
+    rotate_time = timeit(
+        lambda: rotate(quaternion, vector, METERSTOFEET, out), number=loops
+    ) / loops
+    print(f"Matrix path (vehicle_to_inertial @ accel):  {matrix_time * 1e6:8.2f} us")
+    print(f"rotate() into a preallocated buffer:       {rotate_time * 1e6:8.2f} us")
+    speedup = matrix_time / rotate_time
+    print(f"Speedup:                                   {speedup:8.1f}x")
+
+    batch_time = timeit(
+        lambda: rotate_batch(quaternions, vectors, METERSTOFEET), number=10
+    ) / 10
+    per_row = batch_time / count
+    print(
+        f"rotate_batch() on {count:,} rows:            {batch_time * 1000:8.2f} ms "
+        f"({per_row * 1e9:.0f} ns per row, "
+        f"{matrix_time / per_row:,.0f}x the matrix path)"
+    )
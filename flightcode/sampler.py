@@ -0,0 +1,282 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Sensor sampling stage. Each control cycle takes one   |
+# |   | |/ _____ \| |   |  timestamped snapshot of the BNO055 and MPL3115A2, so  |
+# |   | / /_   _\ \ |   |  every register is read once per cycle and everything  |
+# |  |_____|___|_____|  |  computed from it agrees. ThreadedSampler does the     |
+# |    \___________/    |  reading on a background thread instead. The slow      |
+# |                     |  altimeter can be polled every few samples.            |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+from threading import Thread, Event, Lock
+from time import monotonic
+
+
+class Snapshot:
+    """ One reading of every sensor quantity the flight code uses, in driver units. """
+
+    __slots__ = (
+        "count",
+        "time",
+        "acceleration",
+        "quaternion",
+        "altitude",
+        "altitude_fresh",
+    )
+
+    def __init__(self, count, time, acceleration, quaternion, altitude, altitude_fresh):
+        self.count = count  # increases by one for every new snapshot
+        self.time = time  # clock time the snapshot was taken
+        self.acceleration = acceleration  # m/s^2, vehicle frame
+        self.quaternion = quaternion
+        self.altitude = altitude  # meters
+        self.altitude_fresh = altitude_fresh  # False if altitude is a repeat
+
+
+class Sampler:
+    """ Reads the sensors each time a sample is asked for. The altimeter is only
+        read every `baro_every` samples, in between the last altitude is repeated. """
+
+    def __init__(self, bno, mpl, clock=monotonic, baro_every=1):
+        self.bno = bno
+        self.mpl = mpl
+        self.clock = clock
+        self.baro_every = baro_every
+        self.count = 0
+        self.altitude = None
+
+    def read(self) -> Snapshot:
+        """ Read every sensor once. """
+        time = self.clock()
+        fresh = self.altitude is None or self.count % self.baro_every == 0
+        if fresh:
+            self.altitude = self.mpl.altitude
+        self.count += 1
+        return Snapshot(
+            self.count,
+            time,
+            self.bno.acceleration,
+            self.bno.quaternion,
+            self.altitude,
+            fresh,
+        )
+
+    def sample(self) -> Snapshot:
+        """ The snapshot for this control cycle. """
+        return self.read()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class ThreadedSampler(Sampler):
+    """ Reads the sensors continuously on a background thread. sample() returns the
+        latest snapshot instead of waiting on the I2C bus, and each snapshot is
+        handed out once, so if the last one was already taken it waits for the
+        read in progress. A fresh altitude stays fresh until it's handed out,
+        even when newer reads without one replace its snapshot. Only use this
+        with the hardware backend, the simulated sensors aren't thread safe. """
+
+    def __init__(self, bno, mpl, clock=monotonic, baro_every=1):
+        super().__init__(bno, mpl, clock, baro_every)
+        self.latest = None
+        self.lock = Lock()
+        self.ready = Event()  # set while latest hasn't been handed out
+        self.running = False
+        self.thread = Thread(target=self.run, name="sampler", daemon=True)
+
+    def run(self):
+        while self.running:
+            snapshot = self.read()
+            with self.lock:
+                latest = self.latest
+                if self.ready.is_set() and latest.altitude_fresh:
+                    snapshot.altitude_fresh = True
+                self.latest = snapshot
+                self.ready.set()
+
+    def sample(self) -> Snapshot:
+        self.ready.wait()
+        with self.lock:
+            self.ready.clear()
+            return self.latest
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+class BurstSampler(Sampler):
+    """ Sampler for the burst sensors in registers.py (or the simulated ones).
+        Acceleration and quaternion come from one register read, and the
+        altimeter's data ready flag is polled every `baro_every` samples, so the
+        altitude is fresh whenever a conversion has finished and nothing waits for
+        one. Only the very first sample waits for an altitude. """
+
+    def read(self) -> Snapshot:
+        time = self.clock()
+        altitude = None
+        if self.count % self.baro_every == 0:
+            altitude = self.mpl.poll_altitude()
+        if altitude is None and self.altitude is None:
+            altitude = self.mpl.altitude
+        fresh = altitude is not None
+        if fresh:
+            self.altitude = altitude
+        acceleration, quaternion = self.bno.read_motion()
+        self.count += 1
+        return Snapshot(
+            self.count, time, acceleration, quaternion, self.altitude, fresh
+        )
+
+
+class ThreadedBurstSampler(BurstSampler, ThreadedSampler):
+    """ BurstSampler reading on a background thread. """
+
+
+# Columns of a raw sensor capture, one row per snapshot the control loop used
+CAPTURE_HEADERS = (
+    "Time (seconds)",
+    "Acceleration (x)",
+    "Acceleration (y)",
+    "Acceleration (z)",
+    "Quaternion (w)",
+    "Quaternion (x)",
+    "Quaternion (y)",
+    "Quaternion (z)",
+    "Altitude (meters)",
+    "Altitude fresh",
+)
+NAN = float("nan")
+
+
+class CaptureSampler:
+    """ Wraps another sampler and copies every snapshot it hands out into a
+        TelemetryRecorder with CAPTURE_HEADERS, for replay.py. """
+
+    def __init__(self, sampler, recorder):
+        self.sampler = sampler
+        self.recorder = recorder
+
+    def sample(self) -> Snapshot:
+        snapshot = self.sampler.sample()
+        row = (
+            snapshot.time,
+            *snapshot.acceleration,
+            *snapshot.quaternion,
+            snapshot.altitude,
+            snapshot.altitude_fresh,
+        )
+        try:
+            self.recorder.write_to_table(row)
+        except TypeError:
+            # The BNO055 driver hands back None when a read fails
+            self.recorder.write_to_table([NAN if v is None else v for v in row])
+        return snapshot
+
+    def start(self):
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+
+
+class ReplaySampler:
+    """ Hands out the snapshots of a raw capture in order. clock() is the time of
+        the next snapshot, so code that paces itself off the clock follows the
+        recording instead of the wall. Rows are turned into floats a chunk at a
+        time, so hours of capture never sit in memory as Python objects. """
+
+    def __init__(self, records, chunk_rows=65536):
+        self.records = records
+        self.chunk_rows = chunk_rows
+        self.count = 0  # snapshots handed out so far
+        self.chunk = []
+        self.index = 0  # next row within chunk
+
+    @property
+    def done(self):
+        return self.index >= len(self.chunk) and self.count >= len(self.records)
+
+    def next_row(self):
+        if self.index >= len(self.chunk):
+            if self.count >= len(self.records):
+                raise EOFError("end of the capture")
+            start = self.count
+            self.chunk = self.records[start : start + self.chunk_rows].tolist()
+            self.index = 0
+        return self.chunk[self.index]
+
+    def clock(self):
+        return self.next_row()[0]
+
+    def sample(self) -> Snapshot:
+        t, ax, ay, az, qw, qx, qy, qz, alt, fresh = self.next_row()
+        self.index += 1
+        self.count += 1
+        return Snapshot(
+            self.count, t, (ax, ay, az), (qw, qx, qy, qz), alt, fresh != 0
+        )
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+if __name__ == "__main__":
+    from itertools import count
+    from time import sleep
+
+    class FakeIMU:
+        acceleration = (0.0, 0.0, 9.8)
+        quaternion = (1.0, 0.0, 0.0, 0.0)
+
+        def read_motion(self):
+            return self.acceleration, self.quaternion
+
+    class FakeAltimeter:
+        """ Every conversion gives a new altitude, one is ready every third poll. """
+
+        def __init__(self):
+            self.conversions = 0
+            self.polls = 0
+
+        @property
+        def altitude(self):
+            self.conversions += 1
+            return float(self.conversions)
+
+        def poll_altitude(self):
+            self.polls += 1
+            return self.altitude if self.polls % 3 == 0 else None
+
+    # Control ticks slower than the thread reads, so reads pile up between ticks
+    for SamplerType in (ThreadedSampler, ThreadedBurstSampler):
+        sampler = SamplerType(FakeIMU(), FakeAltimeter(), count().__next__, 2)
+        sampler.start()
+        last = sampler.sample()
+        fresh = 0
+        for _ in range(100):
+            sleep(0.001)
+            snapshot = sampler.sample()
+            # Never the same snapshot twice, and fresh exactly when the altitude
+            # changed since the last one handed out
+            assert snapshot.count > last.count and snapshot.time > last.time
+            assert snapshot.altitude_fresh == (snapshot.altitude != last.altitude)
+            fresh += snapshot.altitude_fresh
+            last = snapshot
+        sampler.stop()
+        assert fresh > 0
+        print(f"{SamplerType.__name__}: {fresh} fresh altitudes in 100 samples")
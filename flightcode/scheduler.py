@@ -0,0 +1,106 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Fixed-rate scheduler for the control loop. Starts     |
+# |   | |/ _____ \| |   |  each cycle on a fixed period, measures the real time  |
+# |   | / /_   _\ \ |   |  step, keeps count of overruns and start jitter, and   |
+# |  |_____|___|_____|  |  runs deferred work like logging in the slack left     |
+# |    \___________/    |  before the next cycle.                                |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+from collections import deque
+from time import monotonic, sleep
+
+import numpy as np
+
+JITTER_PERCENTILES = (50, 90, 99)
+
+
+class LoopScheduler:
+    """ Call tick() at the top of every cycle, it waits for the cycle's start time
+        and returns the time since the last cycle started. Work handed to defer()
+        runs inside tick() while there's time left before the next start. """
+
+    def __init__(self, rate, clock=monotonic, sleep=sleep, history=2 ** 16):
+        self.period = 1 / rate
+        self.clock = clock
+        self.sleep = sleep
+
+        self.start_time = None  # when the current cycle started
+        self.next_start = None  # when the next cycle is due
+        self.ticks = 0
+        self.overruns = 0
+
+        # Start lateness of each cycle, kept in a ring so it never grows
+        self.lateness = np.zeros(history)
+
+        # Deferred work, run oldest first. If it falls this far behind, the oldest
+        # task runs even without slack so the backlog stays bounded.
+        self.tasks = deque()
+        self.max_backlog = 256
+        self.tasks_run = 0
+
+    def defer(self, task, *args):
+        """ Run task(*args) in leftover time before a later cycle. """
+        self.tasks.append((task, args))
+
+    def run_task(self):
+        task, args = self.tasks.popleft()
+        task(*args)
+        self.tasks_run += 1
+
+    def tick(self):
+        """ Wait for the next cycle to start, returns the measured time step. """
+        if self.next_start is None:
+            self.start_time = self.clock()
+            self.next_start = self.start_time + self.period
+            return 0.0
+
+        if self.clock() > self.next_start:
+            # Last cycle's work ran past its deadline, no slack this time
+            self.overruns += 1
+            if len(self.tasks) > self.max_backlog:
+                self.run_task()
+        else:
+            while self.tasks and self.clock() < self.next_start:
+                self.run_task()
+            remaining = self.next_start - self.clock()
+            if remaining > 0:
+                self.sleep(remaining)
+
+        now = self.clock()
+        self.lateness[self.ticks % len(self.lateness)] = now - self.next_start
+        self.ticks += 1
+
+        dt = now - self.start_time
+        self.start_time = now
+        self.next_start += self.period
+        if self.next_start <= now:
+            # Fell more than a whole period behind, skip the missed cycles
+            self.next_start = now + self.period
+        return dt
+
+    def drain(self):
+        """ Run everything still deferred. """
+        while self.tasks:
+            self.run_task()
+
+    def stats(self):
+        """ Tick count, overruns and start jitter percentiles in seconds. The
+            jitter is 0.0 when no cycle has been timed yet. """
+        lateness = self.lateness[: min(self.ticks, len(self.lateness))]
+        if not len(lateness):
+            lateness = np.zeros(1)
+        stats = {
+            "rate": 1 / self.period,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "deferred": self.tasks_run,
+        }
+        for pct, value in zip(
+            JITTER_PERCENTILES, np.percentile(lateness, JITTER_PERCENTILES)
+        ):
+            stats[f"jitter_p{pct}"] = float(value)
+        stats["jitter_max"] = float(lateness.max())
+        return stats
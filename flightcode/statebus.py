@@ -0,0 +1,217 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Shared memory ring buffers for passing fixed layout   |
+# |   | |/ _____ \| |   |  records between the flight processes. One process     |
+# |   | / /_   _\ \ |   |  writes, any number read, every record carries a       |
+# |  |_____|___|_____|  |  sequence number so readers can tell a whole record    |
+# |    \___________/    |  from one being overwritten, and nothing is pickled.   |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+from multiprocessing import shared_memory
+from time import monotonic, sleep
+
+import numpy as np
+
+from sampler import Snapshot
+
+# Sequence of the newest record, and the newest one the main reader is done with
+HEADER_DTYPE = np.dtype([("sequence", "<u8"), ("acknowledged", "<u8")])
+
+EVENT = 0
+ERROR = 1
+MESSAGE_SIZE = 240  # bytes, longer event messages are cut short
+EVENT_FIELDS = (("time", "<f8"), ("kind", "u1"), ("message", f"S{MESSAGE_SIZE}"))
+
+
+def float_fields(headers):
+    """ Record layout with a float64 field per header. """
+    return tuple((header, "<f8") for header in headers)
+
+
+class StateRing:
+    """ Single writer ring of records in a named shared memory block.
+
+        fields is a sequence of (name, numpy format) pairs. The creating process
+        passes create=True and unlinks the block when the flight is over, the
+        others attach to it by name. Sequence numbers start at 1. """
+
+    def __init__(self, name, fields, capacity=1024, create=False):
+        self.name = name
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.dtype = np.dtype(list(self.fields))
+        size = HEADER_DTYPE.itemsize + capacity * (8 + self.dtype.itemsize)
+        # Child processes share the creator's resource tracker, so attaching
+        # doesn't make them owners of the block
+        self.shm = shared_memory.SharedMemory(name, create=create, size=size)
+        self.owner = create
+
+        buf = self.shm.buf
+        self.header = np.ndarray((1,), HEADER_DTYPE, buf)
+        offset = HEADER_DTYPE.itemsize
+        self.sequences = np.ndarray((capacity,), "<u8", buf, offset)
+        offset += 8 * capacity
+        self.records = np.ndarray((capacity,), self.dtype, buf, offset)
+        if create:
+            self.header[0] = (0, 0)
+            self.sequences[:] = 0
+        self.count = int(self.header["sequence"][0])
+
+    def spec(self):
+        """ What another process needs to attach, as StateRing(*spec). """
+        return self.name, self.fields, self.capacity
+
+    # Writer side
+
+    def publish(self, values):
+        """ Append a record, overwriting the oldest once the ring is full. Returns
+            its sequence number. """
+        sequence = self.count + 1
+        slot = sequence % self.capacity
+        # Readers that see 0 here, or a different sequence after copying the
+        # record, know it was being written
+        self.sequences[slot] = 0
+        self.records[slot] = values
+        self.sequences[slot] = sequence
+        self.header["sequence"] = sequence
+        self.count = sequence
+        return sequence
+
+    # Reader side
+
+    @property
+    def sequence(self):
+        """ Sequence number of the newest record. """
+        return int(self.header["sequence"][0])
+
+    @property
+    def acknowledged(self):
+        return int(self.header["acknowledged"][0])
+
+    def acknowledge(self, sequence):
+        """ Tell the writer the main reader is done with records up to sequence. """
+        self.header["acknowledged"] = sequence
+
+    def read(self, sequence):
+        """ The record with this sequence number as a tuple, or None if it hasn't
+            been written or has already been overwritten. """
+        slot = sequence % self.capacity
+        if self.sequences[slot] != sequence:
+            return None
+        record = self.records[slot].item()
+        if self.sequences[slot] != sequence:
+            return None
+        return record
+
+    def latest(self):
+        """ (sequence, record) for the newest record, or (0, None). Retries if the
+            writer laps it mid read. """
+        while True:
+            sequence = self.sequence
+            if sequence == 0:
+                return 0, None
+            record = self.read(sequence)
+            if record is not None:
+                return sequence, record
+
+    def wait(self, after, timeout=None, poll=0.0002, stop=None):
+        """ Wait for a record newer than sequence `after`, returns the newest
+            sequence number, or None on timeout or once stop is set. """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            sequence = self.sequence
+            if sequence > after:
+                return sequence
+            if deadline is not None and monotonic() > deadline:
+                return None
+            if stop is not None and stop.is_set():
+                return None
+            sleep(poll)
+
+    def wait_acknowledged(self, sequence, timeout, poll=0.0002, stop=None):
+        """ Wait for the main reader to acknowledge sequence, returns False on
+            timeout or once stop is set. """
+        deadline = monotonic() + timeout
+        while self.acknowledged < sequence:
+            if monotonic() > deadline or (stop is not None and stop.is_set()):
+                return False
+            sleep(poll)
+        return True
+
+    def close(self):
+        del self.header, self.sequences, self.records
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class EventChannel:
+    """ Event log stand-in for a process without its own log file. event() and
+        error() go into a StateRing with EVENT_FIELDS for the logging process,
+        stamped with the system wide monotonic clock so events from different
+        processes can be put back in order. """
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def event(self, msg):
+        self.ring.publish((monotonic(), EVENT, str(msg).encode()))
+
+    def error(self, msg):
+        self.ring.publish((monotonic(), ERROR, str(msg).encode()))
+
+
+class RingSampler:
+    """ Sampler for the control process, handing out snapshots from the
+        acquisition process's ring. Asking for a sample acknowledges the last one,
+        which the acquisition process uses both to run in lock step and as the
+        control process's heartbeat.
+
+        With every=True each snapshot is handed out in turn, otherwise sample()
+        skips to the newest. Raises EOFError once stop is set. """
+
+    def __init__(self, ring, stop, every=True):
+        self.ring = ring
+        self.stop_event = stop
+        self.every = every
+        self.last = 0
+        self.time = None
+
+    def next_sequence(self):
+        newest = self.ring.wait(self.last, stop=self.stop_event)
+        if newest is None:
+            raise EOFError("acquisition stopped")
+        return self.last + 1 if self.every else newest
+
+    def sample(self) -> Snapshot:
+        self.ring.acknowledge(self.last)
+        while True:
+            sequence = self.next_sequence()
+            row = self.ring.read(sequence)
+            if row is not None:
+                break
+            if self.every:
+                # Overwritten before we got to it, carry on from the newest
+                self.last = self.ring.sequence - 1
+        self.last = sequence
+        t, ax, ay, az, qw, qx, qy, qz, alt, fresh = row
+        self.time = t
+        return Snapshot(sequence, t, (ax, ay, az), (qw, qx, qy, qz), alt, fresh != 0)
+
+    def clock(self):
+        """ Time of the last snapshot handed out, or of the next one before the
+            first is. """
+        if self.time is None:
+            row = self.ring.read(self.next_sequence())
+            if row is None:
+                row = self.ring.latest()[1]
+            return row[0]
+        return self.time
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.ring.acknowledge(self.last)
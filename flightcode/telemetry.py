@@ -0,0 +1,136 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Binary telemetry recorder. Rows are float64 records   |
+# |   | |/ _____ \| |   |  copied into a preallocated, memory-mapped file, so    |
+# |   | / /_   _\ \ |   |  logging a row is one copy and the file never grows    |
+# |  |_____|___|_____|  |  mid-flight. Run this file on a recording to turn it   |
+# |    \___________/    |  back into the usual tab-aligned text table.           |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import sys
+import numpy as np
+
+from logger import LOG_HEADER, log_file_name, format_table_header, format_table_row
+
+MAGIC = b"AIATLM01"
+SYNC_ROWS = 100  # rows between syncs to disk, a second at the 100 Hz loop rate
+
+# Fixed part of the header, followed by the tab separated column names. The
+# records start at the next 8 byte boundary after the names.
+HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S8"),
+        ("columns", "<u4"),
+        ("names_size", "<u4"),
+        ("capacity", "<u8"),
+        ("count", "<u8"),
+        ("dropped", "<u8"),
+    ]
+)
+
+
+def data_offset(names_size):
+    """ Byte offset of the first record. """
+    size = HEADER_DTYPE.itemsize + names_size
+    return (size + 7) // 8 * 8
+
+
+class TelemetryRecorder:
+    """ Appends fixed-width rows to a preallocated memory-mapped file.
+
+        With sync_every, the mapping is written to disk every that many rows, so
+        losing power mid-flight loses at most the rows since the last sync.
+        Without it, nothing is certain to be on disk before close(). Call
+        write_to_table from slack time, like the scheduler's deferred tasks,
+        since a sync waits on the disk. """
+
+    def __init__(self, prefix, headers, capacity=2 ** 16, sync_every=None):
+        self.headers = headers
+        self.capacity = capacity
+        self.sync_every = sync_every
+        self.file_name = log_file_name(prefix, "bin")
+
+        names = "\t".join(headers).encode()
+        offset = data_offset(len(names))
+        size = offset + capacity * len(headers) * 8
+
+        # Allocate the whole file up front so nothing grows during the flight
+        self.mmap = np.memmap(self.file_name, dtype=np.uint8, mode="w+", shape=(size,))
+        self.header = self.mmap[: HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        self.header["magic"] = MAGIC
+        self.header["columns"] = len(headers)
+        self.header["names_size"] = len(names)
+        self.header["capacity"] = capacity
+        names_start = HEADER_DTYPE.itemsize
+        names_end = names_start + len(names)
+        self.mmap[names_start:names_end] = np.frombuffer(names, np.uint8)
+        # Plain ndarray views of the same bytes, storing through a memmap or into a
+        # structured field costs several times more per row. count and dropped
+        # are kept as two plain integers.
+        records = self.mmap[offset:].view(np.ndarray)
+        self.records = records.view("<f8").reshape(capacity, len(headers))
+        counts_start = HEADER_DTYPE.fields["count"][1]
+        counts = self.mmap[counts_start : counts_start + 16].view(np.ndarray)
+        self.counts = counts.view("<u8")
+        self.count = 0
+        self.dropped = 0
+        self.closed = False
+
+    def write_to_table(self, data_tup: tuple):
+        """ Copy one row into the file. Rows past capacity are counted and dropped. """
+        if self.count < self.capacity:
+            self.records[self.count] = data_tup
+            self.count += 1
+            self.counts[0] = self.count
+            if self.sync_every and self.count % self.sync_every == 0:
+                self.sync()
+        else:
+            self.dropped += 1
+            self.counts[1] = self.dropped
+
+    def sync(self):
+        """ Write the rows and the header counts out to disk. """
+        self.mmap.flush()
+
+    def close(self):
+        if not self.closed:
+            self.mmap.flush()
+            del self.records, self.header, self.counts, self.mmap
+            self.closed = True
+
+
+def read_recording(file_name):
+    """ Load a recording, returns the headers and the rows that were written. """
+    raw = np.memmap(file_name, dtype=np.uint8, mode="r")
+    header = raw[: HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError(f"{file_name} is not a telemetry recording")
+    columns = int(header["columns"])
+    names_size = int(header["names_size"])
+    names = bytes(raw[HEADER_DTYPE.itemsize : HEADER_DTYPE.itemsize + names_size])
+    offset = data_offset(names_size)
+    records = raw[offset:].view("<f8").reshape(int(header["capacity"]), columns)
+    return tuple(names.decode().split("\t")), records[: int(header["count"])]
+
+
+def convert_to_table(file_name, out_name=None):
+    """ Write a recording out as the tab-aligned text table Logger produces. """
+    headers, records = read_recording(file_name)
+    if out_name is None:
+        out_name = file_name.rsplit(".", 1)[0] + ".txt"
+    with open(out_name, "w") as out:
+        out.write(LOG_HEADER)
+        out.write(format_table_header(headers))
+        for row in records.tolist():
+            out.write(format_table_row(headers, row))
+    return out_name
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python telemetry.py DATA-<time>.bin [output.txt]")
+        sys.exit(1)
+    out_name = sys.argv[2] if len(sys.argv) > 2 else None
+    print(f"Wrote {convert_to_table(sys.argv[1], out_name)}")
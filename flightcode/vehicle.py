@@ -1,17 +1,45 @@
-import adafruit_bno055 as bno055
-import adafruit_mpl3115a2 as mpl3115a2
-from adafruit_servokit import ServoKit
+# Sensor and servo objects are handed in by a backend (see backend.py), so this
+# module doesn't import the adafruit drivers and can run off the Pi. Everything
+# that needs sensor data works from a sampler.Snapshot taken once per cycle.
+from abc import ABC, abstractmethod
 from time import monotonic
 from enum import IntEnum
 from math import log, fabs
-from numpy import array, ndarray, asarray
+from numpy import array, ndarray, zeros
+from rotation import rotate
 
 GRAV = 32.174
 METERSTOFEET = 3.2808399
 
-VELOCITY = ndarray(shape=(1, 3))
-POSITION: ndarray = ndarray(shape=(1, 3))
-ALTITUDE: float = 0
+ACCELERATION: ndarray = zeros(3)  # reused by inertial_acceleration by default
+
+# FlightState layout, offsets into its buffer. The first RECORD_SIZE values are a
+# DATA row in control.DATA_HEADERS order, so the row is logged straight from it
+TIME = 0  # seconds since the coast began
+ACCEL = 1  # inertial x, y, z
+VELOC = 4
+POS = 7  # x, y, then the estimated altitude
+PID_OUTPUT = 10
+PROJECTED_ALT = 11
+RECORD_SIZE = 12
+ESTIMATE = 12  # AltitudeEstimator memory, state then covariance
+ESTIMATE_SIZE = 12
+PID_MEMORY = 24  # PID memory, last error, integral and output
+PID_SIZE = 3
+COAST_START = 27
+MODE = 28  # Runmode value
+LAUNCH_DETECTOR = 29  # detector memory, see PersistenceDetector
+BURNOUT_DETECTOR = 33
+APOGEE_DETECTOR = 37
+DETECTOR_SIZE = 4
+STATE_SIZE = 41
+HISTORY = 512  # saved rows, twice the scheduler's deferred backlog limit
+
+# Pad altitude averaging, see init_current_altitude
+PAD_SAMPLES = 20  # fresh altimeter readings averaged on the pad
+PAD_TIMEOUT = 3.0  # seconds, at most
+WARM_SAMPLES = 5  # readings that do when they agree with the calibration cache
+WARM_TOLERANCE = 10.0  # feet
 
 # Different modes of operation during flight
 class Runmode(IntEnum):
@@ -35,108 +63,278 @@ def sqr(x):
     return x * x
 
 
-def move_servos(servoKit: ServoKit, degrees):
+def move_servos(servoKit, degrees):
     """ Move servos to specified degrees. """
     for servo in servoKit.servo:
         servo.angle = degrees
 
 
-def verify_launch(mpl: mpl3115a2.MPL3115A2, threshold_alt):
-    """ Make sure vehicle has actually launched. """
-    has_launched = True
-    current_time = monotonic()
-    while fabs(monotonic() - current_time) < 0.5:
-        alt = altitude(mpl)
-        if alt < threshold_alt:
-            has_launched = False
-    return has_launched
-
-
-def verify_burnout(bno: bno055.BNO055):
-    has_burntout = True
-    c_time = monotonic()
-    while fabs(monotonic() - c_time) < 0.5:
-        accel = inertial_acceleration(bno)
-        if accel[2] > 0:
-            has_burntout = True
-            break
-    return has_burntout
-
+class PersistenceDetector(ABC):
+    """ Streaming flight event detector. Fed one sample per control cycle, it fires
+        once its condition has held on every sample for `window` seconds. Nothing
+        blocks, so the control loop keeps running while an event is being confirmed.
+        After firing, `latency` is how long the decision took from the first sample
+        that met the condition. Subclasses define condition(), one without it
+        can't be built. """
+
+    def __init__(self, window=0.5, memory=None):
+        """ What carries over between samples is kept in memory, DETECTOR_SIZE
+            values updated in place, like a slice of a FlightState: the time of
+            the first sample in the current run, the samples in it, 1 once
+            detected and the latency. All zeros is a detector that has seen
+            nothing. It's a list of its own unless one is handed in. """
+        self.window = window
+        if memory is None:
+            memory = [0.0] * DETECTOR_SIZE
+        self.memory = memory
+        self.reset()
+
+    @property
+    def onset(self):
+        """ Time of the first sample in the current run, or None. """
+        memory = self.memory
+        return memory[0] if memory[1] else None
+
+    @property
+    def samples(self):
+        return int(self.memory[1])
+
+    @property
+    def detected(self):
+        return bool(self.memory[2])
+
+    @property
+    def latency(self):
+        memory = self.memory
+        return memory[3] if memory[2] else None
+
+    @abstractmethod
+    def condition(self, value):
+        """ True if this sample meets the event's condition. """
+
+    def update(self, time, value):
+        """ Feed the latest sample, returns True once the event is confirmed. """
+        memory = self.memory
+        if memory[2]:
+            return True
+        if not self.condition(value):
+            memory[1] = 0
+            return False
+        if not memory[1]:
+            memory[0] = time
+        memory[1] += 1
+        elapsed = time - memory[0]
+        if elapsed >= self.window:
+            memory[2] = 1
+            memory[3] = elapsed
+            return True
+        return False
+
+    def reset(self):
+        memory = self.memory
+        memory[0] = memory[1] = memory[2] = memory[3] = 0
+
+
+class LaunchDetector(PersistenceDetector):
+    """ Altitude stays above the launch threshold. """
+
+    def __init__(self, threshold_alt, window=0.5, memory=None):
+        super().__init__(window, memory)
+        self.threshold_alt = threshold_alt
+
+    def condition(self, alt):
+        return alt >= self.threshold_alt
+
+
+class BurnoutDetector(PersistenceDetector):
+    """ Vertical acceleration stays negative once the motor stops pushing. """
+
+    def condition(self, vertical_accel):
+        return vertical_accel < 0
+
+
+class ApogeeDetector(PersistenceDetector):
+    """ Vertical velocity stays below -hysteresis ft/s, so altimeter noise around
+        zero velocity near the top doesn't trigger it early. """
+
+    def __init__(self, window=0.5, hysteresis=0, memory=None):
+        super().__init__(window, memory)
+        self.hysteresis = hysteresis
+
+    def condition(self, vertical_veloc):
+        return vertical_veloc < -self.hysteresis
+
+
+class FlightState:
+    """ Everything a flight carries from one control cycle to the next: the DATA
+        row, the estimator's state and covariance, the PID memory, the coast
+        start, the mode and the launch, burnout and apogee detectors. It's kept
+        in one preallocated buffer of doubles that the functions below, the
+        estimator, the PID and the detectors update in place. Views into it are
+        made once and values are stored through them, so a cycle doesn't build
+        new lists or arrays to carry its state. The snapshot a cycle works from
+        is made by the sampler and isn't part of it.
+
+        record is the DATA row part of the buffer. save() copies it into the
+        next of `history` preallocated rows, kept outside the buffer with the
+        plain count of saves, and returns that row, which stays intact for
+        `history` more saves, long enough for deferred logging. """
+
+    __slots__ = (
+        "buffer",
+        "memory",
+        "record",
+        "acceleration",
+        "velocity",
+        "position",
+        "estimate",
+        "pid",
+        "launch",
+        "burnout",
+        "apogee",
+        "rows",
+        "saved",
+    )
 
-def verify_apogee(mpl: mpl3115a2.MPL3115A2, dt):
-    is_descending = True
-    c_time = monotonic()
-    while fabs(monotonic() - c_time) < 0.5:
-        velocity = vertical_velocity(mpl, dt)
-        if velocity > 0:
-            is_descending = False
+    def __init__(self, history=HISTORY):
+        self.buffer = zeros(STATE_SIZE)
+        memory = self.memory = memoryview(self.buffer)
+        self.record = memory[:RECORD_SIZE]
+        self.acceleration = memory[ACCEL : ACCEL + 3]
+        self.velocity = memory[VELOC : VELOC + 3]
+        self.position = memory[POS : POS + 3]
+        self.estimate = memory[ESTIMATE : ESTIMATE + ESTIMATE_SIZE]
+        self.pid = memory[PID_MEMORY : PID_MEMORY + PID_SIZE]
+        self.launch = memory[LAUNCH_DETECTOR : LAUNCH_DETECTOR + DETECTOR_SIZE]
+        self.burnout = memory[BURNOUT_DETECTOR : BURNOUT_DETECTOR + DETECTOR_SIZE]
+        self.apogee = memory[APOGEE_DETECTOR : APOGEE_DETECTOR + DETECTOR_SIZE]
+        self.rows = [memoryview(row) for row in zeros((history, RECORD_SIZE))]
+        self.reset()
+
+    def reset(self):
+        """ Back to STANDBY with everything zeroed. """
+        self.buffer[:] = 0
+        self.saved = 0
+
+    @property
+    def mode(self):
+        return Runmode(int(self.memory[MODE]))
+
+    @mode.setter
+    def mode(self, mode):
+        self.memory[MODE] = mode
+
+    @property
+    def coast_start(self):
+        return self.memory[COAST_START]
+
+    @coast_start.setter
+    def coast_start(self, time):
+        self.memory[COAST_START] = time
+
+    def save(self):
+        """ Copy the record into the next saved row and return it. """
+        row = self.rows[self.saved % len(self.rows)]
+        row[:] = self.record
+        self.saved += 1
+        return row
+
+
+def init_current_altitude(
+    sampler, clock=monotonic, samples=PAD_SAMPLES, timeout=PAD_TIMEOUT, expected=None
+):
+    """ Average the altitude on the launchpad over `samples` fresh altimeter
+        readings, or over those that came in within timeout seconds. Repeated
+        altitudes between readings aren't counted. Given the altitude expected
+        from the calibration cache, WARM_SAMPLES readings are enough if they
+        average within WARM_TOLERANCE feet of it. Returns the average in feet
+        and the number of readings in it. """
+    start = clock()
+    total = 0.0
+    count = 0
+    last = None
+    while count < samples:
+        snapshot = sampler.sample()
+        if snapshot.altitude_fresh and snapshot.count != last:
+            total += altitude(snapshot)
+            count += 1
+            if (
+                count == WARM_SAMPLES
+                and expected is not None
+                and fabs(total / count - expected) <= WARM_TOLERANCE
+            ):
+                break
+        last = snapshot.count
+        if clock() - start >= timeout:
+            if not count:
+                total, count = altitude(snapshot), 1
             break
-    return is_descending
+    return total / count, count
 
 
-def init_current_altitude(mpl: mpl3115a2.MPL3115A2):
-    """ Get an average of the current altitude on the launchpad. """
-    current_time = monotonic()
-    data = list()
-    while fabs(monotonic() - current_time) > 3:
-        data.append(mpl.altitude * METERSTOFEET)
-    return sum(data) / len(data)
-
-
-def altitude(mpl: mpl3115a2.MPL3115A2):
+def altitude(snapshot):
     """ Return altitude in feet instead of meters. """
-    return mpl.altitude * METERSTOFEET
+    return snapshot.altitude * METERSTOFEET
 
 
-def inertial_acceleration(bno: bno055.BNO055) -> ndarray:
-    """ Return the inertial of the vehicle, in feet per second. """
-    accel = asarray(bno.acceleration).T  # .T to convert row vector to column vector
-    t_matrix = vehicle_to_inertial(bno.quaternion)
-    inertial_accel = t_matrix * accel
-    return inertial_accel * METERSTOFEET
+def inertial_acceleration(snapshot, out=ACCELERATION):
+    """ Return the inertial acceleration of the vehicle, in feet per second squared.
+        The BNO055 measures specific force, +1 g up while sitting on the pad, so
+        gravity is taken back out of the vertical component. It's written into
+        out, the same array on every call by default, copy it to keep it. """
+    accel = snapshot.acceleration
+    rotate(snapshot.quaternion, accel, METERSTOFEET, out)
+    out[2] -= GRAV
+    return out
 
 
 def vehicle_to_inertial(quaternion: tuple):
     """ Create a transformation matrix. 
-        a, b, c, d are given from quaternions supplied by the bno055. """
+        a, b, c, d are given from quaternions supplied by the bno055.
+        rotation.rotate applies the same rotation without building it. """
     a = quaternion[0]
     b = quaternion[1]
     c = quaternion[2]
     d = quaternion[3]
     return array(
         [
-            sqr(a) + sqr(b) - sqr(c) - sqr(d),
-            2 * b * c - 2 * a * d,
-            2 * b * d + 2 * a * c,
-        ],
-        [
-            2 * b * c + 2 * a * d,
-            sqr(a) - sqr(b) + sqr(c) - sqr(d),
-            2 * c * d - 2 * a * b,
-        ],
-        [
-            2 * b * d - 2 * a * c,
-            2 * c * d + 2 * a * b,
-            sqr(a) - sqr(b) - sqr(c) + sqr(d),
-        ],
+            [
+                sqr(a) + sqr(b) - sqr(c) - sqr(d),
+                2 * b * c - 2 * a * d,
+                2 * b * d + 2 * a * c,
+            ],
+            [
+                2 * b * c + 2 * a * d,
+                sqr(a) - sqr(b) + sqr(c) - sqr(d),
+                2 * c * d - 2 * a * b,
+            ],
+            [
+                2 * b * d - 2 * a * c,
+                2 * c * d + 2 * a * b,
+                sqr(a) - sqr(b) - sqr(c) + sqr(d),
+            ],
+        ]
     )
 
 
-def velocity(mpl: mpl3115a2.MPL3115A2, acceleration: ndarray, dt):
-    VELOCITY += acceleration * dt
-    VELOCITY[2] = vertical_velocity(mpl, dt)
-    return VELOCITY
-
-
-def position(velocity: ndarray, dt):
-    POSITION += velocity * dt
-    return POSITION
+def velocity(state: FlightState, acceleration, vertical_veloc, dt):
+    """ Integrate the state's horizontal velocity, vertical comes from the
+        estimator. """
+    veloc = state.velocity
+    veloc[0] += acceleration[0] * dt
+    veloc[1] += acceleration[1] * dt
+    veloc[2] = vertical_veloc
+    return veloc
 
 
-def vertical_velocity(mpl: mpl3115a2.MPL3115A2, dt):
-    veloc = (mpl.altitude - ALTITUDE) / dt
-    ALTITUDE = mpl.altitude
-    return veloc
+def position(state: FlightState, velocity, alt, dt):
+    """ Integrate the state's horizontal position, altitude comes from the
+        estimator. """
+    pos = state.position
+    pos[0] += velocity[0] * dt
+    pos[1] += velocity[1] * dt
+    pos[2] = alt
+    return pos
 
 
 def projected_altitude(accel, veloc, alt):
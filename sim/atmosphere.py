@@ -9,7 +9,11 @@
 # |                     |  at different altitudes.                               |
 # +------------------------------------------------------------------------------+
 
+import os
+import numpy as np
+
 FTORANK = 459.67
+TABLE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 class Atmosphere:
@@ -24,3 +28,99 @@ class Atmosphere:
         press = self.pressure(altitude)
         temp = self.temperature(altitude)
         return press / (1718 * (temp + FTORANK))
+
+
+class AtmosphereTable:
+    """ Same interface as Atmosphere, NumPy arrays are answered by linear
+        interpolation in a table built from it once (and cached as a .npy file
+        next to this one), altitudes outside the table are clamped to its ends.
+        Plain numbers go straight to the formulas, which beat any Python lookup
+        one value at a time.
+
+        Interpolation error is at most step^2 / 8 times the largest second
+        derivative. At the default 10 ft spacing temperature is exact and pressure
+        and density are within 3e-8 of the formulas, relative, up to 40,000 ft;
+        max_error() measures it for any table. """
+
+    def __init__(self, min_alt=0, max_alt=40000, step=10, cache=True):
+        self.step = step
+        self.altitudes = np.arange(min_alt, max_alt + step, step, dtype=float)
+
+        file_name = os.path.join(
+            TABLE_DIR, f"atmosphere-{min_alt}-{max_alt}-{step}.npy"
+        )
+        self.table = self.load(file_name) if cache else None
+        if self.table is None:
+            reference = Atmosphere()
+            self.table = np.array(
+                [
+                    reference.temperature(self.altitudes),
+                    reference.pressure(self.altitudes),
+                    reference.density(self.altitudes),
+                ]
+            )
+            if cache:
+                self.save(file_name)
+        self.reference = Atmosphere()
+
+    def load(self, file_name):
+        """ The cached table, or None if it's missing, unreadable or doesn't fit
+            these altitudes, so it gets rebuilt. """
+        try:
+            table = np.load(file_name)
+        except (OSError, ValueError, EOFError):
+            return None
+        if table.shape != (3, len(self.altitudes)):
+            return None
+        return table
+
+    def save(self, file_name):
+        """ Write to a temporary file and rename it over the cache, so parallel
+            workers building the same table never read half of one. """
+        temporary = f"{file_name}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "wb") as f:
+                np.save(f, self.table)
+            os.replace(temporary, file_name)
+        except OSError:
+            # Only a cache, the next run can try again
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def lookup(self, row, altitude):
+        return np.interp(altitude, self.altitudes, self.table[row])
+
+    def temperature(self, altitude):
+        if isinstance(altitude, np.ndarray):
+            return self.lookup(0, altitude)
+        return self.reference.temperature(altitude)
+
+    def pressure(self, altitude):
+        if isinstance(altitude, np.ndarray):
+            return self.lookup(1, altitude)
+        return self.reference.pressure(altitude)
+
+    def density(self, altitude):
+        if isinstance(altitude, np.ndarray):
+            return self.lookup(2, altitude)
+        return self.reference.density(altitude)
+
+    def max_error(self):
+        """ Largest relative error against Atmosphere for temperature (in Rankine),
+            pressure and density, checked halfway between table points. """
+        reference = Atmosphere()
+        mid = self.altitudes[:-1] + self.step / 2
+        temp = reference.temperature(mid) + FTORANK
+        return {
+            "temperature": np.max(
+                np.abs(self.temperature(mid) + FTORANK - temp) / temp
+            ),
+            "pressure": np.max(
+                np.abs(self.pressure(mid) - reference.pressure(mid))
+                / reference.pressure(mid)
+            ),
+            "density": np.max(
+                np.abs(self.density(mid) - reference.density(mid))
+                / reference.density(mid)
+            ),
+        }
@@ -0,0 +1,397 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Integrators for the simulator: explicit Euler, fixed  |
+# |   | |/ _____ \| |   |  step RK4 and adaptive Dormand-Prince RK45, with zero  |
+# |   | / /_   _\ \ |   |  crossing events (apogee, flight phase changes) found  |
+# |  |_____|___|_____|  |  by root finding on the step's interpolant instead of  |
+# |    \___________/    |  ending a step late. Run this file to compare their    |
+# |                     |  apogee accuracy and CPU time on a coast.              |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+from math import inf, sqrt
+
+# Dormand-Prince 5(4) tableau. The last stage is evaluated at the new state, so it
+# doubles as the first stage of the next step and a step costs 6 evaluations
+DP_C = (0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1)
+DP_A = (
+    (),
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (44 / 45, -56 / 15, 32 / 9),
+    (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+    (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+)
+DP_B = (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84)
+# Difference between the 5th and the embedded 4th order solution, per stage
+DP_E = (71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
+
+def combine(y, h, terms):
+    """ y + h * sum(weight * k) over (weight, k) terms, component by component.
+        Components can be floats or NumPy arrays. """
+    terms = [(weight, k) for weight, k in terms if weight]
+    return tuple(
+        yi + h * sum(weight * k[i] for weight, k in terms)
+        for i, yi in enumerate(y)
+    )
+
+
+def hermite(t0, y0, k0, t1, y1, k1, t):
+    """ Cubic Hermite interpolation of the state between two step ends, from the
+        states and their derivatives there. """
+    h = t1 - t0
+    s = (t - t0) / h
+    s2 = s * s
+    s3 = s2 * s
+    h00 = 2 * s3 - 3 * s2 + 1
+    h10 = (s3 - 2 * s2 + s) * h
+    h01 = 3 * s2 - 2 * s3
+    h11 = (s3 - s2) * h
+    return tuple(
+        h00 * a + h10 * da + h01 * b + h11 * db
+        for a, da, b, db in zip(y0, k0, y1, k1)
+    )
+
+
+class Event:
+    """ A zero crossing of function(t, y) to find while integrating. direction is
+        1 for crossings going up, -1 for going down and 0 for either. A terminal
+        event ends the step where it happens, so whatever the derivative depends
+        on can change there, e.g. the flight phase. """
+
+    def __init__(self, name, function, direction=0, terminal=False):
+        self.name = name
+        self.function = function
+        self.direction = direction
+        self.terminal = terminal
+
+    def crossed(self, g0, g1):
+        if self.direction >= 0 and g0 < 0 <= g1:
+            return True
+        return self.direction <= 0 and g0 > 0 >= g1
+
+
+class Integrator:
+    """ Steps dy/dt = f(t, y), where y is a tuple of floats and f returns a tuple
+        the same length. Fixed step integrators also take tuples of NumPy arrays,
+        to integrate many cases at once. `evaluations` counts calls of f. """
+
+    name = None
+    adaptive = False
+    evaluations_per_step = 1
+
+    def __init__(self, step=0.01):
+        self.step = step
+        self.evaluations = 0
+        self.steps = 0
+
+    def derivative(self, f, t, y):
+        self.evaluations += 1
+        return f(t, y)
+
+    def attempt(self, f, t, y, k, h):
+        """ One step of h from (t, y) with k = f(t, y). Returns the new state, its
+            derivative and the error ratio, 1 being the tolerance, or 0 for fixed
+            step integrators. """
+        raise NotImplementedError
+
+    def take(self, f, t, y, k, limit=inf):
+        """ Take one step, no further than time limit. Returns (h, y, k). """
+        h = min(self.step, limit - t)
+        y1, k1, _ = self.attempt(f, t, y, k, h)
+        self.steps += 1
+        return h, y1, k1
+
+
+class Euler(Integrator):
+    name = "euler"
+
+    def attempt(self, f, t, y, k, h):
+        y1 = tuple(yi + h * ki for yi, ki in zip(y, k))
+        self.evaluations += 1
+        return y1, f(t + h, y1), 0.0
+
+
+class RK4(Integrator):
+    """ Classic fourth order Runge-Kutta. The derivative at the end of each step
+        is the first stage of the next one, so a step costs 4 evaluations. """
+
+    name = "rk4"
+    evaluations_per_step = 4
+
+    def attempt(self, f, t, y, k1, h):
+        half = h / 2
+        k2 = f(t + half, tuple(yi + half * ki for yi, ki in zip(y, k1)))
+        k3 = f(t + half, tuple(yi + half * ki for yi, ki in zip(y, k2)))
+        k4 = f(t + h, tuple(yi + h * ki for yi, ki in zip(y, k3)))
+        sixth = h / 6
+        y1 = tuple(
+            yi + sixth * (a + 2 * (b + c) + d)
+            for yi, a, b, c, d in zip(y, k1, k2, k3, k4)
+        )
+        self.evaluations += 4
+        return y1, f(t + h, y1), 0.0
+
+
+class RK45(Integrator):
+    """ Adaptive Dormand-Prince 5(4). Each step's error estimate is kept within
+        atol + rtol * |y| per component, RMS over the components, by shrinking
+        or growing the step. step is the first step to try. """
+
+    name = "rk45"
+    adaptive = True
+    evaluations_per_step = 6
+
+    def __init__(self, step=0.01, rtol=1e-6, atol=1e-6, max_step=1.0, min_step=1e-9):
+        super().__init__(step)
+        self.rtol = rtol
+        self.atol = atol
+        self.max_step = max_step
+        self.min_step = min_step
+        self.rejected = 0
+
+    def attempt(self, f, t, y, k, h):
+        stages = [k]
+        for c, row in zip(DP_C[1:], DP_A[1:]):
+            stages.append(f(t + c * h, combine(y, h, zip(row, stages))))
+        y1 = combine(y, h, zip(DP_B, stages))
+        k7 = f(t + h, y1)
+        stages.append(k7)
+        self.evaluations += 6
+
+        error = combine((0.0,) * len(y), h, zip(DP_E, stages))
+        total = 0.0
+        for e, a, b in zip(error, y, y1):
+            scale = self.atol + self.rtol * max(abs(a), abs(b))
+            total += (e / scale) ** 2
+        return y1, k7, sqrt(total / len(y))
+
+    def take(self, f, t, y, k, limit=inf):
+        h = min(self.step, self.max_step)
+        while True:
+            last = t + h >= limit
+            if last:
+                h = limit - t
+            y1, k1, error = self.attempt(f, t, y, k, h)
+            if error <= 1 or h <= self.min_step:
+                break
+            self.rejected += 1
+            h = max(h * max(0.2, 0.9 * error ** -0.2), self.min_step)
+
+        # Next step from this one's error, kept if it was only cut short by limit
+        growth = 5.0 if error == 0 else min(5.0, max(0.2, 0.9 * error ** -0.2))
+        if not last or h * growth < self.step:
+            self.step = min(h * growth, self.max_step)
+        self.steps += 1
+        return h, y1, k1
+
+
+INTEGRATORS = {cls.name: cls for cls in (Euler, RK4, RK45)}
+
+
+def create_integrator(name, **kwargs):
+    """ Look up an integrator by name and create it. """
+    try:
+        return INTEGRATORS[name](**kwargs)
+    except KeyError:
+        raise ValueError(
+            f"Unknown integrator '{name}', expected one of {list(INTEGRATORS)}"
+        )
+
+
+def locate(event, t0, y0, k0, t1, y1, k1, g0, g1, tolerance=1e-10):
+    """ Time and state of event's zero crossing inside a step, by Illinois
+        regula falsi on the step's Hermite interpolant. """
+    a, ga, b, gb = t0, g0, t1, g1
+    t, y = t1, y1
+    side = 0
+    for _ in range(100):
+        t = (a * gb - b * ga) / (gb - ga)
+        y = hermite(t0, y0, k0, t1, y1, k1, t)
+        g = event.function(t, y)
+        if g == 0 or b - a < tolerance:
+            break
+        if (g > 0) == (gb > 0):
+            b, gb = t, g
+            if side == -1:
+                ga /= 2
+            side = -1
+        else:
+            a, ga = t, g
+            if side == 1:
+                gb /= 2
+            side = 1
+    return t, y
+
+
+class Trajectory:
+    """ Integrates on demand. at(t) steps only as far as needed to reach t and
+        interpolates inside the last step, so the caller can ask for the state as
+        often as it likes at no extra cost.
+
+        Events are checked on every step. Non-terminal ones are kept in `found` as
+        (event, time, state). A terminal one ends the step at its time, and
+        on_event(event, time, state) is called with it once the trajectory moves
+        past, returning the state to carry on from. restart(t) throws away
+        everything after t, for when something f depends on changes at t. """
+
+    def __init__(self, f, t, y, integrator, events=(), on_event=None):
+        self.f = f
+        self.integrator = integrator
+        self.events = list(events)
+        self.on_event = on_event
+        self.found = []
+        self.pending = None
+        self.t0 = self.t1 = t
+        self.restart(t, y)
+
+    def restart(self, t, y=None):
+        if self.pending is not None and self.pending[1] <= t:
+            self.commit()
+        if y is None:
+            y = self.at(t)
+        self.found = [found for found in self.found if found[1] <= t]
+        self.pending = None
+        self.t0 = self.t1 = t
+        self.y0 = self.y1 = y
+        self.k0 = self.k1 = self.integrator.derivative(self.f, t, y)
+
+    def at(self, t):
+        """ State at time t, which can't be before the last restart. """
+        while t > self.t1:
+            self.advance()
+        if t == self.t1:
+            return self.y1
+        return hermite(self.t0, self.y0, self.k0, self.t1, self.y1, self.k1, t)
+
+    def commit(self):
+        """ Carry on from the pending terminal event. """
+        event, t, y = self.pending
+        if self.on_event is not None:
+            y = self.on_event(event, t, y)
+        self.pending = None
+        self.restart(t, y)
+
+    def advance(self):
+        if self.pending is not None:
+            self.commit()
+
+        f = self.f
+        integrator = self.integrator
+        t0, y0, k0 = self.t1, self.y1, self.k1
+        h, y1, k1 = integrator.take(f, t0, y0, k0)
+        t1 = t0 + h
+
+        crossings = []
+        for event in self.events:
+            g0 = event.function(t0, y0)
+            g1 = event.function(t1, y1)
+            if event.crossed(g0, g1):
+                time, state = locate(event, t0, y0, k0, t1, y1, k1, g0, g1)
+                crossings.append((time, event, state))
+        crossings.sort(key=lambda crossing: crossing[0])
+        for time, event, state in crossings:
+            if event.terminal:
+                # Redo the step to end exactly there, so none of it sees past it
+                h = time - t0
+                if h > 0:
+                    y1, k1, _ = integrator.attempt(f, t0, y0, k0, h)
+                else:
+                    y1, k1 = y0, k0
+                t1 = t0 + h
+                self.pending = (event, t1, y1)
+                break
+            self.found.append((event, time, state))
+
+        self.t0, self.y0, self.k0 = t0, y0, k0
+        self.t1, self.y1, self.k1 = t1, y1, k1
+
+
+def solve(f, t, y, end, integrator, events=()):
+    """ Integrate from (t, y) to time end, or to the first terminal event.
+        Returns (time, state, found), found being (event, time, state) for every
+        event on the way, the terminal one last. """
+    trajectory = Trajectory(f, t, y, integrator, events)
+    while trajectory.t1 < end and trajectory.pending is None:
+        trajectory.advance()
+    if trajectory.pending is not None:
+        trajectory.found.append(trajectory.pending)
+        _, t, y = trajectory.pending
+        return t, y, trajectory.found
+    return end, trajectory.at(end), trajectory.found
+
+
+if __name__ == "__main__":
+    import argparse
+    from time import process_time
+
+    import sim
+    from atmosphere import Atmosphere
+
+    parser = argparse.ArgumentParser(
+        description="Apogee accuracy against CPU time for each integrator"
+    )
+    parser.add_argument("--altitude", type=float, default=1000, help="ft at burnout")
+    parser.add_argument("--velocity", type=float, default=700, help="ft/s at burnout")
+    parser.add_argument("--input", type=float, default=0.5, help="plate input, 0 to 1")
+    args = parser.parse_args()
+
+    atmosphere = Atmosphere()
+
+    def coast(t, y):
+        altitude, velocity = y
+        density = atmosphere.density(altitude)
+        return velocity, sim.acceleration(velocity, density, args.input)
+
+    apogee = Event("apogee", lambda t, y: y[1], direction=-1, terminal=True)
+    start = (float(args.altitude), float(args.velocity))
+
+    def run(integrator):
+        """ (apogee, evaluations, CPU seconds), the apogee as found by the event. """
+        begin = process_time()
+        repeats = 0
+        while True:
+            integrator.evaluations = 0
+            _, state, _ = solve(coast, 0.0, start, 600.0, integrator, [apogee])
+            repeats += 1
+            elapsed = process_time() - begin
+            if elapsed > 0.2:
+                return state[0], integrator.evaluations, elapsed / repeats
+
+    def sweep_euler_end(step):
+        """ sim.py's old loop: Euler until velocity goes negative. """
+        altitude, velocity = start
+        evaluations = 0
+        while velocity > 0:
+            _, accel = coast(0, (altitude, velocity))
+            evaluations += 1
+            altitude += velocity * step
+            velocity += accel * step
+        return altitude, evaluations
+
+    reference = run(RK45(rtol=1e-13, atol=1e-13, max_step=0.5))[0]
+    print(f"Coast from {args.altitude:,.0f} ft at {args.velocity:,.0f} ft/s, "
+          f"plate input {args.input:g}")
+    print(f"Reference apogee (RK45 at 1e-13): {reference:,.6f} ft\n")
+    print(f"{'Integrator':<26}{'evaluations':>12}{'CPU (ms)':>10}{'error (ft)':>14}")
+
+    def report(label, result):
+        alt, evaluations, cpu = result
+        print(f"{label:<26}{evaluations:>12,}{cpu * 1000:>10.3f}"
+              f"{abs(alt - reference):>14.2e}")
+
+    for step in (0.01, 0.001):
+        alt, evaluations = sweep_euler_end(step)
+        print(f"{f'sim.py loop, {step:g} s':<26}{evaluations:>12,}{'':>10}"
+              f"{abs(alt - reference):>14.2e}")
+    for step in (0.01, 0.001, 0.0001):
+        report(f"Euler, {step:g} s", run(Euler(step)))
+    for step in (0.5, 0.1, 0.01):
+        report(f"RK4, {step:g} s", run(RK4(step)))
+    for tolerance in (1e-4, 1e-6, 1e-8):
+        report(
+            f"RK45, tolerance {tolerance:g}",
+            run(RK45(rtol=tolerance, atol=tolerance, max_step=10)),
+        )
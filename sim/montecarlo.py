@@ -0,0 +1,205 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Monte Carlo dispersion study. Runs thousands of       |
+# |   | |/ _____ \| |   |  coast phases at once as NumPy arrays, using the drag  |
+# |   | / /_   _\ \ |   |  model from sim.py and the flight code's PID and       |
+# |  |_____|___|_____|  |  projected altitude, and reports how the apogees are   |
+# |    \___________/    |  spread around the target.                             |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+import sim
+from atmosphere import AtmosphereTable
+from pid import PID
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+
+class Dispersion:
+    """ Nominal value and standard deviation of everything that varies per case. """
+
+    def __init__(
+        self,
+        altitude=(1000, 0),
+        velocity=(700, 25),
+        mass=(sim.MASS, 0.02),
+        cd=(sim.CD, 0.05),
+        wind=(0, 15),
+        altitude_noise=1.0,
+        velocity_noise=2.0,
+        accel_noise=1.0,
+    ):
+        self.altitude = altitude  # ft
+        self.velocity = velocity  # ft/s, at burnout
+        self.mass = mass
+        self.cd = cd
+        self.wind = wind  # ft/s, horizontal
+        # Standard deviations of the sensor noise the controller sees
+        self.altitude_noise = altitude_noise
+        self.velocity_noise = velocity_noise
+        self.accel_noise = accel_noise
+
+    def sample(self, cases, rng):
+        """ Draw the initial conditions and vehicle parameters for every case. """
+
+        def draw(param):
+            nominal, spread = param
+            return rng.normal(nominal, spread, cases)
+
+        return {
+            "altitude": draw(self.altitude),
+            "velocity": draw(self.velocity),
+            "mass": draw(self.mass),
+            "cd": draw(self.cd),
+            "wind": draw(self.wind),
+        }
+
+
+class BatchPID(PID):
+    """ The flight PID, clamping elementwise so it can drive every case at once. """
+
+    def clamp(self, value):
+        return np.clip(value, self.min_output, self.max_output)
+
+
+def batch_projected_altitude(accel, veloc, alt):
+    """ vehicle.projected_altitude on arrays, 0 wherever the formula is undefined. """
+    valid = (accel < 0) & (accel != -sim.GRAV)
+    ratio = np.where(valid, -accel / sim.GRAV, 1.0)
+    denom = np.where(valid, 2 * (accel + sim.GRAV), 1.0)
+    return np.where(valid, -((veloc ** 2) / denom) * np.log(ratio) + alt, 0.0)
+
+
+def coast_acceleration(velocity, wind, density, input, cd, mass):
+    """ Vertical acceleration with drag acting along the air-relative velocity. """
+    airspeed = np.sqrt(velocity * velocity + wind * wind)
+    drag = sim.acceleration(airspeed, density, input, cd, mass) + sim.GRAV
+    return -sim.GRAV + drag * velocity / np.maximum(airspeed, 1e-9)
+
+
+def fly(
+    cases=10000,
+    target=3500,
+    gains=(0.00025, 0.001, 0.1),
+    dispersion=None,
+    step=sim.STEP,
+    seed=None,
+    max_time=60,
+    settle_band=50,
+    limits=(0, 1),
+):
+    """ Fly every case from burnout to apogee. Returns per-case arrays of apogee,
+        actuator travel (total change in plate input) and settling time (last time
+        the projected apogee was more than settle_band feet from the target).
+
+        limits is the PID's output range, its top is full plate deflection. (0, 1)
+        drives sim.py's plate input directly, control.PID_LIMITS flies the flight
+        code's degrees. Travel is in full plate sweeps either way. """
+    rng = np.random.default_rng(seed)
+    if dispersion is None:
+        dispersion = Dispersion()
+    params = dispersion.sample(cases, rng)
+    atmosphere = AtmosphereTable()
+
+    altitude = params["altitude"]
+    velocity = params["velocity"]
+    apogee = altitude.copy()
+    travel = np.zeros(cases)
+    settling_time = np.zeros(cases)
+    low, high = limits
+    pid = BatchPID(*gains, target, min_output=low, max_output=high)
+    plate = np.zeros(cases)
+    accel = coast_acceleration(
+        velocity,
+        params["wind"],
+        atmosphere.density(altitude),
+        0,
+        params["cd"],
+        params["mass"],
+    )
+
+    time = 0
+    active = velocity > 0
+    while active.any() and time < max_time:
+        # Cases past apogee stop moving, so they just ride along
+        dt = step * active
+        altitude = altitude + velocity * dt
+        velocity = velocity + accel * dt
+        np.maximum(apogee, altitude, out=apogee)
+
+        measured_alt = altitude + rng.normal(0, dispersion.altitude_noise, cases)
+        measured_vel = velocity + rng.normal(0, dispersion.velocity_noise, cases)
+        measured_acc = accel + rng.normal(0, dispersion.accel_noise, cases)
+        p_alt = batch_projected_altitude(measured_acc, measured_vel, measured_alt)
+        last_plate = plate
+        plate = pid.output(p_alt, step) / high
+
+        time += step
+        travel += np.abs(plate - last_plate) * active
+        unsettled = active & (np.abs(p_alt - target) > settle_band)
+        settling_time[unsettled] = time
+
+        accel = coast_acceleration(
+            velocity,
+            params["wind"],
+            atmosphere.density(altitude),
+            plate,
+            params["cd"],
+            params["mass"],
+        )
+        active = velocity > 0
+
+    return {"apogee": apogee, "travel": travel, "settling_time": settling_time}
+
+
+def simulate(cases=10000, target=3500, gains=(0.00025, 0.001, 0.1), **kwargs):
+    """ Fly every case from burnout to apogee, returns the apogee of each. """
+    return fly(cases, target, gains, **kwargs)["apogee"]
+
+
+def summarize(apogees, target):
+    """ Mean, spread and percentiles of the apogees, and of the miss from target. """
+    miss = apogees - target
+    return {
+        "cases": len(apogees),
+        "mean": float(apogees.mean()),
+        "std": float(apogees.std()),
+        "mean_miss": float(miss.mean()),
+        "mean_abs_miss": float(np.abs(miss).mean()),
+        "percentiles": dict(zip(PERCENTILES, np.percentile(apogees, PERCENTILES))),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo apogee dispersion")
+    parser.add_argument("--cases", type=int, default=10000)
+    parser.add_argument("--target", type=float, default=3500)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--plot", action="store_true", help="show a histogram")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    apogees = simulate(args.cases, args.target, seed=args.seed)
+    elapsed = perf_counter() - start
+    summary = summarize(apogees, args.target)
+
+    print(f"{summary['cases']:,} cases in {elapsed:.2f} s")
+    print(f"Apogee:         {summary['mean']:,.1f} +/- {summary['std']:,.1f} ft")
+    print(f"Mean miss:      {summary['mean_miss']:,.1f} ft")
+    print(f"Mean abs miss:  {summary['mean_abs_miss']:,.1f} ft")
+    for pct, value in summary["percentiles"].items():
+        print(f"  P{pct:<3}         {value:,.1f} ft")
+
+    if args.plot:
+        import matplotlib.pyplot as plt
+
+        plt.hist(apogees, bins=100)
+        plt.axvline(args.target, color="k")
+        plt.xlabel("Apogee (ft)")
+        plt.show()
@@ -1,7 +1,13 @@
-import matplotlib.pyplot as plt
+import os
+import sys
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+FLIGHTCODE_DIR = os.path.join(SIM_DIR, "..", "flightcode")
+sys.path.insert(0, FLIGHTCODE_DIR)
+
 from atmosphere import Atmosphere
-from src.pid import PID
-from src.vehicle import projected_altitude
+from pid import PID
+from vehicle import projected_altitude
 
 CD = 0.5  # Approximate drag coefficient of vehicle
 AREA = 0.79  # Frontal area of rocket
@@ -12,28 +18,51 @@ TIME = 0
 STEP = 0.01
 
 
-def acceleration(velocity, density, input):
-    cd = CD + (0.75 * input)
-    return -GRAV - (cd * AREA * density * (velocity ** 2) / (2 * MASS))
+def acceleration(velocity, density, input, cd=CD, mass=MASS):
+    """ Works elementwise on NumPy arrays as well as on plain numbers. """
+    cd = cd + (0.75 * input)
+    return -GRAV - (cd * AREA * density * (velocity ** 2) / (2 * mass))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import matplotlib.pyplot as plt
+
+    from integrators import INTEGRATORS, Event, create_integrator, solve
+
+    parser = argparse.ArgumentParser(description="Closed loop coast to apogee")
+    parser.add_argument("--integrator", choices=list(INTEGRATORS), default="rk4")
+    args = parser.parse_args()
 
+    AtmosEngine = Atmosphere()
+    integrator = create_integrator(args.integrator, step=STEP)
+    apogee = Event("apogee", lambda t, y: y[1], direction=-1, terminal=True)
+    time = TIME
+    state = (1000.0, 700.0)  # altitude, velocity
 
-AtmosEngine = Atmosphere()
-altitude = 1000
-velocity = 700
-accel = acceleration(velocity, AtmosEngine.density(altitude), 0)
+    pid = PID(0.00025, 0.001, 0.1, 3500, 0, 1)
+    pid_output = 0
 
-pid = PID(0.00025, 0.001, 0.1, 3500, 0, 1)
+    def rates(t, y):
+        altitude, velocity = y
+        density = AtmosEngine.density(altitude)
+        return velocity, acceleration(velocity, density, pid_output)
 
-pid_outputs = []
+    pid_outputs = []
 
-while velocity > 0:
-    altitude += velocity * STEP
-    velocity += accel * STEP
-    p_alt = projected_altitude(accel, velocity, altitude)
-    pid_output = pid.output(p_alt, STEP)
-    accel = acceleration(velocity, AtmosEngine.density(altitude), pid_output)
-    pid_outputs.append(pid_output)
+    # The plate input is held for a step at a time, apogee ends the last one
+    found = []
+    while not found:
+        altitude, velocity = state
+        accel = rates(time, state)[1]
+        p_alt = projected_altitude(accel, velocity, altitude)
+        pid_output = pid.output(p_alt, STEP)
+        pid_outputs.append(pid_output)
+        end = time + STEP
+        time, state, found = solve(rates, time, state, end, integrator, [apogee])
 
-print(f"Altitude: {altitude}")
-plt.plot(pid_outputs)
-plt.show()
+    print(f"Altitude: {state[0]}")
+    print(f"{integrator.evaluations:,} derivative evaluations")
+    plt.plot(pid_outputs)
+    plt.show()
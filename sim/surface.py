@@ -0,0 +1,110 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  Builds the apogee prediction surface the flight code  |
+# |   | |/ _____ \| |   |  interpolates (flightcode/predictor.py). Every grid    |
+# |   | / /_   _\ \ |   |  point of altitude, vertical velocity and plate angle  |
+# |  |_____|___|_____|  |  is coasted to apogee with the drag model in sim.py,   |
+# |    \___________/    |  all at once as NumPy arrays.                          |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import argparse
+import json
+from time import perf_counter
+
+import numpy as np
+
+import sim
+from atmosphere import AtmosphereTable
+from predictor import ApogeePredictor, surface_files
+
+MAX_ANGLE = 180  # plate angle the flight code commands at full deflection
+
+
+def axis(start, stop, step):
+    count = int(round((stop - start) / step)) + 1
+    return {"start": start, "step": step, "count": count}
+
+
+def values(axis):
+    return axis["start"] + axis["step"] * np.arange(axis["count"])
+
+
+def coast_gain(altitude, velocity, angle, step=sim.STEP, max_time=120):
+    """ How much higher each state coasts before apogee, holding the plate angle.
+        Takes arrays of matching shape. """
+    atmosphere = AtmosphereTable()
+    input = np.asarray(angle, dtype=float) / MAX_ANGLE
+    start = np.asarray(altitude, dtype=float)
+    altitude = start.copy()
+    velocity = np.asarray(velocity, dtype=float).copy()
+    apogee = altitude.copy()
+    time = 0
+    active = velocity > 0
+    while active.any() and time < max_time:
+        accel = sim.acceleration(velocity, atmosphere.density(altitude), input)
+        dt = step * active
+        altitude += velocity * dt
+        velocity += accel * dt
+        np.maximum(apogee, altitude, out=apogee)
+        active = velocity > 0
+        time += step
+    return apogee - start
+
+
+def build(file_name, altitudes, velocities, angles):
+    """ Coast every grid point and save the gains as a .npy with a .json of axes. """
+    alt, vel, ang = np.meshgrid(
+        values(altitudes), values(velocities), values(angles), indexing="ij"
+    )
+    gains = coast_gain(alt, vel, ang)
+    surface_file, axes_file = surface_files(file_name)
+    np.save(surface_file, gains)
+    with open(axes_file, "w") as f:
+        json.dump(
+            {
+                "altitude": altitudes,
+                "velocity": velocities,
+                "angle": angles,
+                "model": {"cd": sim.CD, "area": sim.AREA, "mass": sim.MASS},
+            },
+            f,
+            indent=2,
+        )
+    return gains
+
+
+def check(file_name, altitudes, velocities, samples=2000, seed=0):
+    """ Largest difference between the interpolated and integrated apogee at
+        random points inside the surface, in feet. """
+    rng = np.random.default_rng(seed)
+    predictor = ApogeePredictor(file_name)
+    alt = rng.uniform(altitudes["start"], values(altitudes)[-1], samples)
+    vel = rng.uniform(velocities["step"], values(velocities)[-1], samples)
+    ang = rng.uniform(0, MAX_ANGLE, samples)
+    exact = alt + coast_gain(alt, vel, ang)
+    predicted = np.array([predictor.predict(a, v, p) for a, v, p in zip(alt, vel, ang)])
+    return float(np.abs(predicted - exact).max())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the apogee surface")
+    parser.add_argument("output", help="where to save it, e.g. apogee_surface.npy")
+    parser.add_argument("--max-altitude", type=float, default=15000)
+    parser.add_argument("--altitude-step", type=float, default=250)
+    parser.add_argument("--max-velocity", type=float, default=1200)
+    parser.add_argument("--velocity-step", type=float, default=10)
+    parser.add_argument("--angle-step", type=float, default=5)
+    args = parser.parse_args()
+
+    altitudes = axis(0, args.max_altitude, args.altitude_step)
+    velocities = axis(0, args.max_velocity, args.velocity_step)
+    angles = axis(0, MAX_ANGLE, args.angle_step)
+
+    start = perf_counter()
+    gains = build(args.output, altitudes, velocities, angles)
+    elapsed = perf_counter() - start
+    print(f"{gains.size:,} points {gains.shape} in {elapsed:.1f} s")
+    error = check(args.output, altitudes, velocities)
+    print(f"Largest interpolation error: {error:.2f} ft")
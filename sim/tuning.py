@@ -0,0 +1,247 @@
+# +------------------------------------------------------------------------------+
+# |         ___         |                                                        |
+# |  _____ / _ \ _____  |  Description:                                          |
+# |  |_ _|/ /_\ \|_ _|  |  PID gain tuning against the simulated coast phase.    |
+# |   | |/ _____ \| |   |  Candidates are scored in a process pool, by grid or   |
+# |   | / /_   _\ \ |   |  by a parallel pattern search, and every result is     |
+# |  |_____|___|_____|  |  cached on disk by gains and vehicle parameters so     |
+# |    \___________/    |  repeated sweeps only fly the new points.              |
+# |                     |                                                        |
+# +------------------------------------------------------------------------------+
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+
+import montecarlo
+from control import PID_GAINS, PID_LIMITS
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tuning.json")
+
+# Candidates run the flight code's PID on its own output range, plate degrees
+# clamped to control.PID_LIMITS, so the gains found go straight into
+# control.PID_GAINS. Its (KI * I) * (KD * D) term means gains tuned on another
+# output scale don't carry over by rescaling.
+
+# Range the pattern search keeps KP, KI and KD in, two decades either side of the
+# flight gains, the same span as the default grid
+GAIN_MIN = tuple(gain / 100 for gain in PID_GAINS)
+GAIN_MAX = tuple(gain * 100 for gain in PID_GAINS)
+
+
+class Scenario:
+    """ Everything besides the gains that decides how a candidate flies. """
+
+    def __init__(
+        self,
+        target=3500,
+        cases=200,
+        seed=0,
+        dispersion=None,
+        travel_weight=100,
+        limits=PID_LIMITS,
+    ):
+        self.target = target  # apogee, ft above sea level like the dispersion
+        self.limits = limits
+        self.cases = cases
+        self.seed = seed
+        self.dispersion = dispersion or montecarlo.Dispersion()
+        self.travel_weight = travel_weight  # feet of miss worth one full plate sweep
+
+    def key(self, gains):
+        """ Cache key for a candidate flown in this scenario. """
+        description = {
+            "gains": [float(gain) for gain in gains],
+            "target": self.target,
+            "cases": self.cases,
+            "seed": self.seed,
+            "limits": list(self.limits),
+            "step": montecarlo.sim.STEP,
+            "vehicle": {"area": montecarlo.sim.AREA, **vars(self.dispersion)},
+        }
+        text = json.dumps(description, sort_keys=True)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+
+def evaluate(gains, scenario):
+    """ Fly one candidate, returns its metrics. Runs in a worker process. """
+    result = montecarlo.fly(
+        scenario.cases,
+        scenario.target,
+        gains,
+        dispersion=scenario.dispersion,
+        seed=scenario.seed,
+        limits=scenario.limits,
+    )
+    miss = result["apogee"] - scenario.target
+    travel = float(result["travel"].mean())
+    mean_abs_miss = float(np.abs(miss).mean())
+    return {
+        "gains": [float(gain) for gain in gains],
+        "mean_miss": float(miss.mean()),
+        "mean_abs_miss": mean_abs_miss,
+        "worst_miss": float(np.abs(miss).max()),
+        "travel": travel,
+        "settling_time": float(result["settling_time"].mean()),
+        "score": mean_abs_miss + scenario.travel_weight * travel,
+    }
+
+
+class Tuner:
+    """ Scores candidate gains in parallel, remembering results between runs. """
+
+    def __init__(self, scenario=None, workers=None, cache_file=CACHE_FILE):
+        self.scenario = scenario or Scenario()
+        self.workers = workers
+        self.cache_file = cache_file
+        self.cache = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    self.cache = json.load(f)
+            except ValueError:
+                pass  # left by an older, interrupted run, start over
+        self.hits = 0
+        self.misses = 0
+
+    def save(self):
+        """ Replace the cache in one rename, so an interrupted run never leaves
+            half a file. """
+        if self.cache_file is not None:
+            temporary = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(temporary, "w") as f:
+                json.dump(self.cache, f)
+            os.replace(temporary, self.cache_file)
+
+    def score(self, candidates):
+        """ Metrics for every candidate, flying only the ones not cached yet. """
+        keys = [self.scenario.key(gains) for gains in candidates]
+        todo = {}
+        for key, gains in zip(keys, candidates):
+            if key in self.cache:
+                self.hits += 1
+            elif key not in todo:
+                todo[key] = gains
+        self.misses += len(todo)
+
+        if todo:
+            scenarios = [self.scenario] * len(todo)
+            with ProcessPoolExecutor(self.workers) as pool:
+                results = pool.map(evaluate, todo.values(), scenarios)
+                for key, result in zip(todo, results):
+                    self.cache[key] = result
+            self.save()
+
+        return [self.cache[key] for key in keys]
+
+    def grid(self, kp_values, ki_values, kd_values):
+        """ Score every combination of the given gains, best first. """
+        results = self.score(list(product(kp_values, ki_values, kd_values)))
+        return sorted(results, key=lambda result: result["score"])
+
+    def pattern_search(
+        self,
+        start,
+        step=1.0,
+        min_step=0.05,
+        max_iterations=30,
+        gain_min=GAIN_MIN,
+        gain_max=GAIN_MAX,
+    ):
+        """ Derivative-free compass search in log10 gain space. Each iteration scores
+            the six neighbours of the current point at once and moves to the best,
+            halving the step when none of them improves. Every gain is clamped to
+            [gain_min, gain_max], so one that barely matters can't drift off to
+            zero. Returns the best result and the path taken. """
+        low, high = np.log10(gain_min), np.log10(gain_max)
+        point = np.clip(np.log10(start), low, high)
+        best = self.score([tuple(10 ** point)])[0]
+        path = [best]
+        for _ in range(max_iterations):
+            if step < min_step:
+                break
+            neighbours = []
+            for axis, sign in product(range(3), (1, -1)):
+                neighbour = point.copy()
+                neighbour[axis] += sign * step
+                neighbours.append(np.clip(neighbour, low, high))
+            results = self.score([tuple(10 ** n) for n in neighbours])
+            index = min(range(len(results)), key=lambda i: results[i]["score"])
+            if results[index]["score"] < best["score"]:
+                point = neighbours[index]
+                best = results[index]
+                path.append(best)
+            else:
+                step /= 2
+        return best, path
+
+
+def print_results(results):
+    print(
+        f"{'KP':>10} {'KI':>10} {'KD':>10} {'score':>9} {'|miss|':>9} "
+        f"{'worst':>9} {'travel':>7} {'settle s':>9}"
+    )
+    for r in results:
+        kp, ki, kd = r["gains"]
+        print(
+            f"{kp:10.3g} {ki:10.3g} {kd:10.3g} {r['score']:9.1f} "
+            f"{r['mean_abs_miss']:9.1f} {r['worst_miss']:9.1f} {r['travel']:7.2f} "
+            f"{r['settling_time']:9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the PID gains in simulation")
+    parser.add_argument("method", choices=("grid", "search"))
+    parser.add_argument("--target", type=float, default=3500)
+    parser.add_argument("--cases", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--points", type=int, default=5, help="grid points per gain")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--start",
+        type=float,
+        nargs=3,
+        default=PID_GAINS,
+        metavar=("KP", "KI", "KD"),
+        help="gains to center the grid on or start the search from",
+    )
+    parser.add_argument(
+        "--min",
+        type=float,
+        nargs=3,
+        default=GAIN_MIN,
+        metavar=("KP", "KI", "KD"),
+        help="smallest gains the search may try",
+    )
+    parser.add_argument(
+        "--max",
+        type=float,
+        nargs=3,
+        default=GAIN_MAX,
+        metavar=("KP", "KI", "KD"),
+        help="largest gains the search may try",
+    )
+    args = parser.parse_args()
+
+    tuner = Tuner(Scenario(args.target, args.cases, args.seed), args.workers)
+    if args.method == "grid":
+        # Two decades either side of the starting gains
+        axes = [np.logspace(-2, 2, args.points) * gain for gain in args.start]
+        results = tuner.grid(*axes)
+        best = results[0]
+        print_results(results[: args.top])
+    else:
+        best, path = tuner.pattern_search(
+            args.start, gain_min=args.min, gain_max=args.max
+        )
+        print_results(path)
+    kp, ki, kd = best["gains"]
+    print(f"PID_GAINS = ({kp:.6g}, {ki:.6g}, {kd:.6g})  # for control.py")
+    print(f"{tuner.misses} candidates flown, {tuner.hits} from cache")